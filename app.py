@@ -1,26 +1,34 @@
 from flask import Flask, jsonify, request, Response
 from flask_cors import CORS
-import asyncio
 import threading
 import io
 import sys
 import argparse
+import multiprocessing
 import yaml
 import os
-import queue
+import json
 from pathlib import Path
 import shutil
 from caption_openai import main as caption_main
+from metrics.timing import prometheus_text
+from metrics.events import LOG, STATUS
+from scheduling.jobs import JobManager
+from scheduling.shared_budget import SharedConcurrencyBudget
 from hints.registration import get_available_hint_sources, get_hint_source_descriptions
 import time
 
 app = Flask(__name__)
 CORS(app)
 
-captioning_in_progress = False
 captioning_lock = threading.Lock()  # Lock to prevent race conditions
-output_queue = queue.Queue()
-current_task = None
+# Every job shares one concurrency budget per endpoint, so jobs running side by side don't overload a server
+job_manager = JobManager(SharedConcurrencyBudget(), run_job=caption_main)
+ui_job = None  # the job started by the UI through /api/run
+
+STREAM_INTERVAL = 0.25  # seconds between batches sent to a client
+STREAM_BATCH = 500  # events per batch at most
+KEEPALIVE_SECONDS = 5
 
 def get_user_config_dir():
     """Get the user configuration directory path (cross-platform)"""
@@ -68,24 +76,17 @@ def restore_config_from_user_dir(config_path) -> bool:
         print(f"Failed to restore config from backup: {e}")
     return False
 
-async def run_captioning_task():
-    """Wrapper function for caption_main that handles cancellation"""
-    try:
-        await caption_main()
-    except asyncio.CancelledError:
-        print("Captioning task was cancelled")
-        raise
+def captioning_in_progress():
+    return ui_job is not None and ui_job.running
 
 @app.route('/api/stop', methods=['POST'])
 def stop_captioning():
-    global current_task
-
-    if current_task is None or current_task.done():
+    if not captioning_in_progress():
         return jsonify({'error': 'No captioning process is currently running'}), 400
 
     try:
         # Cancel the task
-        current_task.cancel()
+        ui_job.stop()
         return jsonify({
             'success': True,
             'message': 'Captioning cancellation requested'
@@ -99,13 +100,25 @@ def stop_captioning():
 @app.route('/api/status', methods=['GET'])
 def get_status():
     return jsonify({
-        'captioning_in_progress': captioning_in_progress
+        'captioning_in_progress': captioning_in_progress(),
+        'jobs_running': len(job_manager.running())
     })
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'healthy'})
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Timing and throughput of every job still listed, in Prometheus text format,
+    each job's samples labelled with its id"""
+    jobs = job_manager.list()
+    text = "# HELP vlm_caption_running Whether a captioning run is in progress.\n"
+    text += "# TYPE vlm_caption_running gauge\n"
+    text += f"vlm_caption_running {1 if any(job.running for job in jobs) else 0}\n"
+    text += prometheus_text([({"job": job.id}, job.metrics) for job in jobs if job.metrics is not None])
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/hint_sources', methods=['GET'])
 def get_hint_sources():
     try:
@@ -233,109 +246,149 @@ def update_config():
         }), 500
         
 
-class StreamingStdout:
-    """Custom stdout class that writes to both console and queue"""
-    def __init__(self, original_stdout, output_queue):
-        self.original_stdout = original_stdout
-        self.output_queue = output_queue
-        self.buffer = ""
-        self.encoding = 'utf-8'
-
-    def write(self, text):
-        self.original_stdout.write(text)
-        self.original_stdout.flush()
-
-        self.buffer += text
-        while '\n' in self.buffer:
-            line, self.buffer = self.buffer.split('\n', 1)
-            self.output_queue.put(line + '\n')
-
-    def flush(self):
-        self.original_stdout.flush()
-
-def run_captioning_with_streaming():
-    global captioning_in_progress, captioning_lock, output_queue, current_task
-
-    original_stdout = sys.stdout
-    
-    try:
-        # Clear any remaining items in the output queue
-        while not output_queue.empty():
-            try:
-                output_queue.get_nowait()
-            except queue.Empty:
+def console_line(event):
+    """The line the UI console shows for a log or status event, None for other events"""
+    if event['type'] == LOG:
+        return event['text'].rstrip()
+    if event['type'] == STATUS:
+        if event['status'] == 'complete':
+            return '[COMPLETE]'
+        if event['status'] == 'cancelled':
+            return f"[CANCELLED] {event['message']}"
+        return f"[ERROR] {event['message']}"
+    return None
+
+def stream_events(job, offset, console=False):
+    """Generator of Server-Sent Events for the job's events from offset on, sent in batches
+    at most every STREAM_INTERVAL seconds. Events go out as JSON in 'events' messages,
+    whose id is the offset to resume from. With console, log lines and the run status
+    are sent as plain messages instead, as the UI console expects. Ends after the
+    job's complete or error status, or once it has finished and all events are sent."""
+    last_sent = 0.0
+    while True:
+        wait = STREAM_INTERVAL - (time.monotonic() - last_sent)
+        if wait > 0:
+            time.sleep(wait)
+        if not job.events.wait(offset, KEEPALIVE_SECONDS):
+            if not job.running:
                 break
+            yield "data: [KEEPALIVE]\n\n" if console else ": keepalive\n\n"
+            continue
+
+        events, offset, dropped = job.events.read(offset, STREAM_BATCH)
+        last_sent = time.monotonic()
+        messages = []
+        typed = []
+        for event in events:
+            line = console_line(event) if console else None
+            if line is None:
+                typed.append(event)
+            else:
+                if typed:
+                    messages.append(f"event: events\ndata: {json.dumps({'events': typed})}\n\n")
+                    typed = []
+                messages.append(f"data: {line}\n\n")
+        if typed or dropped:
+            messages.append(f"event: events\ndata: {json.dumps({'events': typed, 'dropped': dropped})}\n\n")
+        messages[-1] = f"id: {offset}\n" + messages[-1]
+        yield "".join(messages)
+
+        if any(event['type'] == STATUS and event['status'] != 'cancelled' for event in events):
+            break
 
-        sys.stdout = StreamingStdout(original_stdout, output_queue)
-
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-
-        current_task = loop.create_task(run_captioning_task())
-
-        try:
-            loop.run_until_complete(current_task)
-        except asyncio.CancelledError:
-            output_queue.put("data: [CANCELLED] Captioning was cancelled by user\n\n")
-
-        output_queue.put("data: [COMPLETE]\n\n")
-        loop.close()
-
-    except Exception as e:
-        output_queue.put(f"data: [ERROR] run_captioning_with_streaming {str(e)}\n\n")
-    finally:
-        sys.stdout = original_stdout
-    
-    with captioning_lock:
-        captioning_in_progress = False
-
-def generate_stream():
+def generate_stream(job):
     """Generator function for Server-Sent Events"""
-    global output_queue
-
-    captioning_thread = threading.Thread(target=run_captioning_with_streaming)
-    captioning_thread.daemon = True
-    captioning_thread.start()
-
     yield "data: [STARTED] Captioning process started...\n\n"
 
-    while True:
-        try:
-            output = output_queue.get(timeout=1)
-            
-            if output.startswith("data: [COMPLETE]"):
-                yield output
-                break
-            elif output.startswith("data: [ERROR]"):
-                yield output
-                break
-            else:
-                yield f"data: {output.rstrip()}\n\n"
-                
-        except queue.Empty:
-            yield "data: [KEEPALIVE]\n\n"
-            
-            if not captioning_thread.is_alive() and output_queue.empty():
-                break
-        except Exception as e:
-            yield f"data: [ERROR] Stream error: {str(e)}\n\n"
-            break
+    try:
+        yield from stream_events(job, 0, console=True)
+    except Exception as e:
+        yield f"data: [ERROR] Stream error: {str(e)}\n\n"
 
 @app.route('/api/run', methods=['GET'])
 def run_captioning_stream():
     """Start captioning process with real-time streaming output"""
-    global captioning_in_progress, captioning_lock
+    global captioning_lock, ui_job
     
     with captioning_lock:
-        if captioning_in_progress:
+        if captioning_in_progress():
+            last_event_id = request.headers.get('Last-Event-ID', '')
+            if last_event_id.isdigit():
+                # EventSource reconnecting: carry on from the last event it got
+                return Response(stream_events(ui_job, int(last_event_id), console=True), mimetype="text/event-stream")
             return jsonify({'error': 'Captioning is already in progress'}), 400
 
-        captioning_in_progress = True
         backup_config_to_user_dir_with_timestamp()
+        ui_job = job_manager.start('caption.yaml', name='ui')
     
-    return Response(generate_stream(), mimetype="text/event-stream")
+    return Response(generate_stream(ui_job), mimetype="text/event-stream")
+
+def event_offset():
+    """Offset to stream events from: ?offset=N, or the Last-Event-ID of a reconnecting EventSource"""
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        last_event_id = request.headers.get('Last-Event-ID', '')
+        offset = int(last_event_id) if last_event_id.isdigit() else 0
+    return max(0, offset)
+
+@app.route('/api/events', methods=['GET'])
+def stream_run_events():
+    """Progress events of the UI's current (or last) run as JSON Server-Sent Events,
+    replayed from the requested offset as far as the events are still buffered."""
+    if ui_job is None:
+        return jsonify({'error': 'No captioning run yet'}), 404
+    return Response(stream_events(ui_job, event_offset()), mimetype="text/event-stream")
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify({
+        'success': True,
+        'jobs': [job.to_dict() for job in job_manager.list()],
+        'endpoints': job_manager.budget.status()
+    })
+
+@app.route('/api/jobs', methods=['POST'])
+def start_job():
+    """Start a job next to any already running. Body: config_path (default caption.yaml),
+    config (settings that override the file's) and name, all optional."""
+    data = request.get_json(silent=True) or {}
+    config_path = data.get('config_path') or 'caption.yaml'
+    overrides = data.get('config') or {}
+    if not os.path.exists(config_path):
+        return jsonify({'success': False, 'error': f'Config file not found: {config_path}'}), 400
+    if not isinstance(overrides, dict):
+        return jsonify({'success': False, 'error': 'config must be an object of settings'}), 400
+
+    job = job_manager.start(config_path, overrides, name=data.get('name', ''))
+    return jsonify({'success': True, 'job': job.to_dict()})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': f'No job {job_id}'}), 404
+    return jsonify({'success': True, 'job': job.to_dict()})
+
+@app.route('/api/jobs/<job_id>/stop', methods=['POST'])
+def stop_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': f'No job {job_id}'}), 404
+    if not job.stop():
+        return jsonify({'error': f'Job {job_id} is not running'}), 400
+    return jsonify({'success': True, 'message': 'Job cancellation requested'})
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def stream_job_events(job_id):
+    """The job's events as JSON Server-Sent Events, replayed from the requested offset"""
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': f'No job {job_id}'}), 404
+    return Response(stream_events(job, event_offset()), mimetype="text/event-stream")
 
 if __name__ == '__main__':
+    # The packaged exe starts from here, so image preprocessing workers must stop here too
+    multiprocessing.freeze_support()
     argparser = argparse.ArgumentParser()
     argparser.add_argument("--port", type=int, default=5000)
     args = argparser.parse_args()
@@ -0,0 +1,405 @@
+"""
+Offline batch mode: instead of streaming every turn of every image, export the
+requests as OpenAI Batch API input files, have the provider run them, and
+import its output files. Each export/import round runs one stage of the
+conversation (see turn_stages), so a config with several turns takes one batch
+per stage. Finished captions go through the same filters and writers as a
+normal run.
+"""
+
+import os
+import re
+import json
+import asyncio
+from concurrent.futures import Executor
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from batch_api.batch_state import STATUS_DONE, STATUS_EXPORTED, STATUS_PENDING, BatchImage, BatchState
+from caption_openai import PREFETCH_WORKERS, ImageJob, first_prompt_text, load_config, read_image_bytes, write_image
+from file_utils.caption_index import open_caption_index
+from file_utils.caption_writer import CaptionWriter, create_caption_writer
+from file_utils.file_access import OUTPUT_FORMAT_TXT, WALK_WORKERS, image_walk
+from file_utils.image_preprocess import create_preprocess_executor, encode_image
+from file_utils.shard_output import ShardOutput, open_shard_output
+from hints.hint_sources import get_hints_async
+from hints.registration import HintCache
+from response_filters import filter_ascii, filter_caption, filter_thinking
+from scheduling.memory_budget import MB
+from scheduling.pipeline import Pipeline, Stage
+from scheduling.sharding import create_shard
+from scheduling.prompt_graph import PromptNode, prompt_identity, prompt_nodes, turn_messages, turn_stages
+
+CHAT_COMPLETIONS_URL = "/v1/chat/completions"
+# Limits of one OpenAI batch input file, with some room to spare on the size
+DEFAULT_MAX_REQUESTS = 50000
+DEFAULT_MAX_MB = 190
+CHUNK_SIZE = 1000
+
+_CUSTOM_ID = re.compile(r"^img(\d+)-t(\d+)$")
+
+
+def custom_id(image_id: int, turn: int) -> str:
+    return f"img{image_id}-t{turn}"
+
+
+def parse_custom_id(value: str) -> Optional[Tuple[int, int]]:
+    """The (image id, turn index) of a request's custom_id, or None if it is not one of ours."""
+    match = _CUSTOM_ID.match(value or "")
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def request_line(request_id: str, body: Dict) -> str:
+    """One line of a Batch API input file."""
+    return json.dumps({"custom_id": request_id, "method": "POST", "url": CHAT_COMPLETIONS_URL, "body": body})
+
+
+class BatchResult(NamedTuple):
+    custom_id: str
+    text: Optional[str]
+    prompt_tokens: int
+    completion_tokens: int
+    error: Optional[str]
+
+
+def parse_result_line(line: str) -> BatchResult:
+    """Read one line of a Batch API output or error file."""
+    record = json.loads(line)
+    request_id = record.get("custom_id", "")
+    error = record.get("error")
+    if error:
+        message = error.get("message") if isinstance(error, dict) else None
+        return BatchResult(request_id, None, 0, 0, message or json.dumps(error))
+    response = record.get("response") or {}
+    body = response.get("body") or {}
+    status = response.get("status_code", 0)
+    if status != 200:
+        message = (body.get("error") or {}).get("message") if isinstance(body, dict) else None
+        return BatchResult(request_id, None, 0, 0, f"HTTP {status}: {message or json.dumps(body)}")
+    choices = body.get("choices") or []
+    text = choices[0].get("message", {}).get("content") if choices else None
+    if text is None:
+        return BatchResult(request_id, None, 0, 0, "response has no message content")
+    usage = body.get("usage") or {}
+    return BatchResult(request_id, text, usage.get("prompt_tokens") or 0, usage.get("completion_tokens") or 0, None)
+
+
+def batch_identity(conf) -> str:
+    return f"{conf.model}\n{conf.get('system_prompt', '')}\n{prompt_identity(conf)}"
+
+
+def _settings(conf):
+    return conf.get("batch_api", None) or {}
+
+
+def batch_directory(conf) -> str:
+    """Where request files and the batch state go: batch_api.directory, by default a
+    batch_requests folder in base_directory."""
+    return _settings(conf).get("directory", None) or os.path.join(conf.base_directory, "batch_requests")
+
+
+def open_batch_state(conf) -> BatchState:
+    state_file = _settings(conf).get("state_file", None) or os.path.join(batch_directory(conf), "batch_state.sqlite")
+    return BatchState(state_file)
+
+
+async def build_requests(image: BatchImage, conf, nodes: List[PromptNode], stages: List[int],
+                         executor: Optional[Executor] = None,
+                         hint_cache: Optional[HintCache] = None) -> Tuple[str, List[str]]:
+    """The image's first prompt (with hints) and the request lines of its current
+    stage: one per turn of the stage that has no response yet. Every request
+    carries the system prompt, the image and the responses the turn depends on."""
+    file_contents = await read_image_bytes(image.image_path)
+    first_prompt = image.first_prompt
+    if first_prompt is None:
+        first_prompt = first_prompt_text(nodes, await get_hints_async(conf.get("hint_sources", []), image.image_path, hint_cache=hint_cache))
+    mime_type, b64_image = await encode_image(file_contents, image.image_path, conf.get("image_preprocess"), executor)
+    del file_contents
+
+    prefix = [{"role": "system", "content": conf.system_prompt}] if conf.get("system_prompt") else []
+    first_message = [{"type": "text", "text": first_prompt},
+                     {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{b64_image}"}}]
+    lines = []
+    for turn, stage in enumerate(stages):
+        if stage != image.stage or turn in image.responses:
+            continue
+        body = {"model": conf.model, "messages": turn_messages(nodes, turn, prefix, first_message, image.responses)}
+        if turn == 0:
+            body["max_tokens"] = conf.max_tokens
+        lines.append(request_line(custom_id(image.id, turn), body))
+    return first_prompt, lines
+
+
+class _RequestFiles:
+    """Numbered request files of one export. A file is closed once the next image's
+    requests would take it over max_requests or max_bytes, and its images are
+    only marked exported after it has been closed."""
+
+    def __init__(self, state: BatchState, directory: str, round_number: int, max_requests: int, max_bytes: int):
+        self.state = state
+        self.directory = directory
+        self.round_number = round_number
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.paths: List[str] = []
+        self.requests = 0
+        self._file = None
+        self._file_requests = 0
+        self._file_bytes = 0
+        self._exported: List[Tuple[int, str]] = []
+
+    async def write(self, image: BatchImage, first_prompt: str, lines: List[str]) -> None:
+        data = "".join(line + "\n" for line in lines).encode("utf-8")
+        if self._file is not None and (self._file_requests + len(lines) > self.max_requests
+                                       or self._file_bytes + len(data) > self.max_bytes):
+            await self.close()
+        if self._file is None:
+            path = os.path.join(self.directory, f"requests-{self.round_number:04d}-{len(self.paths):03d}.jsonl")
+            self._file = open(path, "xb")
+            self.paths.append(path)
+            self._file_requests = self._file_bytes = 0
+        await asyncio.to_thread(self._file.write, data)
+        self._file_requests += len(lines)
+        self._file_bytes += len(data)
+        self.requests += len(lines)
+        self._exported.append((image.id, first_prompt))
+
+    async def close(self) -> None:
+        if self._file is None:
+            return
+        await asyncio.to_thread(self._file.close)
+        self._file = None
+        await self.state.mark_exported(self._exported, os.path.basename(self.paths[-1]))
+        self._exported = []
+
+
+async def _add_walked_images(conf, state: BatchState, caption_index) -> int:
+    skip_if_caption_exists = conf.get("skip_if_caption_exists", conf.get("skip_if_txt_exists", False))
+    added = 0
+    chunk: List[str] = []
+    async for image_path in image_walk(
+        conf.base_directory,
+        recursive=conf.recursive,
+        skip_if_caption_exists=skip_if_caption_exists,
+        output_format=conf.get("output_format", OUTPUT_FORMAT_TXT),
+        model=conf.get("model", ""),
+        concat_prompt=prompt_identity(conf),
+        caption_index=caption_index,
+        walk_workers=conf.get("walk_workers", WALK_WORKERS),
+        ordered=conf.get("walk_ordered", False),
+    ):
+        chunk.append(image_path)
+        if len(chunk) >= CHUNK_SIZE:
+            added += await state.add_images(chunk)
+            chunk = []
+    if chunk:
+        added += await state.add_images(chunk)
+    return added
+
+
+async def export_requests(conf, state: BatchState, directory: str, executor: Optional[Executor] = None,
+                          caption_index=None, requeue: bool = False) -> List[str]:
+    """Add newly walked images to the batch state, then write the requests of the
+    current stage of every pending image to request files in directory.
+    Returns the paths of the files written."""
+    nodes = prompt_nodes(conf)
+    stages = turn_stages(nodes)
+    await state.check_identity(batch_identity(conf))
+    if requeue:
+        print(f" -> Requeued {await state.requeue_exported()} exported images without imported results")
+    added = await _add_walked_images(conf, state, caption_index)
+    print(f" -> {added} new images")
+
+    settings = _settings(conf)
+    os.makedirs(directory, exist_ok=True)
+    files = _RequestFiles(state, directory, await state.next_round(),
+                          settings.get("max_requests", DEFAULT_MAX_REQUESTS),
+                          int(settings.get("max_mb", DEFAULT_MAX_MB) * MB))
+    hint_cache = HintCache()
+
+    async def pending():
+        after_id = 0
+        while True:
+            images = await state.pending(after_id, CHUNK_SIZE)
+            if not images:
+                return
+            for image in images:
+                yield image
+            after_id = images[-1].id
+
+    async def prepare(image: BatchImage):
+        try:
+            first_prompt, lines = await build_requests(image, conf, nodes, stages, executor, hint_cache)
+        except Exception as e:
+            print(filter_ascii(f"Failed to export {image.image_path}: {e}"))
+            await state.record_results([(image, str(e))])
+            return None
+        return (image, first_prompt, lines) if lines else None
+
+    async def write(item) -> None:
+        await files.write(*item)
+
+    workers = conf.get("prefetch_workers", PREFETCH_WORKERS)
+    pipeline = Pipeline([
+        Stage("prepare", prepare, workers=workers, queue_size=workers),
+        Stage("write", write, queue_size=workers),
+    ])
+    try:
+        await pipeline.run(pending())
+    finally:
+        await files.close()
+    print(filter_ascii(f" -> Exported {files.requests} requests to {len(files.paths)} files in {directory}"))
+    return files.paths
+
+
+async def _save_caption(conf, image: BatchImage, final_turn: int, caption_index, shard_output, caption_writer) -> Dict:
+    job = ImageJob(
+        image.image_path,
+        model=conf.model,
+        caption_text=filter_caption(image.responses[final_turn].strip()),
+        prompt_token_usage=image.prompt_tokens,
+        completion_token_usage=image.completion_tokens,
+    )
+    return await write_image(job, conf, caption_index=caption_index, shard_output=shard_output, caption_writer=caption_writer)
+
+
+async def _import_chunk(conf, state: BatchState, nodes: List[PromptNode], stages: List[int], results: Sequence[BatchResult],
+                        totals: Dict[str, int], caption_index, shard_output, caption_writer) -> None:
+    parsed = []
+    for result in results:
+        ids = parse_custom_id(result.custom_id)
+        if ids is None:
+            totals["ignored"] += 1
+        else:
+            parsed.append((ids, result))
+    stored = await state.images(sorted({image_id for (image_id, _), _ in parsed}))
+
+    images: Dict[int, BatchImage] = {}
+    errors: Dict[int, str] = {}
+    for (image_id, turn), result in parsed:
+        image = images.get(image_id) or stored.get(image_id)
+        # Results of another stage or already answered turns are duplicates or
+        # left over from an earlier export, and are not used again
+        if (image is None or image.status == STATUS_DONE or turn >= len(nodes)
+                or stages[turn] != image.stage or turn in image.responses):
+            totals["ignored"] += 1
+            continue
+        images[image_id] = image
+        if result.error is not None:
+            errors[image_id] = f"{nodes[turn].name}: {result.error}"
+            totals["failed"] += 1
+            continue
+        responses = dict(image.responses)
+        responses[turn] = filter_thinking(result.text)
+        images[image_id] = image._replace(responses=responses,
+                                          prompt_tokens=image.prompt_tokens + result.prompt_tokens,
+                                          completion_tokens=image.completion_tokens + result.completion_tokens)
+        totals["responses"] += 1
+
+    updates = []
+    finished = []
+    for image_id, image in images.items():
+        stage_complete = all(turn in image.responses for turn, stage in enumerate(stages) if stage == image.stage)
+        if stage_complete and image.stage == stages[-1]:
+            finished.append(image)
+        elif stage_complete:
+            updates.append((image._replace(stage=image.stage + 1, status=STATUS_PENDING), None))
+        elif image_id in errors:
+            updates.append((image._replace(status=STATUS_PENDING), errors[image_id]))
+        else:
+            updates.append((image, None))
+
+    final_turn = len(nodes) - 1
+    saved = await asyncio.gather(*(_save_caption(conf, image, final_turn, caption_index, shard_output, caption_writer)
+                                   for image in finished))
+    for image, result in zip(finished, saved):
+        if result["success"]:
+            updates.append((image._replace(status=STATUS_DONE), None))
+            totals["captioned"] += 1
+        else:
+            print(filter_ascii(f"Failed to save caption for {image.image_path}: {result['error']}"))
+            responses = {turn: text for turn, text in image.responses.items() if turn != final_turn}
+            updates.append((image._replace(status=STATUS_PENDING, responses=responses), result["error"]))
+            totals["failed"] += 1
+    await state.record_results(updates)
+
+
+def _read_results(path: str) -> List[BatchResult]:
+    results = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                results.append(parse_result_line(line))
+            except (ValueError, AttributeError) as e:
+                print(filter_ascii(f"Skipping unreadable line in {path}: {e}"))
+    return results
+
+
+async def import_results(conf, state: BatchState, result_paths: Sequence[str], caption_index=None,
+                         shard_output: Optional[ShardOutput] = None,
+                         caption_writer: Optional[CaptionWriter] = None) -> Dict[str, int]:
+    """Read Batch API output or error files. Each response is filtered and stored,
+    images whose stage is complete move on to the next one, and after the last
+    stage the caption is saved. Failed requests are exported again next time."""
+    nodes = prompt_nodes(conf)
+    stages = turn_stages(nodes)
+    await state.check_identity(batch_identity(conf))
+    totals = {"responses": 0, "captioned": 0, "failed": 0, "ignored": 0}
+    for path in result_paths:
+        results = await asyncio.to_thread(_read_results, path)
+        for start in range(0, len(results), CHUNK_SIZE):
+            await _import_chunk(conf, state, nodes, stages, results[start:start + CHUNK_SIZE], totals,
+                                caption_index, shard_output, caption_writer)
+    return totals
+
+
+async def print_status(conf, state: BatchState) -> None:
+    nodes = prompt_nodes(conf)
+    stages = turn_stages(nodes)
+    counts = await state.counts()
+    for stage in range(stages[-1] + 1):
+        names = ", ".join(node.name for node, node_stage in zip(nodes, stages) if node_stage == stage)
+        print(filter_ascii(f" -> Stage {stage} ({names}): {counts.get((STATUS_PENDING, stage), 0)} pending, "
+                           f"{counts.get((STATUS_EXPORTED, stage), 0)} exported"))
+    print(f" -> Done: {sum(count for (status, _), count in counts.items() if status == STATUS_DONE)}")
+    for image_path, stage, error in await state.failures():
+        print(filter_ascii(f"    stage {stage} failed for {image_path}: {error}"))
+
+
+async def batch_main(config_path: str = "caption.yaml", export: bool = False, requeue: bool = False,
+                     import_paths: Sequence[str] = (), overrides: Optional[Dict] = None) -> None:
+    """Run the batch commands: import result files, then export the next requests,
+    then show the state of the run. overrides are applied to the config as in main()."""
+    conf = await load_config(config_path, overrides)
+    if create_shard(conf) is not None:
+        raise ValueError("shard_index and shard_count cannot be used in batch mode: a batch run exports "
+                         "every pending image of base_directory; split the dataset by base_directory instead")
+    if len(prompt_nodes(conf)) > 1 and conf.get("retry_rules", []):
+        print(" -> Note: retry_rules are not applied in batch mode")
+
+    state = open_batch_state(conf)
+    caption_index = open_caption_index(conf)
+    shard_output = open_shard_output(conf)
+    caption_writer = create_caption_writer(conf, caption_index) if import_paths else None
+    executor = create_preprocess_executor(conf.get("image_preprocess")) if export else None
+    try:
+        if import_paths:
+            totals = await import_results(conf, state, import_paths, caption_index, shard_output, caption_writer)
+            print(f" -> Imported {totals['responses']} responses: {totals['captioned']} images captioned, "
+                  f"{totals['failed']} failed, {totals['ignored']} ignored")
+        if export:
+            await export_requests(conf, state, batch_directory(conf), executor,
+                                  caption_index=shard_output if shard_output is not None else caption_index,
+                                  requeue=requeue)
+        await print_status(conf, state)
+    finally:
+        if caption_writer is not None:
+            await caption_writer.close()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        state.close()
+        if caption_index is not None:
+            caption_index.close()
+        if shard_output is not None:
+            shard_output.close()
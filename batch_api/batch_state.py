@@ -0,0 +1,164 @@
+"""
+State of an offline batch run: which stage each image is on, the responses of
+its earlier turns, and whether its current requests have been exported.
+"""
+
+import json
+import time
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from file_utils.sqlite_store import SqliteStore
+
+STATUS_PENDING = "pending"
+STATUS_EXPORTED = "exported"
+STATUS_DONE = "done"
+
+
+class BatchImage(NamedTuple):
+    id: int
+    image_path: str
+    stage: int
+    status: str
+    first_prompt: Optional[str]
+    responses: Dict[int, str]
+    prompt_tokens: int
+    completion_tokens: int
+
+
+def _image(row) -> BatchImage:
+    responses = {int(turn): text for turn, text in json.loads(row[5]).items()}
+    return BatchImage(row[0], row[1], row[2], row[3], row[4], responses, row[6], row[7])
+
+
+_COLUMNS = "id, image_path, stage, status, first_prompt, responses, prompt_tokens, completion_tokens"
+
+
+class BatchState(SqliteStore):
+    """One row per image. Turns are run in stages (see turn_stages): an image starts
+    pending on stage 0, exporting the requests of its stage marks it exported,
+    and once the results of all turns in the stage are imported it moves on to
+    the next stage (pending again) or, after the last one, is done. A failed
+    request puts the image back to pending on the same stage, so the next export
+    retries the turns of that stage that have no response yet.
+
+    first_prompt is the first turn's prompt text with the image's hints, fixed on
+    the first export so every later turn repeats exactly what the model was sent.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS settings (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS images (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        image_path TEXT NOT NULL UNIQUE,
+        stage INTEGER NOT NULL DEFAULT 0,
+        status TEXT NOT NULL DEFAULT 'pending',
+        first_prompt TEXT,
+        responses TEXT NOT NULL DEFAULT '{}',
+        prompt_tokens INTEGER NOT NULL DEFAULT 0,
+        completion_tokens INTEGER NOT NULL DEFAULT 0,
+        request_file TEXT,
+        error TEXT,
+        updated REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS images_status ON images (status, id);
+    """
+
+    async def check_identity(self, identity: str) -> None:
+        """Tie the state to one model and prompt set. Raises ValueError if it was
+        started with different ones, since half-finished conversations could not
+        be continued with other prompts."""
+        def _check(conn):
+            row = conn.execute("SELECT value FROM settings WHERE key='identity'").fetchone()
+            if row is None:
+                conn.execute("INSERT INTO settings VALUES ('identity', ?)", (identity,))
+                conn.commit()
+                return True
+            return row[0] == identity
+        if not await self._call(_check):
+            raise ValueError(f"Batch state {self.path} was started with a different model or prompts; "
+                             "finish or remove it before changing them")
+
+    async def next_round(self) -> int:
+        """Number the next export, so each export writes its own request files."""
+        def _next(conn):
+            row = conn.execute("SELECT value FROM settings WHERE key='round'").fetchone()
+            number = int(row[0]) + 1 if row else 0
+            conn.execute("INSERT OR REPLACE INTO settings VALUES ('round', ?)", (str(number),))
+            conn.commit()
+            return number
+        return await self._call(_next)
+
+    async def add_images(self, image_paths: Sequence[str]) -> int:
+        """Add images not seen before as pending on the first stage. Returns how many were new."""
+        def _add(conn, now):
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO images (image_path, updated) VALUES (?, ?)",
+                             [(path, now) for path in image_paths])
+            conn.commit()
+            return conn.total_changes - before
+        return await self._call(_add, time.time())
+
+    async def pending(self, after_id: int = 0, limit: int = 1000) -> List[BatchImage]:
+        """Pending images with an id above after_id, in id order."""
+        def _pending(conn):
+            rows = conn.execute(f"SELECT {_COLUMNS} FROM images WHERE status=? AND id>? ORDER BY id LIMIT ?",
+                                (STATUS_PENDING, after_id, limit))
+            return [_image(row) for row in rows]
+        return await self._call(_pending)
+
+    async def images(self, ids: Sequence[int]) -> Dict[int, BatchImage]:
+        def _images(conn):
+            found = {}
+            for image_id in ids:
+                row = conn.execute(f"SELECT {_COLUMNS} FROM images WHERE id=?", (image_id,)).fetchone()
+                if row is not None:
+                    found[image_id] = _image(row)
+            return found
+        return await self._call(_images)
+
+    async def mark_exported(self, exported: Sequence[Tuple[int, str]], request_file: str) -> None:
+        """Mark each (id, first_prompt) as exported to request_file."""
+        def _mark(conn, now):
+            conn.executemany("UPDATE images SET status=?, first_prompt=?, request_file=?, updated=? WHERE id=?",
+                             [(STATUS_EXPORTED, first_prompt, request_file, now, image_id)
+                              for image_id, first_prompt in exported])
+            conn.commit()
+        await self._call(_mark, time.time())
+
+    async def requeue_exported(self) -> int:
+        """Put exported images whose results never came back up for export again."""
+        def _requeue(conn, now):
+            cursor = conn.execute("UPDATE images SET status=?, updated=? WHERE status=?",
+                                  (STATUS_PENDING, now, STATUS_EXPORTED))
+            conn.commit()
+            return cursor.rowcount
+        return await self._call(_requeue, time.time())
+
+    async def record_results(self, updates: Sequence[Tuple[BatchImage, Optional[str]]]) -> None:
+        """Store imported results: per (image, error), the image's new stage, status,
+        responses and token counts, and the error of its failed request, if any."""
+        def _record(conn, now):
+            conn.executemany(
+                "UPDATE images SET status=?, stage=?, responses=?, prompt_tokens=?, completion_tokens=?, "
+                "error=?, updated=? WHERE id=?",
+                [(image.status, image.stage, json.dumps(image.responses), image.prompt_tokens,
+                  image.completion_tokens, error, now, image.id) for image, error in updates])
+            conn.commit()
+        await self._call(_record, time.time())
+
+    async def counts(self) -> Dict[Tuple[str, int], int]:
+        """Number of images per (status, stage)."""
+        def _counts(conn):
+            rows = conn.execute("SELECT status, stage, COUNT(*) FROM images GROUP BY status, stage")
+            return {(status, stage): count for status, stage, count in rows}
+        return await self._call(_counts)
+
+    async def failures(self, limit: int = 10) -> List[Tuple[str, int, str]]:
+        """The most recent (image_path, stage, error) of images waiting to be retried."""
+        def _failures(conn):
+            return conn.execute("SELECT image_path, stage, error FROM images WHERE status=? AND error IS NOT NULL "
+                                "ORDER BY updated DESC LIMIT ?", (STATUS_PENDING, limit)).fetchall()
+        return await self._call(_failures)
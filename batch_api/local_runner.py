@@ -0,0 +1,99 @@
+"""
+Local stand-in for a Batch API provider: runs the requests of a batch input file
+against an OpenAI compatible server (LM Studio, vLLM, the benchmark mock server,
+...) and writes a batch output file, so the export/import round trip works
+without a cloud batch service.
+
+    python -m batch_api.local_runner requests-0000-000.jsonl results.jsonl --config caption.yaml
+"""
+
+import sys
+import json
+import asyncio
+import argparse
+from typing import Dict, Tuple
+
+import openai
+from omegaconf import OmegaConf
+
+from scheduling.endpoints import endpoint_configs
+from scheduling.pipeline import Pipeline, Stage
+
+DEFAULT_CONCURRENCY = 8
+
+
+async def _run_request(client: openai.AsyncOpenAI, number: int, request: Dict) -> Dict:
+    record = {"id": f"batch_req_{number}", "custom_id": request.get("custom_id"), "response": None, "error": None}
+    try:
+        completion = await client.chat.completions.create(**request["body"])
+        record["response"] = {"status_code": 200, "request_id": completion.id, "body": completion.model_dump()}
+    except openai.APIStatusError as e:
+        error = e.body if isinstance(e.body, dict) else {"message": str(e)}
+        record["response"] = {"status_code": e.status_code, "request_id": "", "body": {"error": error}}
+    except Exception as e:
+        record["error"] = {"code": type(e).__name__, "message": str(e)}
+    return record
+
+
+async def run_request_file(client: openai.AsyncOpenAI, input_path: str, output_path: str,
+                           concurrency: int = DEFAULT_CONCURRENCY) -> Tuple[int, int]:
+    """Send every request of input_path, concurrency at a time, and write one output
+    line per request (in completion order, as a provider may). Returns the number
+    of succeeded and failed requests."""
+    counts = [0, 0]
+
+    async def requests():
+        with open(input_path, "r", encoding="utf-8") as f:
+            for number, line in enumerate(f):
+                if line.strip():
+                    yield number, json.loads(line)
+
+    async def send(item):
+        return await _run_request(client, *item)
+
+    with open(output_path, "w", encoding="utf-8") as out:
+        async def write(record):
+            out.write(json.dumps(record) + "\n")
+            counts[0 if (record["response"] or {}).get("status_code") == 200 else 1] += 1
+
+        await Pipeline([
+            Stage("request", send, workers=concurrency, queue_size=concurrency),
+            Stage("write", write, queue_size=concurrency),
+        ]).run(requests())
+    return counts[0], counts[1]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Run a Batch API request file against an OpenAI compatible server.")
+    parser.add_argument("input", help="Batch input file (from caption_openai.py --batch-export)")
+    parser.add_argument("output", help="Batch output file to write (for caption_openai.py --batch-import)")
+    parser.add_argument("--config", default="caption.yaml", help="Config file to take base_url and api_key from")
+    parser.add_argument("--base-url", help="Server to send the requests to, instead of the config's (first) base_url")
+    parser.add_argument("--api-key", help="API key, instead of the config's api_key")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Requests in flight at once")
+    args = parser.parse_args(argv)
+
+    base_url, api_key = args.base_url, args.api_key
+    if base_url is None or api_key is None:
+        from caption_openai import resolve_api_key
+        conf = OmegaConf.load(args.config)
+        endpoint = endpoint_configs(conf)[0]
+        if endpoint["api_key"] is not None:
+            conf.api_key = endpoint["api_key"]
+        base_url = base_url or endpoint["url"]
+        api_key = api_key if api_key is not None else resolve_api_key(conf)
+
+    async def run():
+        client = openai.AsyncOpenAI(base_url=base_url, api_key=api_key or "none")
+        try:
+            return await run_request_file(client, args.input, args.output, args.concurrency)
+        finally:
+            await client.close()
+
+    succeeded, failed = asyncio.run(run())
+    print(f"{succeeded} requests succeeded, {failed} failed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
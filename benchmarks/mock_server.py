@@ -0,0 +1,234 @@
+"""
+Stand-in OpenAI compatible chat completions server for benchmarks and tests.
+
+Serves POST /v1/chat/completions (streamed or not) and GET /v1/models using
+only asyncio. Responses are synthetic: a fixed number of tokens after a
+configurable time to first token, at a configurable token rate, optionally
+slowed down as more streams run at once, with injected 429/500 errors.
+
+    python -m benchmarks.mock_server --port 8089 --ttft 0.2 --tokens-per-s 40
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+
+@dataclass
+class MockServerConfig:
+    ttft: float = 0.2                 # seconds before the first token
+    tokens_per_s: float = 50.0        # decode speed of a single stream
+    completion_tokens: int = 64       # tokens per response
+    contention: float = 0.0           # each extra concurrent stream slows decode by this fraction
+    error_rate: float = 0.0           # fraction of requests answered with an error
+    rate_limit_share: float = 0.5     # fraction of injected errors that are 429 rather than 500
+    retry_after: float = 0.5          # Retry-After seconds sent with 429s
+    usage: bool = True                # send a usage chunk at the end of streams
+    seed: Optional[int] = None
+
+
+class MockServer:
+    """Run with `async with MockServer(config) as server:`; server.base_url is then
+    the /v1 URL to point a client at."""
+
+    def __init__(self, config: Optional[MockServerConfig] = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or MockServerConfig()
+        self.host = host
+        self.port = port
+        self.active = 0
+        self.peak_active = 0
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(self.config.seed)
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def start(self) -> "MockServer":
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self) -> "MockServer":
+        return await self.start()
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                method, path, body = request
+                await self._dispatch(writer, method, path, body)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, writer: asyncio.StreamWriter, method: str, path: str, body: bytes) -> None:
+        if method == "GET" and path.rstrip("/").endswith("/models"):
+            await _send_json(writer, 200, {"object": "list", "data": [{"id": "mock", "object": "model", "owned_by": "mock"}]})
+        elif method == "POST" and path.rstrip("/").endswith("/chat/completions"):
+            await self._chat_completion(writer, json.loads(body or b"{}"))
+        else:
+            await _send_json(writer, 404, {"error": {"message": f"no route {method} {path}", "type": "not_found"}})
+
+    async def _chat_completion(self, writer: asyncio.StreamWriter, payload: dict) -> None:
+        config = self.config
+        self.requests += 1
+        if config.error_rate and self._random.random() < config.error_rate:
+            self.errors += 1
+            if self._random.random() < config.rate_limit_share:
+                await _send_json(writer, 429, {"error": {"message": "rate limited", "type": "rate_limit_error"}},
+                                 {"Retry-After": f"{config.retry_after:g}"})
+            else:
+                await _send_json(writer, 500, {"error": {"message": "injected failure", "type": "server_error"}})
+            return
+
+        model = payload.get("model", "mock")
+        prompt_tokens = max(1, len(json.dumps(payload.get("messages", []))) // 4)
+        tokens = config.completion_tokens
+        if payload.get("max_tokens"):
+            tokens = min(tokens, int(payload["max_tokens"]))
+
+        self.active += 1
+        self.peak_active = max(self.peak_active, self.active)
+        try:
+            await asyncio.sleep(config.ttft)
+            if not payload.get("stream"):
+                await asyncio.sleep(max(0, tokens - 1) * self._token_interval())
+                await _send_json(writer, 200, {
+                    "id": "chatcmpl-mock", "object": "chat.completion", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": _text(tokens)}, "finish_reason": "stop"}],
+                    "usage": _usage(prompt_tokens, tokens),
+                })
+                return
+
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                         b"Cache-Control: no-cache\r\nTransfer-Encoding: chunked\r\n\r\n")
+            for i in range(tokens):
+                if i:
+                    await asyncio.sleep(self._token_interval())
+                delta = {"role": "assistant", "content": "tok "} if i == 0 else {"content": "tok "}
+                await _send_event(writer, {
+                    "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": None}],
+                })
+            if config.usage:
+                await _send_event(writer, {
+                    "id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                    "choices": [], "usage": _usage(prompt_tokens, tokens),
+                })
+            await _send_chunk(writer, b"data: [DONE]\n\n")
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            self.active -= 1
+
+    def _token_interval(self) -> float:
+        slowdown = 1.0 + self.config.contention * max(0, self.active - 1)
+        return slowdown / self.config.tokens_per_s
+
+
+def _text(tokens: int) -> str:
+    return "tok " * tokens
+
+
+def _usage(prompt_tokens: int, completion_tokens: int) -> dict:
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens}
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, bytes]]:
+    """Read one HTTP/1.1 request, or None when the client closed the connection."""
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except asyncio.IncompleteReadError:
+        return None
+    lines = head.decode("latin-1").split("\r\n")
+    method, path, _ = lines[0].split(" ", 2)
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            key, value = line.split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    body = await reader.readexactly(length) if length else b""
+    return method, path, body
+
+
+async def _send_json(writer: asyncio.StreamWriter, status: int, body: dict, headers: Optional[dict] = None) -> None:
+    data = json.dumps(body).encode()
+    reason = {200: "OK", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error"}.get(status, "")
+    head = f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+    for key, value in (headers or {}).items():
+        head += f"{key}: {value}\r\n"
+    writer.write(head.encode() + b"\r\n" + data)
+    await writer.drain()
+
+
+async def _send_chunk(writer: asyncio.StreamWriter, data: bytes) -> None:
+    writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+    await writer.drain()
+
+
+async def _send_event(writer: asyncio.StreamWriter, event: dict) -> None:
+    await _send_chunk(writer, f"data: {json.dumps(event)}\n\n".encode())
+
+
+def add_server_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = MockServerConfig()
+    parser.add_argument("--ttft", type=float, default=defaults.ttft, help="seconds before the first token")
+    parser.add_argument("--tokens-per-s", type=float, default=defaults.tokens_per_s, help="decode speed of one stream")
+    parser.add_argument("--completion-tokens", type=int, default=defaults.completion_tokens, help="tokens per response")
+    parser.add_argument("--contention", type=float, default=defaults.contention,
+                        help="decode slowdown per extra concurrent stream (0.1 = 10%%)")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="fraction of requests that fail")
+    parser.add_argument("--retry-after", type=float, default=defaults.retry_after, help="Retry-After seconds sent with 429s")
+    parser.add_argument("--no-usage", action="store_true", help="do not send usage chunks")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def server_config_from_args(args: argparse.Namespace) -> MockServerConfig:
+    return MockServerConfig(
+        ttft=args.ttft,
+        tokens_per_s=args.tokens_per_s,
+        completion_tokens=args.completion_tokens,
+        contention=args.contention,
+        error_rate=args.error_rate,
+        retry_after=args.retry_after,
+        usage=not args.no_usage,
+        seed=args.seed,
+    )
+
+
+async def _serve(config: MockServerConfig, host: str, port: int) -> None:
+    async with MockServer(config, host, port) as server:
+        print(f"Mock server listening on {server.base_url}")
+        await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stand-in OpenAI compatible chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve(server_config_from_args(args), args.host, args.port))
+    except KeyboardInterrupt:
+        pass
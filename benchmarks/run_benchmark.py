@@ -0,0 +1,231 @@
+"""
+Offline benchmark: caption a synthetic image tree against the mock server.
+
+For each concurrency level, caption_openai.main runs in a fresh child process
+(so peak RSS is per level) against benchmarks.mock_server, and the run's
+metrics_file records are summarized:
+
+    python -m benchmarks.run_benchmark --images 200 --levels 1,4,16 --ttft 0.3 --tokens-per-s 40
+
+Anything else in caption.yaml can be set with --set, e.g.
+--set image_preprocess.enabled=true --set output_format=jsonl
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import shutil
+from typing import Dict, List, Optional
+
+from omegaconf import OmegaConf
+from PIL import Image
+
+from benchmarks.mock_server import MockServer, add_server_arguments, server_config_from_args
+from metrics.timing import quantile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_image_tree(root: str, count: int, per_dir: int = 50, size: int = 512) -> None:
+    """count noise JPEGs of size x size, per_dir to a folder. Noise compresses
+    poorly, so file sizes are closer to photos than flat test images."""
+    for i in range(count):
+        folder = os.path.join(root, f"dir{i // per_dir:04d}")
+        os.makedirs(folder, exist_ok=True)
+        image = Image.effect_noise((size, size), 64).convert("RGB")
+        image.save(os.path.join(folder, f"img{i:06d}.jpg"), quality=90)
+
+
+def write_config(path: str, base_url: str, image_dir: str, concurrency: int, prompts: int,
+                 metrics_file: str, overrides: List[str]) -> None:
+    conf = OmegaConf.create({
+        "base_url": base_url,
+        "api_key": "mock",
+        "model": "mock",
+        "max_tokens": 4096,
+        "concurrent_batch_size": concurrency,
+        "system_prompt": "You are a benchmark.",
+        "prompts": [f"Benchmark question {i + 1}." for i in range(prompts)],
+        "hint_sources": [],
+        "base_directory": image_dir,
+        "recursive": True,
+        "skip_if_caption_exists": False,
+        "output_format": "txt",
+        "metrics_file": metrics_file,
+        "metrics_interval": 0,
+    })
+    conf = OmegaConf.merge(conf, OmegaConf.from_dotlist(overrides))
+    OmegaConf.save(conf, path)
+
+
+def _summarize(records: List[dict], wall: float) -> Dict:
+    ok = [r for r in records if r["success"]]
+    turns = [t for r in ok for t in r.get("turns", [])]
+    latency = sorted(t["latency"] for t in turns)
+    ttft = sorted(t["ttft"] for t in turns)
+    tokens_per_s = sorted(t["tokens_per_s"] for t in turns if t["tokens_per_s"])
+    summary = {
+        "images": len(ok),
+        "failed": len(records) - len(ok),
+        "wall_s": round(wall, 3),
+        "images_per_s": round(len(ok) / wall, 3) if wall > 0 else 0.0,
+        "turns": len(turns),
+    }
+    if latency:
+        summary.update({
+            "turn_latency_p50": round(quantile(latency, 0.5), 4),
+            "turn_latency_p95": round(quantile(latency, 0.95), 4),
+            "turn_latency_p99": round(quantile(latency, 0.99), 4),
+            "ttft_p50": round(quantile(ttft, 0.5), 4),
+        })
+    if tokens_per_s:
+        summary["tokens_per_s_p50"] = round(quantile(tokens_per_s, 0.5), 2)
+    return summary
+
+
+async def run_level(python: str, workdir: str, base_url: str, image_dir: str, concurrency: int,
+                    prompts: int, overrides: List[str], verbose: bool) -> Dict:
+    level_dir = os.path.join(workdir, f"level{concurrency}")
+    os.makedirs(level_dir, exist_ok=True)
+    config_path = os.path.join(level_dir, "caption.yaml")
+    metrics_file = os.path.join(level_dir, "timing.jsonl")
+    result_path = os.path.join(level_dir, "child.json")
+    write_config(config_path, base_url, image_dir, concurrency, prompts, metrics_file, overrides)
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])))
+    output = None if verbose else asyncio.subprocess.DEVNULL
+    # The child runs in level_dir so anything it writes to the working directory stays out of the way.
+    process = await asyncio.create_subprocess_exec(
+        python, "-m", "benchmarks.run_benchmark", "--child", config_path, result_path,
+        cwd=level_dir, env=env, stdout=output, stderr=output)
+    if await process.wait() != 0:
+        raise RuntimeError(f"benchmark run at concurrency {concurrency} failed, rerun with --verbose for details")
+
+    with open(result_path) as f:
+        child = json.load(f)
+    with open(metrics_file) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return {"concurrency": concurrency, **_summarize(records, child["wall_s"]), **child}
+
+
+async def _run(args: argparse.Namespace) -> List[Dict]:
+    workdir = args.workdir or tempfile.mkdtemp(prefix="vlm_caption_bench_")
+    image_dir = os.path.join(workdir, "images")
+    try:
+        if not os.path.isdir(image_dir):
+            print(f" -> Generating {args.images} images in {image_dir}")
+            make_image_tree(image_dir, args.images, args.per_dir, args.image_size)
+
+        results = []
+        async with MockServer(server_config_from_args(args)) as server:
+            for level in args.levels:
+                server.peak_active = 0
+                requests, errors = server.requests, server.errors
+                print(f" -> Concurrency {level}...")
+                result = await run_level(sys.executable, workdir, server.base_url, image_dir, level,
+                                         args.prompts, args.set, args.verbose)
+                result["server_requests"] = server.requests - requests
+                result["server_errors"] = server.errors - errors
+                result["server_peak_streams"] = server.peak_active
+                results.append(result)
+        return results
+    finally:
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _print_table(results: List[Dict]) -> None:
+    columns = [
+        ("concurrency", "conc", "{}"),
+        ("images", "images", "{}"),
+        ("images_per_s", "img/s", "{:.2f}"),
+        ("turn_latency_p50", "turn p50", "{:.3f}s"),
+        ("turn_latency_p95", "turn p95", "{:.3f}s"),
+        ("ttft_p50", "ttft p50", "{:.3f}s"),
+        ("peak_rss_mb", "peak RSS", "{:.0f}MB"),
+        ("loop_lag_p99_ms", "lag p99", "{:.1f}ms"),
+        ("loop_lag_max_ms", "lag max", "{:.1f}ms"),
+        ("server_errors", "errors", "{}"),
+    ]
+    rows = [[title for _, title, _ in columns]]
+    for result in results:
+        rows.append([fmt.format(result[key]) if result.get(key) is not None else "-" for key, _, fmt in columns])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    for row in rows:
+        print("  ".join(cell.rjust(width) for cell, width in zip(row, widths)))
+
+
+def _peak_rss_mb() -> Optional[float]:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+async def _child(config_path: str, result_path: str) -> None:
+    """One benchmark run: caption_openai.main plus an event loop lag probe."""
+    from caption_openai import main as caption_main
+
+    interval = 0.01
+    lags: List[float] = []
+
+    async def probe() -> None:
+        while True:
+            before = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append(max(0.0, time.perf_counter() - before - interval))
+
+    probe_task = asyncio.create_task(probe())
+    started = time.perf_counter()
+    try:
+        await caption_main(config_path)
+    finally:
+        wall = time.perf_counter() - started
+        probe_task.cancel()
+    lags.sort()
+    with open(result_path, "w") as f:
+        json.dump({
+            "wall_s": wall,
+            "peak_rss_mb": _peak_rss_mb(),
+            "loop_lag_p99_ms": round(1000 * quantile(lags, 0.99), 2) if lags else None,
+            "loop_lag_max_ms": round(1000 * lags[-1], 2) if lags else None,
+        }, f)
+
+
+def main() -> None:
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        asyncio.run(_child(sys.argv[2], sys.argv[3]))
+        return
+
+    parser = argparse.ArgumentParser(description="Benchmark caption_openai against a local mock server")
+    parser.add_argument("--images", type=int, default=100, help="number of synthetic images")
+    parser.add_argument("--per-dir", type=int, default=50, help="images per folder")
+    parser.add_argument("--image-size", type=int, default=512, help="image width and height in pixels")
+    parser.add_argument("--levels", type=lambda s: [int(x) for x in s.split(",")], default=[1, 4, 16],
+                        help="comma separated concurrent_batch_size values")
+    parser.add_argument("--prompts", type=int, default=4, help="turns per image")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra caption.yaml setting, may be repeated")
+    parser.add_argument("--workdir", default=None, help="reuse this directory (images are generated once)")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary work directory")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the captioning output")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    results = asyncio.run(_run(args))
+    print()
+    _print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
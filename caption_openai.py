@@ -1,4 +1,3 @@
-import base64
 from PIL import Image
 import asyncio
 import openai
@@ -7,12 +6,42 @@ import aiofiles
 import time
 from omegaconf import OmegaConf
 import os
-from file_utils.file_access import image_walk, save_caption, concat_prompts, OUTPUT_FORMAT_TXT, OUTPUT_FORMAT_JSONL
+from file_utils.file_access import image_walk, save_caption, WALK_WORKERS, IMAGE_EXTENSIONS, OUTPUT_FORMAT_TXT
+from file_utils.image_preprocess import encode_image, create_preprocess_executor, preprocess_enabled, preprocess_settings
+from file_utils.caption_cache import CaptionCache, open_caption_cache, hash_image_bytes_async
+from file_utils.caption_index import CaptionIndex, open_caption_index
+from file_utils.walk_snapshot import WalkSnapshot, open_walk_snapshot
+from file_utils.debug_transcripts import DebugTranscriptStore, open_debug_transcripts
+from file_utils.shard_output import ShardOutput, open_shard_output
+from file_utils.caption_writer import CaptionWriter, create_caption_writer
+from file_utils.run_ledger import RunLedger, open_run_ledger, ledger_job_key, STATE_DONE, STATE_QUEUED, STATE_FAILED
+from file_utils.work_queue import WorkQueue, open_work_queue, queue_job_key, format_queue_counts, DEFAULT_CLAIM_SIZE
 from response_filters import filter_thinking, filter_caption, filter_ascii, remove_base64_image
-from hints.hint_sources import get_hints
+from hints.hint_sources import get_hints_async
+from hints.registration import HintCache
 import logging
-from typing import Tuple, Dict, List
+from typing import Callable, NamedTuple, Tuple, Dict, List, Optional, Sequence
+from dataclasses import dataclass, field
+from concurrent.futures import Executor
+import multiprocessing
+import argparse
 from rules.summary_retry import run_summary_retry_rules
+from scheduling.endpoints import Endpoint, EndpointPool, create_endpoint_pool
+from scheduling.pipeline import Pipeline, Stage
+from scheduling.memory_budget import MB, ByteBudget, create_memory_budget, estimate_payload_bytes, encoded_payload_bytes
+from scheduling.turns import TurnObserver, stream_chat_turn
+from scheduling.prompt_graph import PromptNode, prompt_nodes, prompt_identity, run_prompt_graph
+from scheduling.adaptive import AdaptiveConcurrency, create_adaptive_concurrency
+from scheduling.rate_limit import RateLimiter, create_rate_limiter
+from scheduling.sharding import Shard, create_shard
+from scheduling.http_client import ConnectionStats, create_http_client, client_options
+from scheduling.shared_budget import SharedConcurrencyBudget
+from metrics.timing import ImageTimer, RunMetrics, create_run_metrics
+from metrics.events import EventSink, ProgressEvents
+
+# Workers reading, hinting and encoding images ahead of the caption stage, and saving captions after it
+PREFETCH_WORKERS = 4
+WRITE_WORKERS = 4
 
 def resolve_api_key(config):
     api_key_value = config.api_key.strip()
@@ -30,173 +59,373 @@ def resolve_api_key(config):
 
     return api_key_value
 
-async def write_debug_messages(messages: List, i: int):
-    async with aiofiles.open(f"messages_{i}.txt", "w") as f:
-        await f.write(json.dumps(messages,indent=2))
+async def read_image_bytes(image_path: str) -> bytes:
+    async with aiofiles.open(image_path, "rb") as image_file:
+        return await image_file.read()
+
+class PrefetchedImage(NamedTuple):
+    file_contents: Optional[bytes]
+    hints: Optional[str]
+    # Set once the image has been encoded ahead of time, after which file_contents is dropped.
+    mime_type: Optional[str] = None
+    b64_image: Optional[str] = None
+
+async def prefetch_image(image_path: str, conf, timer: ImageTimer, hint_cache: Optional[HintCache] = None) -> PrefetchedImage:
+    """Read the image bytes and gather its hints concurrently. The prefetch stage runs
+    this ahead of the image getting an endpoint slot, so file and hint I/O overlap with
+    other images' requests instead of delaying this image's first turn."""
+    async def read() -> bytes:
+        with timer.stage("read"):
+            return await read_image_bytes(image_path)
+
+    async def hints() -> Optional[str]:
+        with timer.stage("hints"):
+            return await get_hints_async(conf.get("hint_sources", []), image_path, hint_cache=hint_cache)
+
+    file_contents, hint_text = await asyncio.gather(read(), hints())
+    return PrefetchedImage(file_contents, hint_text)
+
+async def encode_prefetched(prefetched: PrefetchedImage, image_path: str, conf, executor: Optional[Executor], timer: ImageTimer) -> PrefetchedImage:
+    """Convert the image to a base64 string, downscaled/re-encoded if image_preprocess
+    is enabled. The raw bytes are not kept."""
+    with timer.stage("encode"):
+        mime_type, b64_image = await encode_image(prefetched.file_contents, image_path, conf.get("image_preprocess"), executor)
+    return PrefetchedImage(None, prefetched.hints, mime_type, b64_image)
+
+def first_prompt_text(nodes: Sequence[PromptNode], hints: Optional[str]) -> str:
+    """The first turn's prompt, with the image's hints ahead of it."""
+    if hints:
+        return f"{hints}\n\n{nodes[0].prompt}"
+    return nodes[0].prompt
 
-async def process_image(client: openai.AsyncOpenAI, image_path, conf) -> Tuple[str,str,int,int]:
+async def process_image(client: openai.AsyncOpenAI, image_path, conf, executor: Optional[Executor] = None, prefetched: Optional[PrefetchedImage] = None, observers: Sequence[TurnObserver] = (), timer: Optional[ImageTimer] = None, debug_transcripts: Optional[DebugTranscriptStore] = None) -> Tuple[str,str,int,int]:
     """Process a single image and generate caption using an OpenAI compatible API. 
+    Turns run in the order of prompts, or as a prompt_graph where turns that do not
+    depend on each other run concurrently.
+    The image bytes and hints are read here unless already prefetched.
+    Stage and turn timings are recorded on timer, if given.
+    With debug_transcripts, the image's conversation (or as much of it as ran
+    before an error) is recorded there.
     returns a tuple of: [final response, chat history jsondumps, prompt_tokens_usage, completion_tokens_usage]"""
-    # Convert image to base64 string
-    async with aiofiles.open(image_path, "rb") as image_file:
-        file_contents = await image_file.read()
-        b64_image = base64.b64encode(file_contents).decode("utf-8")
-
-    messages = []
-    prompts = conf.prompts
-    completion_tokens_usage = 0
-    prompt_tokens_usage = 0
+    if timer is None:
+        timer = ImageTimer()
+    observers = (*observers, timer)
+    if prefetched is None:
+        prefetched = await prefetch_image(image_path, conf, timer)
+    hints = prefetched.hints
+    if prefetched.b64_image is None:
+        prefetched = await encode_prefetched(prefetched, image_path, conf, executor, timer)
+    mime_type, b64_image = prefetched.mime_type, prefetched.b64_image
+    del prefetched
+
+    prefix = []
+    nodes = prompt_nodes(conf)
+    turns = []
 
     if conf.get("system_prompt"):
-        messages.append({"role": "system", "content": conf.system_prompt})
+        prefix.append({"role": "system", "content": conf.system_prompt})
     
-    hints = get_hints(conf.get("hint_sources", []), image_path)
+    first_message = [{"type": "text", "text": first_prompt_text(nodes, hints)},
+                     {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{b64_image}"}}]
 
-    first_prompt_text = prompts[0]
-    if hints:
-        first_prompt_text = f"{hints}\n\n{prompts[0]}"
-        
-    first_message = [{"type": "text", "text": first_prompt_text},
-                     {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64_image}"}}]
-    messages.append({"role": "user", "content": first_message})
-
-    stream = await client.chat.completions.create(
-        model=conf.model,
-        messages=messages,
-        stream=True,
-        max_tokens=conf.max_tokens,
-    )
+    async def run_turn(i: int, messages: List) -> Tuple[str, int, int]:
+        if i == 0:
+            create_kwargs = {"max_tokens": conf.max_tokens}
+        else:
+            create_kwargs = {"stream_options": {"include_usage": True}}
+        response_text, prompt_tokens, completion_tokens = await stream_chat_turn(
+            client,
+            messages,
+            observers,
+            model=conf.model,
+            **create_kwargs,
+        )
+        response_text = filter_thinking(response_text)
+        if debug_transcripts is not None:
+            turns.append({"turn": nodes[i].name, "response": response_text,
+                          "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens})
+        return response_text, prompt_tokens, completion_tokens
 
-    response_text = ""
-    async for event in stream:
-        if event.choices and event.choices[0].delta.content is not None:
-            chunk = event.choices[0].delta.content
-            #print(chunk, end="")
-            response_text += chunk  # Accumulate the response text
-        if event.usage:
-            completion_tokens_usage += event.usage.completion_tokens
-            prompt_tokens_usage += event.usage.prompt_tokens
-
-    response_text = filter_thinking(response_text)
-    messages.append({"role": "assistant", "content": [{"type": "text", "text": response_text}]})
-    i=0
-    save_debug_task = asyncio.create_task(write_debug_messages(messages, i))
-
-    if len(prompts) > 1:
-        for prompt in prompts[1:]:
-            response_text = ""
-            #print(f"\n ----> REQUESTING: {prompt}")
-            messages.append({"role": "user", "content": [{"type": "text", "text": prompt}]})
-
-            stream = await client.chat.completions.create(
-                    model=conf.model,
-                    messages=messages,
-                    stream=True,
-                    stream_options={"include_usage": True}
-                    )
-            await save_debug_task
-
-            async for event in stream:
-                if event.choices and event.choices[0].delta.content is not None:
-                    chunk = event.choices[0].delta.content
-                    response_text += chunk
-                if event.usage:
-                    completion_tokens_usage += event.usage.completion_tokens
-                    prompt_tokens_usage += event.usage.prompt_tokens
-            response_text = filter_thinking(response_text)
-            messages.append({"role": "assistant", "content": [{"type": "text", "text": response_text}]})
-            save_debug_task = asyncio.create_task(write_debug_messages(messages, i))
-            i += 1
-            final_summary_response = response_text
-            if i == len(prompts)-1:
+    try:
+        with timer.stage("turns"):
+            messages, prompt_tokens_usage, completion_tokens_usage = await run_prompt_graph(nodes, prefix, first_message, run_turn)
+        final_summary_response = messages[-1]["content"][0]["text"]
+
+        if len(nodes) > 1:
+            with timer.stage("retry_rules"):
                 final_summary_response, completion_tokens_usage, prompt_tokens_usage = await \
                     run_summary_retry_rules(client, 
                                             conf, 
                                             messages, 
-                                            summary_response=response_text,
+                                            summary_response=final_summary_response,
                                             completion_tokens_usage=completion_tokens_usage,
-                                            prompt_tokens_usage=completion_tokens_usage)
-    else:
-        final_summary_response = response_text
+                                            prompt_tokens_usage=prompt_tokens_usage,
+                                            observers=observers)
+    except Exception as e:
+        if debug_transcripts is not None:
+            debug_transcripts.add(image_path, {"image_path": image_path, "model": conf.model, "turns": turns,
+                                               "messages": remove_base64_image(prefix + [{"role": "user", "content": first_message}]),
+                                               "error": str(e)})
+        raise
 
-    await save_debug_task
     final_summary_response = final_summary_response.strip()
     messages = remove_base64_image(messages)
+    if debug_transcripts is not None:
+        debug_transcripts.add(image_path, {"image_path": image_path, "model": conf.model, "turns": turns, "messages": messages})
     return final_summary_response, json.dumps(messages, indent=2), prompt_tokens_usage, completion_tokens_usage
 
-async def process_image_semaphore(client: openai.AsyncOpenAI, image_path: str, conf, semaphore: asyncio.Semaphore, results_queue: asyncio.Queue):
-    """Process a single image and put results in queue. The caller must have acquired
-    the semaphore before scheduling this task; we release it here on completion so that
-    the producer loop applies backpressure and the in-flight task set stays bounded."""
+@dataclass
+class ImageJob:
+    """One image on its way through the pipeline in _run_jobs."""
+    image_path: str
+    timer: ImageTimer = field(default_factory=ImageTimer)
+    start_time: float = field(default_factory=time.perf_counter)
+    prefetched: Optional[PrefetchedImage] = None
+    image_hash: Optional[str] = None
+    cache_identity: str = ""
+    model: str = ""
+    caption_text: Optional[str] = None
+    chat_history: str = ""
+    prompt_token_usage: int = 0
+    completion_token_usage: int = 0
+    cached: bool = False
+    endpoint: Optional[Endpoint] = None
+    error: Optional[Exception] = None
+    payload_bytes: int = 0  # held in the memory budget, if any
+
+    @property
+    def ready(self) -> bool:
+        """Captioned, answered from the caption cache, or failed: nothing left for the API to do."""
+        return self.caption_text is not None or self.error is not None
+
+def cache_identity(conf, hints: Optional[str]) -> str:
+    """What a cached caption must have been made with, besides the image and the
+    model: the system prompt (with any global metadata), the prompts, the image's
+    hints, the image_preprocess settings that shape the payload sent and the
+    generation settings of the request (max_tokens)."""
+    preprocess = conf.get("image_preprocess")
+    payload = f"preprocess {preprocess_settings(preprocess)}" if preprocess_enabled(preprocess) else "original image"
+    return "\n\n".join([conf.get("system_prompt", ""), prompt_identity(conf), hints or "",
+                         payload, f"max_tokens {conf.get('max_tokens')}"])
+
+async def prepare_image(job: ImageJob, conf, executor: Optional[Executor] = None, caption_cache: Optional[CaptionCache] = None, cache_models: Sequence[str] = (), budget: Optional[ByteBudget] = None, hint_cache: Optional[HintCache] = None) -> ImageJob:
+    """Prefetch stage: read the image and its hints, then either answer it from the
+    caption cache or encode it, so it can be sent the moment an endpoint slot frees up.
+    With a caption cache, an image whose bytes were already captioned with the same
+    system prompt, prompts and hints and one of cache_models (default: the configured model) is not sent at all.
+    With a memory budget, the image waits for room in it before being read; the
+    bytes it holds are recorded in job.payload_bytes for the caller to release."""
+    job.start_time = time.perf_counter()
     try:
-        start_time = time.perf_counter()
-        caption_text, chat_history, prompt_token_usage, completion_token_usage = await process_image(client, image_path, conf)
-        caption_text = filter_caption(caption_text)
-
-        output_format = conf.get("output_format", OUTPUT_FORMAT_TXT)
-        await save_caption(
-            file_path=image_path,
-            caption_text=caption_text,
-            debug_info=chat_history,
-            output_format=output_format,
-            model=conf.get("model", ""),
-            concat_prompt=concat_prompts(list(conf.get("prompts", []))),
-        )
-
-        processing_time = time.perf_counter() - start_time
-
-        await results_queue.put({
-            'image_path': image_path,
-            'caption_text': caption_text,
-            'prompt_token_usage': prompt_token_usage,
-            'completion_token_usage': completion_token_usage,
-            'processing_time': processing_time,
-            'success': True
-        })
-
+        if budget is not None:
+            with job.timer.stage("memory_wait"):
+                file_size = await asyncio.to_thread(os.path.getsize, job.image_path)
+                job.payload_bytes = await budget.acquire(estimate_payload_bytes(file_size))
+        job.prefetched = await prefetch_image(job.image_path, conf, job.timer, hint_cache)
+        if caption_cache is not None:
+            job.cache_identity = cache_identity(conf, job.prefetched.hints)
+            with job.timer.stage("hash"):
+                job.image_hash = await hash_image_bytes_async(job.prefetched.file_contents)
+            with job.timer.stage("cache"):
+                for model in cache_models or (conf.get("model", ""),):
+                    cached_caption = await caption_cache.get(job.image_hash, model, job.cache_identity)
+                    if cached_caption is not None:
+                        job.caption_text, job.model, job.cached = cached_caption, model, True
+                        job.prefetched = None
+                        return job
+        job.prefetched = await encode_prefetched(job.prefetched, job.image_path, conf, executor, job.timer)
+        if budget is not None:
+            job.payload_bytes = budget.resize(job.payload_bytes, encoded_payload_bytes(len(job.prefetched.b64_image)))
     except Exception as e:
-        await results_queue.put({
-            'image_path': image_path,
-            'error': str(e),
+        job.prefetched = None
+        job.error = e
+    return job
+
+async def caption_image(job: ImageJob, endpoint: Endpoint, executor: Optional[Executor] = None, observers: Sequence[TurnObserver] = (), debug_transcripts: Optional[DebugTranscriptStore] = None) -> ImageJob:
+    """Caption stage: run the image's conversation on endpoint. The caller holds one of
+    the endpoint's slots for the duration."""
+    job.endpoint = endpoint
+    job.model = endpoint.conf.get("model", "")
+    job.start_time = time.perf_counter()
+    prefetched, job.prefetched = job.prefetched, None
+    try:
+        caption_text, job.chat_history, job.prompt_token_usage, job.completion_token_usage = await process_image(endpoint.client, job.image_path, endpoint.conf, executor, prefetched, observers, job.timer, debug_transcripts)
+        job.caption_text = filter_caption(caption_text)
+    except Exception as e:
+        job.error = e
+    return job
+
+async def write_image(job: ImageJob, conf, caption_cache: Optional[CaptionCache] = None, caption_index: Optional[CaptionIndex] = None, shard_output: Optional[ShardOutput] = None, caption_writer: Optional[CaptionWriter] = None) -> Dict:
+    """Writer stage: save the caption, add it to the caption cache, and return the
+    image's result record, which carries its per-stage timing record.
+    With a caption_writer the caption is handed to it, and this returns once the
+    writer has committed it to disk."""
+    if job.error is None:
+        concat_prompt = prompt_identity(conf)
+        output_format = conf.get("output_format", OUTPUT_FORMAT_TXT)
+        try:
+            with job.timer.stage("save"):
+                if caption_writer is not None:
+                    await (await caption_writer.put(job.image_path, job.caption_text, output_format, job.model, concat_prompt))
+                else:
+                    await save_caption(
+                        file_path=job.image_path,
+                        caption_text=job.caption_text,
+                        debug_info=job.chat_history,
+                        output_format=output_format,
+                        model=job.model,
+                        concat_prompt=concat_prompt,
+                        caption_index=caption_index,
+                        shard_output=shard_output,
+                    )
+            if caption_cache is not None and not job.cached:
+                with job.timer.stage("cache"):
+                    await caption_cache.put(job.image_hash, job.model, job.cache_identity, job.caption_text)
+        except Exception as e:
+            job.error = e
+
+    if job.error is not None:
+        return {
+            'image_path': job.image_path,
+            'error': str(job.error),
+            'exception': job.error,
+            'timing': job.timer.record(),
             'success': False
-        })
-    finally:
-        semaphore.release()
-
-async def main():
+        }
+    return {
+        'image_path': job.image_path,
+        'caption_text': job.caption_text,
+        'prompt_token_usage': job.prompt_token_usage,
+        'completion_token_usage': job.completion_token_usage,
+        'processing_time': time.perf_counter() - job.start_time,
+        'cached': job.cached,
+        'timing': job.timer.record(),
+        'success': True
+    }
+
+async def load_config(config_path: str = "caption.yaml", overrides: Optional[Dict] = None):
+    """Load the captioning config, with overrides (e.g. from the command line) applied
+    and the global metadata file (if any) prepended to the system prompt."""
     import hints.registration as registration
     registration._validate_hint_sources()
 
-    conf = OmegaConf.load("caption.yaml")
+    conf = OmegaConf.load(config_path)
+    for key, value in (overrides or {}).items():
+        conf[key] = value
     
-    concurrent_batch_size = conf.concurrent_batch_size
-
     if conf.get("global_metadata_file"): # type: ignore
         async with aiofiles.open(conf.global_metadata_file) as f:
             global_metadata = await f.read()
             conf.system_prompt = f"{global_metadata}\n{conf.system_prompt}"
+    return conf
+
+async def main(config_path: str = "caption.yaml", overrides: Optional[Dict] = None, event_sink: Optional[EventSink] = None, concurrency_budget: Optional[SharedConcurrencyBudget] = None, metrics_sink: Optional[Callable[[RunMetrics], None]] = None):
+    """Caption the images of the config. With event_sink set, typed progress events
+    (see metrics/events.py) are passed to it as the run goes, e.g. for app.py.
+    concurrency_budget is shared with the other jobs running in the process, and
+    metrics_sink is handed the run's RunMetrics once the run starts."""
+    conf = await load_config(config_path, overrides)
+    shard = create_shard(conf)
+    if shard is not None and conf.get("work_queue_file", ""):
+        raise ValueError("shard_count and work_queue_file cannot be used together: with a work queue the workers share out the images themselves")
 
     print(filter_ascii(f" -> SYSTEM PROMPT:\n{conf.system_prompt}\n"))
-    print(filter_ascii(f" -> Max concurrency: {concurrent_batch_size}\n"))
-
-    api_key = resolve_api_key(conf)
-
-    client = openai.AsyncOpenAI(base_url=conf.base_url, api_key=api_key)
-
-    aggregated_prompt_token_usage = 0
-    aggregated_completion_token_usage = 0
-    total_images_processed = 0
-    total_images_failed = 0
-
-    semaphore = asyncio.Semaphore(concurrent_batch_size)
-    results_queue = asyncio.Queue()
-    active_tasks = []
-    
-    print(filter_ascii(f"Starting image processing...\n"))
-
+    if conf.get("prompt_graph"):
+        # prompt_nodes validates the graph, so a bad config fails before any work starts
+        for node in prompt_nodes(conf):
+            print(filter_ascii(f" -> Turn {node.name}: after {', '.join(node.depends_on) or 'image'}"))
+        print()
+
+    rate_limiter = create_rate_limiter(conf)
+    # One HTTP client (connection pool) is shared by every endpoint's API client.
+    connection_stats = ConnectionStats()
+    http_client = create_http_client(conf, connection_stats)
+    client_kwargs = client_options(conf, rate_limited=rate_limiter is not None)
+    endpoint_pool = create_endpoint_pool(
+        conf,
+        client_factory=lambda base_url, api_key: openai.AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=http_client, **client_kwargs),
+        resolve_api_key=resolve_api_key,
+        budget=concurrency_budget,
+    )
+    if len(endpoint_pool.endpoints) > 1:
+        for endpoint in endpoint_pool.endpoints:
+            print(filter_ascii(f" -> Endpoint {endpoint.name}: model {endpoint.conf.model}, concurrency {endpoint.concurrency}"))
+    print(filter_ascii(f" -> Max concurrency: {endpoint_pool.capacity}\n"))
+    if shard is not None:
+        print(f" -> Captioning {shard.label}: images whose path hashes to shard {shard.index} of {shard.count}\n")
+    adaptive = create_adaptive_concurrency(conf, endpoint_pool)
+    if adaptive is not None:
+        print(f" -> Adaptive concurrency: starting at {adaptive.limit}, range {adaptive.min_limit}-{adaptive.max_limit}\n")
+
+    executor = create_preprocess_executor(conf.get("image_preprocess"))
+    caption_cache = open_caption_cache(conf)
+    work_queue = open_work_queue(conf)
+    if work_queue is not None and conf.get("run_ledger_file", ""):
+        print(" -> Run ledger not used: the work queue keeps track of every image\n")
+    ledger = open_run_ledger(conf) if work_queue is None else None
+    caption_index = open_caption_index(conf)
+    walk_snapshot = open_walk_snapshot(conf)
+    debug_transcripts = open_debug_transcripts(conf)
+    shard_output = open_shard_output(conf)
+    caption_writer = create_caption_writer(conf, caption_index)
+    metrics = create_run_metrics(conf)
+    if metrics_sink is not None:
+        metrics_sink(metrics)
+    try:
+        await _run_jobs(conf, endpoint_pool, executor, caption_cache, ledger, caption_index, walk_snapshot, adaptive, rate_limiter, metrics, debug_transcripts, shard_output, caption_writer, shard, work_queue, ProgressEvents(event_sink))
+        if connection_stats.requests:
+            print(connection_stats.summary())
+    finally:
+        if caption_writer is not None:
+            await caption_writer.close()
+        await metrics.flush(force=True)
+        metrics.close()
+        await endpoint_pool.close()
+        await http_client.aclose()
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if caption_cache is not None:
+            caption_cache.close()
+        if ledger is not None:
+            await ledger.flush_queued()
+            ledger.close()
+        if caption_index is not None:
+            caption_index.close()
+        if walk_snapshot is not None:
+            walk_snapshot.close()
+        if debug_transcripts is not None:
+            debug_transcripts.close()
+        if shard_output is not None:
+            shard_output.close()
+        if work_queue is not None:
+            work_queue.close()
+
+async def _walk_images(conf, ledger: Optional[RunLedger], caption_index: Optional[CaptionIndex], walk_snapshot: Optional[WalkSnapshot], metrics: RunMetrics, shard_output: Optional[ShardOutput] = None, shard: Optional[Shard] = None):
+    """Yield the images to caption: from the walker, or straight from the run ledger
+    when a previous run already walked the whole tree. The expected number of
+    images (for the ETA) comes from the ledger or the walk snapshot, if any.
+    With a shard, only the images of that shard are yielded."""
     output_format = conf.get("output_format", OUTPUT_FORMAT_TXT)
     skip_if_caption_exists = conf.get("skip_if_caption_exists", conf.get("skip_if_txt_exists", False))
-    concat_prompt = concat_prompts(list(conf.get("prompts", [])))
+    concat_prompt = prompt_identity(conf)
+
+    if ledger is not None and await ledger.walk_complete() and not conf.get("run_ledger_rescan", False):
+        print(" -> Resuming from run ledger, skipping directory scan")
+        metrics.expect_images((await ledger.counts())[STATE_QUEUED])
+        async for image_path in ledger.iter_queued():
+            if shard is None or shard.selects(image_path):
+                yield image_path
+        return
+
+    if walk_snapshot is not None:
+        expected = await walk_snapshot.count_images(
+            conf.base_directory, conf.recursive, IMAGE_EXTENSIONS,
+            uncaptioned_txt=skip_if_caption_exists and output_format == OUTPUT_FORMAT_TXT)
+        if expected is not None:
+            if shard is not None:
+                expected = round(expected / shard.count)
+            print(f" -> Walk snapshot: about {expected} images to process")
+            metrics.expect_images(expected)
 
     async for image_path in image_walk(
         conf.base_directory,
@@ -205,78 +434,278 @@ async def main():
         output_format=output_format,
         model=conf.get("model", ""),
         concat_prompt=concat_prompt,
+        caption_index=shard_output if shard_output is not None else caption_index,
+        walk_workers=conf.get("walk_workers", WALK_WORKERS),
+        ordered=conf.get("walk_ordered", False),
+        walk_snapshot=walk_snapshot,
     ):
-        current_task = asyncio.current_task()
-        if current_task is not None and current_task.cancelled():
-            print("Captioning task was cancelled by user")
-            for task in active_tasks:
-                task.cancel()
-            return
-
-        # Apply backpressure on the producer: block here until a slot is free, so
-        # we never stage more than concurrent_batch_size pending tasks at once.
-        await semaphore.acquire()
-        task = asyncio.create_task(process_image_semaphore(client, image_path, conf, semaphore, results_queue))
-        active_tasks.append(task)
-
-        # Opportunistically drain finished tasks and queued results so neither the
-        # active_tasks list nor results_queue grows for the duration of the walk.
-        if len(active_tasks) >= concurrent_batch_size:
-            active_tasks = [t for t in active_tasks if not t.done()]
+        if shard is not None and not shard.selects(image_path):
+            continue
+        if ledger is not None:
+            if await ledger.is_done(image_path):
+                continue
+            await ledger.add_queued(image_path)
+        yield image_path
+
+    if ledger is not None:
+        await ledger.mark_walk_complete()
+    if walk_snapshot is not None:
+        print(f" -> Walk snapshot: {walk_snapshot.hits} directories unchanged, {walk_snapshot.misses} listed")
+
+async def _renew_leases(conf, work_queue: WorkQueue) -> None:
+    """Keep this worker's leases alive while it runs."""
+    settings = conf.get("work_queue", None) or {}
+    interval = settings.get("heartbeat_seconds", None) or work_queue.lease_seconds / 3
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await work_queue.heartbeat()
+        except Exception as e:
+            print(filter_ascii(f"Warning: could not renew work queue leases: {e}"))
+
+async def _claim_images(conf, work_queue: WorkQueue, caption_index: Optional[CaptionIndex], walk_snapshot: Optional[WalkSnapshot], metrics: RunMetrics, shard_output: Optional[ShardOutput] = None):
+    """Yield images claimed from the shared work queue, a batch at a time. Whichever
+    worker gets the walk lease also walks the tree and queues what it finds, while
+    every worker captions what is already queued. Ends once the walk is complete
+    and no image is left queued or leased to any worker; leases of workers that
+    stopped renewing them run out and their images are claimed here again."""
+    settings = conf.get("work_queue", None) or {}
+    claim_size = settings.get("claim_size", DEFAULT_CLAIM_SIZE)
+    poll_seconds = settings.get("poll_seconds", 2)
+    walker = None
+
+    async def walk_into_queue():
+        batch = []
+        async for image_path in _walk_images(conf, None, caption_index, walk_snapshot, metrics, shard_output):
+            batch.append(image_path)
+            if len(batch) >= claim_size:
+                await work_queue.add(batch)
+                batch = []
+        if batch:
+            await work_queue.add(batch)
+        await work_queue.finish_walk()
+
+    try:
         while True:
-            try:
-                result = results_queue.get_nowait()
-            except asyncio.QueueEmpty:
-                break
-            if result['success']:
-                total_images_processed += 1
-                aggregated_prompt_token_usage += result['prompt_token_usage']
-                aggregated_completion_token_usage += result['completion_token_usage']
-                print(filter_ascii(f" --> Processed {result['image_path']}"))
-                print(f"     Time: {result['processing_time']/concurrent_batch_size:.2f}s, Tokens: {result['prompt_token_usage']} prompt, {result['completion_token_usage']} completion")
+            if walker is not None and walker.done():
+                walker.result()
+            if walker is None and not await work_queue.walk_complete() and await work_queue.claim_walk():
+                print(" -> Walking the directory tree into the work queue")
+                walker = asyncio.ensure_future(walk_into_queue())
+            claimed = await work_queue.claim(claim_size)
+            for image_path in claimed:
+                yield image_path
+            if claimed:
+                continue
+            if await work_queue.remaining() == 0 and await work_queue.walk_complete():
+                return
+            await asyncio.sleep(poll_seconds)
+    finally:
+        if walker is not None and not walker.done():
+            walker.cancel()
+
+async def _run_jobs(conf, endpoint_pool: EndpointPool, executor: Optional[Executor], caption_cache: Optional[CaptionCache], ledger: Optional[RunLedger], caption_index: Optional[CaptionIndex], walk_snapshot: Optional[WalkSnapshot], adaptive: Optional[AdaptiveConcurrency], rate_limiter: Optional[RateLimiter], metrics: RunMetrics, debug_transcripts: Optional[DebugTranscriptStore] = None, shard_output: Optional[ShardOutput] = None, caption_writer: Optional[CaptionWriter] = None, shard: Optional[Shard] = None, work_queue: Optional[WorkQueue] = None, events: Optional[ProgressEvents] = None):
+    """Caption every image as a pipeline: walk -> prefetch (read, hints, cache check,
+    encode) -> caption (one endpoint slot per image) -> write. The stages are joined
+    by bounded queues, so the walk runs only as far ahead as there is room, and
+    an endpoint slot is only taken by an image that is ready to send. With
+    memory_budget_mb set, images are also only read while their payload fits in
+    the budget, until their conversation is over. With a work queue, the images
+    come from the queue shared with the other workers instead of the walk."""
+    concurrent_batch_size = endpoint_pool.capacity
+    events = events or ProgressEvents()
+    progress_interval = conf.get("metrics_interval", 60)
+    last_progress = time.monotonic()
+
+    totals = {
+        'processed': 0,
+        'failed': 0,
+        'cache_hits': 0,
+        'prompt_token_usage': 0,
+        'completion_token_usage': 0,
+    }
+
+    observers = [o for o in (rate_limiter, adaptive) if o is not None]
+    cache_models = list(dict.fromkeys(endpoint.conf.get("model", "") for endpoint in endpoint_pool.endpoints))
+    # Metadata read by the hint sources is shared by this run's images only
+    hint_cache = HintCache()
+    budget = create_memory_budget(conf)
+    if budget is not None:
+        print(f" -> Memory budget: {conf.memory_budget_mb} MB for images in flight\n")
+
+    def release_payload(job: ImageJob) -> None:
+        if budget is not None and job.payload_bytes:
+            budget.release(job.payload_bytes)
+            job.payload_bytes = 0
+
+    async def handle_result(result):
+        nonlocal last_progress
+        metrics.observe(result)
+        await metrics.flush()
+        events.image_finished(result)
+        if result['success']:
+            totals['processed'] += 1
+            totals['prompt_token_usage'] += result['prompt_token_usage']
+            totals['completion_token_usage'] += result['completion_token_usage']
+            if ledger is not None:
+                await ledger.mark_done(result['image_path'], result['prompt_token_usage'], result['completion_token_usage'])
+            if result['cached']:
+                totals['cache_hits'] += 1
+                print(filter_ascii(f" --> Cache hit {result['image_path']}"))
             else:
-                total_images_failed += 1
-                print(filter_ascii(f" --> Error processing {result['image_path']}: {result['error']}"))
-            results_queue.task_done()
-
-    while active_tasks:
-        try:
-            result = await asyncio.wait_for(results_queue.get(), timeout=0.025)
-            if result['success']:
-                total_images_processed += 1
-                aggregated_prompt_token_usage += result['prompt_token_usage']
-                aggregated_completion_token_usage += result['completion_token_usage']
-                
                 print(filter_ascii(f" --> Processed {result['image_path']}"))
-                print(f"     Time: {result['processing_time']/concurrent_batch_size:.2f}s, Tokens: {result['prompt_token_usage']} prompt, {result['completion_token_usage']} completion")
-            else:
-                total_images_failed += 1
-                print(filter_ascii(f" --> Error processing {result['image_path']}: {result['error']}"))
-            
-            results_queue.task_done()
-        except asyncio.TimeoutError:
-            pass
-
-        active_tasks = [task for task in active_tasks if not task.done()]
-        
-        if not active_tasks:
-            break
-
-    # Process any remaining results
-    while not results_queue.empty():
-        result = await results_queue.get()
-        if result['success']:
-            total_images_processed += 1
-            aggregated_prompt_token_usage += result['prompt_token_usage']
-            aggregated_completion_token_usage += result['completion_token_usage']
+                print(f"     Time: {result['processing_time']:.2f}s, Tokens: {result['prompt_token_usage']} prompt, {result['completion_token_usage']} completion")
+        else:
+            totals['failed'] += 1
+            if ledger is not None:
+                await ledger.mark_failed(result['image_path'], result['error'])
+            print(filter_ascii(f" --> Error processing {result['image_path']}: {result['error']}"))
+        if progress_interval and time.monotonic() - last_progress >= progress_interval:
+            last_progress = time.monotonic()
+            queued = ", ".join(f"{name} {depth}" for name, depth in pipeline.depths().items())
+            progress = f"{metrics.progress_line()} | queued: {queued}"
+            if shard is not None:
+                progress = f"[{shard.label}] {progress}"
+            if budget is not None:
+                progress += f" | {budget.status()}"
+            print(progress)
+        events.progress(metrics)
+
+    if ledger is not None:
+        counts = await ledger.open_job(
+            ledger_job_key(conf, prompt_identity(conf)),
+            retry_failed=conf.get("run_ledger_retry_failed", True),
+        )
+        print(f" -> Run ledger: {counts[STATE_DONE]} done, {counts[STATE_QUEUED]} queued, {counts[STATE_FAILED]} failed\n")
+    if work_queue is not None:
+        counts = await work_queue.open_job(
+            queue_job_key(conf, prompt_identity(conf)),
+            retry_failed=(conf.get("work_queue", None) or {}).get("retry_failed", True),
+        )
+        print(filter_ascii(f" -> Work queue as {work_queue.worker}: {format_queue_counts(counts)}\n"))
+
+    async def walk():
+        if work_queue is not None:
+            source = _claim_images(conf, work_queue, caption_index, walk_snapshot, metrics, shard_output)
         else:
-            total_images_failed += 1
-        results_queue.task_done()
+            source = _walk_images(conf, ledger, caption_index, walk_snapshot, metrics, shard_output, shard)
+        async for image_path in source:
+            metrics.image_discovered()
+            yield ImageJob(image_path)
+        metrics.walk_complete()
+
+    async def prepare(job: ImageJob) -> ImageJob:
+        return await prepare_image(job, conf, executor, caption_cache, cache_models, budget, hint_cache)
+
+    async def caption(job: ImageJob) -> ImageJob:
+        # All turns of the image's conversation go to the endpoint picked here.
+        with job.timer.stage("slot_wait"):
+            endpoint = await endpoint_pool.acquire()
+        try:
+            if ledger is not None:
+                await ledger.mark_in_flight(job.image_path)
+            return await caption_image(job, endpoint, executor, observers, debug_transcripts)
+        finally:
+            endpoint.release()
+            release_payload(job)
+
+    async def write(job: ImageJob) -> None:
+        # Cache hits and images that failed to load still hold their budget here
+        release_payload(job)
+        result = await write_image(job, conf, caption_cache, caption_index, shard_output, caption_writer)
+        if job.endpoint is not None:
+            endpoint_pool.report(job.endpoint, result['success'], result.get('exception'))
+        if work_queue is not None:
+            try:
+                if result['success']:
+                    if not await work_queue.complete(job.image_path):
+                        print(filter_ascii(f"Warning: lease on {job.image_path} was lost before it was done; another worker captions it again"))
+                else:
+                    await work_queue.fail(job.image_path, result['error'])
+            except Exception as e:
+                # The lease runs out and the image is claimed again
+                print(filter_ascii(f"Warning: could not update the work queue for {job.image_path}: {e}"))
+        await handle_result(result)
+
+    # Images ready to send wait in front of the caption stage; prefetch_images sets how many.
+    prefetch_depth = conf.get("prefetch_images", concurrent_batch_size)
+    write_workers = conf.get("write_workers", WRITE_WORKERS)
+    if caption_writer is not None:
+        # Writers mostly wait for their caption's batch to be committed, so allow enough
+        # of them to fill a batch.
+        write_workers = max(write_workers, caption_writer.max_pending)
+    pipeline = Pipeline([
+        Stage("prefetch", prepare, workers=conf.get("prefetch_workers", PREFETCH_WORKERS), queue_size=conf.get("prefetch_workers", PREFETCH_WORKERS)),
+        # Cache hits and images that failed to load go straight to the writer.
+        Stage("caption", caption, workers=concurrent_batch_size, queue_size=prefetch_depth, bypass=lambda job: job.ready),
+        Stage("write", write, workers=write_workers, queue_size=concurrent_batch_size),
+    ])
+
+    print(filter_ascii(f"Starting image processing...\n"))
+    events.run_started(conf.base_directory, concurrent_batch_size, [endpoint.name for endpoint in endpoint_pool.endpoints])
+    heartbeat = asyncio.ensure_future(_renew_leases(conf, work_queue)) if work_queue is not None else None
+    try:
+        await pipeline.run(walk())
+    except asyncio.CancelledError:
+        print("Captioning task was cancelled by user")
+        events.progress(metrics, force=True)
+        events.run_finished(totals, cancelled=True)
+        raise
+    finally:
+        if heartbeat is not None:
+            heartbeat.cancel()
+            released = await work_queue.release()
+            if released:
+                print(f" -> Returned {released} unfinished images to the work queue")
 
     print(F" -> JOB COMPLETE.")
-    print(f"Total images processed: {total_images_processed}")
-    print(f"Total images failed: {total_images_failed}")
-    print(f"aggregated_prompt_token_usage: {aggregated_prompt_token_usage}, aggregated_completion_token_usage: {aggregated_completion_token_usage}")
+    events.progress(metrics, force=True)
+    events.run_finished(totals)
+    if shard is not None:
+        print(shard.summary())
+    if work_queue is not None:
+        print(filter_ascii(f"Work queue: {work_queue.completed} images done by this worker; all workers: {format_queue_counts(await work_queue.counts())}"))
+    print(f"Total images processed: {totals['processed']}")
+    print(f"Total images failed: {totals['failed']}")
+    if caption_cache is not None:
+        print(f"Total cache hits: {totals['cache_hits']}")
+    if shard_output is not None:
+        print(filter_ascii(f"Captions written to {shard_output.output_format} in {shard_output.directory} ({shard_output.batches} batches)"))
+    if budget is not None:
+        print(f"Peak image memory: {budget.peak / MB:.0f} MB of {budget.limit / MB:.0f} MB budget")
+    print(f"aggregated_prompt_token_usage: {totals['prompt_token_usage']}, aggregated_completion_token_usage: {totals['completion_token_usage']}")
+    if len(endpoint_pool.endpoints) > 1:
+        for endpoint in endpoint_pool.endpoints:
+            print(filter_ascii(f"Endpoint {endpoint.name}: {endpoint.completed} processed, {endpoint.failed} failed"))
+    if adaptive is not None:
+        print(adaptive.summary())
+    if rate_limiter is not None:
+        print(f"Total request retries: {rate_limiter.retries}")
+    print(metrics.summary())
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Caption images with an OpenAI compatible API.")
+    parser.add_argument("--config", default="caption.yaml", help="Config file (default: caption.yaml)")
+    parser.add_argument("--shard-index", type=int, help="Caption only shard number SHARD_INDEX (0 to shard count - 1) of the images")
+    parser.add_argument("--shard-count", type=int, help="Number of shards the images are split into, one per worker")
+    batch = parser.add_argument_group("offline batch mode (see Batch API in the README)")
+    batch.add_argument("--batch-export", action="store_true",
+                       help="Write Batch API request files for the next stage of every pending image")
+    batch.add_argument("--batch-requeue", action="store_true",
+                       help="With --batch-export, export again the requests whose results were never imported")
+    batch.add_argument("--batch-import", nargs="+", metavar="FILE",
+                       help="Import Batch API output (or error) files and save the finished captions")
+    batch.add_argument("--batch-status", action="store_true", help="Show how far the batch run has got")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    multiprocessing.freeze_support()
+    args = parse_args()
+    overrides = {key: value for key, value in (("shard_index", args.shard_index), ("shard_count", args.shard_count))
+                 if value is not None}
+    if args.batch_export or args.batch_import or args.batch_status:
+        from batch_api.batch_job import batch_main
+        asyncio.run(batch_main(args.config, export=args.batch_export, requeue=args.batch_requeue,
+                               import_paths=args.batch_import or (), overrides=overrides))
+    else:
+        asyncio.run(main(args.config, overrides))
@@ -0,0 +1,64 @@
+import time
+import hashlib
+import asyncio
+from typing import Optional
+
+from file_utils.sqlite_store import SqliteStore
+
+
+def hash_image_bytes(data: bytes) -> str:
+    """Content hash identifying an image regardless of its file name or location."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_prompt(identity: str) -> str:
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+
+async def hash_image_bytes_async(data: bytes) -> str:
+    return await asyncio.to_thread(hash_image_bytes, data)
+
+
+class CaptionCache(SqliteStore):
+    """Persistent content-addressed cache of finished captions.
+
+    Keyed by (sha256 of the image bytes, model, hash of the identity string the
+    caller builds from everything else that shapes the caption: system prompt,
+    prompts and the image's hints), so copies of the same image in other directories, or images that were
+    renamed or moved, reuse the caption instead of running the conversation again.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS captions (
+        image_hash TEXT NOT NULL,
+        model TEXT NOT NULL,
+        prompt_hash TEXT NOT NULL,
+        caption TEXT NOT NULL,
+        created REAL NOT NULL,
+        PRIMARY KEY (image_hash, model, prompt_hash)
+    );
+    """
+
+    async def get(self, image_hash: str, model: str, identity: str) -> Optional[str]:
+        def _get(conn, key):
+            row = conn.execute(
+                "SELECT caption FROM captions WHERE image_hash=? AND model=? AND prompt_hash=?", key
+            ).fetchone()
+            return row[0] if row else None
+        return await self._call(_get, (image_hash, model, hash_prompt(identity)))
+
+    async def put(self, image_hash: str, model: str, identity: str, caption: str) -> None:
+        def _put(conn, row):
+            # Columns named, since cache files from older versions also have a debug_info column
+            conn.execute("INSERT OR REPLACE INTO captions (image_hash, model, prompt_hash, caption, created) "
+                         "VALUES (?, ?, ?, ?, ?)", row)
+            conn.commit()
+        await self._call(_put, (image_hash, model, hash_prompt(identity), caption, time.time()))
+
+
+def open_caption_cache(conf) -> Optional[CaptionCache]:
+    """Open the cache configured by caption_cache_file, or None if caching is off."""
+    cache_file = conf.get("caption_cache_file", "")
+    if not cache_file:
+        return None
+    return CaptionCache(cache_file)
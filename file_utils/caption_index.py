@@ -0,0 +1,179 @@
+"""
+Index of the (model, prompt) captions present in jsonl sidecars, so skip checks
+do not have to open and parse every sidecar on every run.
+
+Rebuild the index for sidecars written by older versions (or by other tools) with:
+
+    python -m file_utils.caption_index --index caption_index.sqlite C:\\my_project\\to_be_captioned
+"""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+from typing import List, Optional, Tuple
+
+from file_utils.sqlite_store import SqliteStore
+
+
+def caption_key(model: str, concat_prompt: str) -> str:
+    return hashlib.sha256(f"{model}\0{concat_prompt}".encode("utf-8")).hexdigest()
+
+
+def _norm(path: str) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+def _sidecar_for(image_path: str) -> str:
+    return f"{os.path.splitext(image_path)[0]}.jsonl"
+
+
+def sidecar_stat(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def _index_sidecar(conn, sidecar: str, stat: Tuple[int, int]) -> bool:
+    """(Re)parse one sidecar and replace its rows. Returns False if it could not be
+    read. Runs on the store thread."""
+    keys = set()
+    try:
+        with open(sidecar, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                keys.add(caption_key(entry.get("model", ""), entry.get("prompt", "")))
+    except Exception as e:
+        print(f"Error reading {sidecar}: {e}")
+        return False
+    sidecar = _norm(sidecar)
+    conn.execute("DELETE FROM entries WHERE sidecar=?", (sidecar,))
+    conn.executemany("INSERT OR IGNORE INTO entries VALUES (?, ?)", [(sidecar, k) for k in keys])
+    conn.execute("INSERT OR REPLACE INTO sidecars VALUES (?, ?, ?)", (sidecar, *stat))
+    return True
+
+
+def _contains(conn, sidecar: str, key: str) -> bool:
+    """Whether the sidecar has a caption with this key, reparsing it first if it
+    changed since it was indexed (e.g. truncated or edited by hand, which may
+    have removed the caption). Runs on the store thread."""
+    stat = sidecar_stat(sidecar)
+    if stat is None:
+        return False
+    norm = _norm(sidecar)
+    row = conn.execute("SELECT size, mtime_ns FROM sidecars WHERE sidecar=?", (norm,)).fetchone()
+    if row is None or tuple(row) != stat:
+        indexed = _index_sidecar(conn, sidecar, stat)
+        conn.commit()
+        if not indexed:
+            return False
+    return conn.execute("SELECT 1 FROM entries WHERE sidecar=? AND key=?", (norm, key)).fetchone() is not None
+
+
+class CaptionIndex(SqliteStore):
+    """Which (model, prompt) pairs each jsonl sidecar contains.
+
+    Rows are keyed by sidecar path (one per image stem) and the hash of model and
+    prompt. The sidecar's size and mtime are stored with its rows: if the file
+    changed behind the index's back (another process, an older version, a hand
+    edit) it is parsed again on the next lookup, so a stale index can cost a
+    reparse but never a wrong skip.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sidecars (
+        sidecar TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS entries (
+        sidecar TEXT NOT NULL,
+        key TEXT NOT NULL,
+        PRIMARY KEY (sidecar, key)
+    ) WITHOUT ROWID;
+    """
+
+    async def contains(self, image_path: str, model: str, concat_prompt: str) -> bool:
+        return await self._call(_contains, _sidecar_for(image_path), caption_key(model, concat_prompt))
+
+    async def contains_many(self, image_paths: List[str], model: str, concat_prompt: str) -> List[bool]:
+        """contains() for a batch of images (e.g. one directory) in a single store call."""
+        def _contains_many(conn, sidecars, key):
+            return [_contains(conn, sidecar, key) for sidecar in sidecars]
+        return await self._call(_contains_many, [_sidecar_for(p) for p in image_paths], caption_key(model, concat_prompt))
+
+    async def record(self, image_path: str, model: str, concat_prompt: str,
+                     before: Optional[Tuple[int, int]], after: Optional[Tuple[int, int]]) -> None:
+        """Record a caption appended by save_caption.
+
+        before/after are the sidecar's (size, mtime_ns) around the append. The
+        stored stat only moves forward if it matched `before`, i.e. nothing
+        else touched the file since it was last indexed.
+        """
+        def _record(conn, sidecar, key):
+            conn.execute("INSERT OR IGNORE INTO entries VALUES (?, ?)", (sidecar, key))
+            row = conn.execute("SELECT size, mtime_ns FROM sidecars WHERE sidecar=?", (sidecar,)).fetchone()
+            indexed = tuple(row) if row is not None else None
+            if after is not None and indexed == before:
+                conn.execute("INSERT OR REPLACE INTO sidecars VALUES (?, ?, ?)", (sidecar, *after))
+            conn.commit()
+        await self._call(_record, _norm(_sidecar_for(image_path)), caption_key(model, concat_prompt))
+
+    def rebuild(self, base_directory: str, recursive: bool = True) -> int:
+        """Drop the index rows under base_directory and reindex every jsonl sidecar there.
+        Returns the number of sidecars indexed."""
+        def _rebuild(conn):
+            prefix = os.path.join(_norm(base_directory), "")
+            for table in ("entries", "sidecars"):
+                conn.execute(f"DELETE FROM {table} WHERE substr(sidecar, 1, ?) = ?", (len(prefix), prefix))
+            count = 0
+            for root, dirs, files in os.walk(base_directory):
+                for name in files:
+                    if name.lower().endswith(".jsonl"):
+                        sidecar = os.path.join(root, name)
+                        stat = sidecar_stat(sidecar)
+                        if stat is not None:
+                            _index_sidecar(conn, sidecar, stat)
+                            count += 1
+                if not recursive:
+                    break
+            conn.commit()
+            return count
+        return self._call_sync(_rebuild)
+
+
+def open_caption_index(conf) -> Optional[CaptionIndex]:
+    """Open the index configured by caption_index_file. Only used for jsonl output."""
+    index_file = conf.get("caption_index_file", "")
+    if not index_file or conf.get("output_format", "txt") != "jsonl":
+        return None
+    return CaptionIndex(index_file)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Rebuild the jsonl caption index for a directory.")
+    parser.add_argument("directory", help="Directory containing images and .jsonl sidecars")
+    parser.add_argument("--index", required=True, help="Path to the index file (caption_index_file)")
+    parser.add_argument("--no-recursive", action="store_true", help="Only index the top-level directory")
+    args = parser.parse_args(argv)
+
+    index = CaptionIndex(args.index)
+    try:
+        count = index.rebuild(args.directory, recursive=not args.no_recursive)
+    finally:
+        index.close()
+    print(f"Indexed {count} sidecar(s) from {args.directory} into {args.index}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
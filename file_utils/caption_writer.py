@@ -0,0 +1,163 @@
+"""
+Write-behind caption writer: captions for .txt and .jsonl sidecars are queued,
+then written in batches by a single background task.
+"""
+
+import asyncio
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from file_utils.caption_index import CaptionIndex
+from file_utils.file_access import (OUTPUT_FORMAT_JSONL, OUTPUT_FORMAT_TXT, _jsonl_path_for, _txt_path_for,
+                                    append_jsonl_locked, jsonl_line, write_txt_atomic)
+
+DEFAULT_FLUSH_INTERVAL = 0.5
+DEFAULT_FLUSH_RECORDS = 64
+
+
+class _Entry:
+    __slots__ = ("image_path", "caption_text", "output_format", "model", "concat_prompt", "future")
+
+    def __init__(self, image_path, caption_text, output_format, model, concat_prompt, future):
+        self.image_path = image_path
+        self.caption_text = caption_text
+        self.output_format = output_format
+        self.model = model
+        self.concat_prompt = concat_prompt
+        self.future = future
+
+
+def _write_batch(groups: Dict[Tuple[str, str], List[_Entry]]) -> Dict[Tuple[str, str], object]:
+    """Write each target file's captions. Returns per target the (before, after)
+    sidecar stats of a jsonl append, None for a txt file, or the exception raised."""
+    outcomes = {}
+    for (output_format, target), entries in groups.items():
+        try:
+            if output_format == OUTPUT_FORMAT_JSONL:
+                lines = [jsonl_line(e.caption_text, e.model, e.concat_prompt) for e in entries]
+                outcomes[(output_format, target)] = append_jsonl_locked(target, lines)
+            else:
+                # Only the newest caption of an image is kept in its .txt
+                write_txt_atomic(target, entries[-1].caption_text)
+                outcomes[(output_format, target)] = None
+        except Exception as e:
+            outcomes[(output_format, target)] = e
+    return outcomes
+
+
+class CaptionWriter:
+    """Collects captions and writes them in batches from one background task.
+
+    A batch is written once flush_records captions are waiting, or flush_interval
+    seconds after its first caption arrived, whichever comes first. Captions are
+    grouped per sidecar: a .txt is replaced through a temporary file and a rename,
+    and all lines for a .jsonl go out in one append under a file lock. put()
+    returns a future that completes once the caption is on disk (and recorded
+    in caption_index), or fails with the error that prevented it. put() itself
+    only waits when max_pending captions are already waiting to be written.
+    """
+
+    def __init__(self, flush_interval: float = DEFAULT_FLUSH_INTERVAL, flush_records: int = DEFAULT_FLUSH_RECORDS,
+                 max_pending: int = 0, caption_index: Optional[CaptionIndex] = None):
+        self.flush_interval = flush_interval
+        self.flush_records = max(1, flush_records)
+        self.max_pending = max_pending or 4 * self.flush_records
+        self.caption_index = caption_index
+        self.batches = 0
+        self._pending: List[_Entry] = []
+        self._first_at = 0.0
+        self._wake = asyncio.Event()
+        self._room = asyncio.Event()
+        self._closing = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def put(self, image_path: str, caption_text: str, output_format: str = OUTPUT_FORMAT_TXT,
+                  model: str = "", concat_prompt: str = "") -> asyncio.Future:
+        while len(self._pending) >= self.max_pending:
+            self._room.clear()
+            await self._room.wait()
+        loop = asyncio.get_running_loop()
+        if self._task is None:
+            self._task = loop.create_task(self._run())
+        future = loop.create_future()
+        self._pending.append(_Entry(image_path, caption_text, output_format, model, concat_prompt, future))
+        if len(self._pending) == 1:
+            self._first_at = loop.time()
+            self._wake.set()
+        elif len(self._pending) >= self.flush_records:
+            self._wake.set()
+        return future
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wake.clear()
+            if not self._pending:
+                if self._closing:
+                    return
+                await self._wake.wait()
+                continue
+            remaining = self._first_at + self.flush_interval - loop.time()
+            if len(self._pending) < self.flush_records and remaining > 0 and not self._closing:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            batch, self._pending = self._pending, []
+            self._room.set()
+            await self._commit(batch)
+
+    async def _commit(self, batch: List[_Entry]) -> None:
+        groups = defaultdict(list)
+        for entry in batch:
+            if entry.output_format == OUTPUT_FORMAT_JSONL:
+                groups[(OUTPUT_FORMAT_JSONL, _jsonl_path_for(entry.image_path))].append(entry)
+            else:
+                groups[(OUTPUT_FORMAT_TXT, _txt_path_for(entry.image_path))].append(entry)
+        try:
+            outcomes = await asyncio.to_thread(_write_batch, groups)
+        except Exception as e:
+            outcomes = {target: e for target in groups}
+        self.batches += 1
+
+        for target, entries in groups.items():
+            outcome = outcomes[target]
+            for entry in entries:
+                error = outcome if isinstance(outcome, Exception) else None
+                if error is None and self.caption_index is not None and entry.output_format == OUTPUT_FORMAT_JSONL:
+                    before, after = outcome
+                    try:
+                        await self.caption_index.record(entry.image_path, entry.model, entry.concat_prompt, before, after)
+                    except Exception as e:
+                        error = e
+                if entry.future.done():
+                    continue
+                if error is None:
+                    entry.future.set_result(None)
+                else:
+                    entry.future.set_exception(error)
+
+    async def close(self) -> None:
+        """Write everything still waiting and stop the background task."""
+        self._closing = True
+        self._wake.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+
+def create_caption_writer(conf, caption_index: Optional[CaptionIndex] = None) -> Optional[CaptionWriter]:
+    """The write-behind writer for txt and jsonl output, or None when output goes to
+    shards (which batch their own writes) or caption_writer.enabled is false."""
+    if conf.get("output_format", OUTPUT_FORMAT_TXT) not in (OUTPUT_FORMAT_TXT, OUTPUT_FORMAT_JSONL):
+        return None
+    settings = conf.get("caption_writer", None) or {}
+    if not settings.get("enabled", True):
+        return None
+    return CaptionWriter(
+        flush_interval=settings.get("flush_interval", DEFAULT_FLUSH_INTERVAL),
+        flush_records=settings.get("flush_records", DEFAULT_FLUSH_RECORDS),
+        max_pending=settings.get("max_pending", 0),
+        caption_index=caption_index,
+    )
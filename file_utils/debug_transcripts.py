@@ -0,0 +1,111 @@
+"""
+Debug transcripts: the conversation held for each image, kept in one SQLite file
+instead of being dumped to messages_{i}.txt after every turn.
+"""
+
+import sys
+import json
+import time
+import zlib
+import argparse
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+from file_utils.sqlite_store import SqliteStore
+
+DEFAULT_MAX_TRANSCRIPTS = 10000
+
+
+def _encode(record: Dict) -> bytes:
+    return zlib.compress(json.dumps(record).encode("utf-8"), 6)
+
+
+def _decode(data: bytes) -> Dict:
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+class DebugTranscriptStore(SqliteStore):
+    """One compressed record per captioned image: each turn's response, the final
+    messages with the image payload stripped, and the error if the image failed.
+
+    add() hands the record to the store thread and returns at once, so the
+    serializing, compressing and writing all happen on that single background
+    writer. Only the newest max_records transcripts are kept.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS transcripts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        image_path TEXT NOT NULL,
+        created REAL NOT NULL,
+        error TEXT,
+        data BLOB NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS transcripts_image ON transcripts (image_path);
+    """
+
+    def __init__(self, path: str, max_records: int = DEFAULT_MAX_TRANSCRIPTS):
+        super().__init__(path)
+        self.max_records = max_records
+
+    def add(self, image_path: str, record: Dict) -> Future:
+        """Queue record (JSON-serializable, not modified afterwards) for writing."""
+        def _add(conn, created, error):
+            cursor = conn.execute(
+                "INSERT INTO transcripts (image_path, created, error, data) VALUES (?, ?, ?, ?)",
+                (image_path, created, error, _encode(record)))
+            if self.max_records:
+                conn.execute("DELETE FROM transcripts WHERE id <= ?", (cursor.lastrowid - self.max_records,))
+            conn.commit()
+
+        future = self._executor.submit(self._invoke, _add, (time.time(), record.get("error")))
+        future.add_done_callback(_report_failure)
+        return future
+
+    def transcripts(self, image_path: Optional[str] = None, limit: int = 0) -> List[Dict]:
+        """The stored records, newest first, optionally only those of image_path."""
+        def _select(conn):
+            query = "SELECT data FROM transcripts"
+            args = []
+            if image_path is not None:
+                query += " WHERE image_path=?"
+                args.append(image_path)
+            query += " ORDER BY id DESC"
+            if limit:
+                query += " LIMIT ?"
+                args.append(limit)
+            return [_decode(row[0]) for row in conn.execute(query, args)]
+        return self._call_sync(_select)
+
+
+def _report_failure(future: Future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Warning: failed to write debug transcript: {future.exception()}")
+
+
+def open_debug_transcripts(conf) -> Optional[DebugTranscriptStore]:
+    """Open the store configured by debug_transcripts_file, or None when it is not set."""
+    transcripts_file = conf.get("debug_transcripts_file", "")
+    if not transcripts_file:
+        return None
+    return DebugTranscriptStore(transcripts_file, conf.get("debug_transcripts_max", DEFAULT_MAX_TRANSCRIPTS))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Print debug transcripts as JSON lines, newest first.")
+    parser.add_argument("file", help="Path to the transcripts file (debug_transcripts_file)")
+    parser.add_argument("--image", help="Only show transcripts of this image path")
+    parser.add_argument("--limit", type=int, default=10, help="Number of transcripts to show, 0 for all")
+    args = parser.parse_args(argv)
+
+    store = DebugTranscriptStore(args.file)
+    try:
+        for record in store.transcripts(args.image, args.limit):
+            print(json.dumps(record))
+    finally:
+        store.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,14 @@
 import os
 import json
-import aiofiles
-from typing import AsyncGenerator, List, Optional
+from typing import AsyncGenerator, List, Optional, Set, Tuple, Union
 import asyncio
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from file_utils.caption_index import CaptionIndex, sidecar_stat
+from file_utils.walk_snapshot import WalkSnapshot
+from file_utils.shard_output import ShardOutput, SHARD_FORMATS
 
 # Supported image extensions
 IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp', '.avif')
@@ -78,6 +84,9 @@ def _scan_dir(base_directory: str):
     return results
 
 
+WALK_WORKERS = 8
+
+
 async def image_walk(
     base_directory: str,
     recursive: bool,
@@ -85,40 +94,183 @@ async def image_walk(
     output_format: str = OUTPUT_FORMAT_TXT,
     model: str = "",
     concat_prompt: str = "",
+    caption_index: Optional[Union[CaptionIndex, ShardOutput]] = None,
+    walk_workers: int = WALK_WORKERS,
+    ordered: bool = False,
+    walk_snapshot: Optional[WalkSnapshot] = None,
 ) -> AsyncGenerator[str, None]:
     """
     Asynchronously walk through the directory and yield image file paths.
 
     When skip_if_caption_exists is True, images that already have a matching
-    caption (per output_format / model / concat_prompt) are skipped.
+    caption (per output_format / model / concat_prompt) are skipped. In jsonl
+    mode a caption_index answers that check without parsing the sidecars; with
+    the shard formats, caption_index is the ShardOutput whose index answers it.
 
-    All blocking filesystem I/O is offloaded to a thread so the event loop
-    stays responsive — over SMB this lets in-flight caption tasks make
-    progress while the walker is waiting on directory listings.
+    Directory listings run on a pool of walk_workers threads, so sibling
+    directories are listed concurrently and the event loop stays responsive —
+    over SMB, where each listing is a network round-trip, the walk no longer
+    waits on one directory at a time. By default images are yielded as soon as
+    their directory has been listed, in no particular order. With ordered=True
+    they come in a fixed depth-first order (sorted by name, a directory's images
+    before its subdirectories), while the next walk_workers subdirectories are
+    still listed ahead in the background. The skip check is made per directory
+    from its listing, see _captioned_images.
+    With a walk_snapshot, directories whose mtime has not changed since the
+    last walk are not listed again.
     """
-    entries = await asyncio.to_thread(_scan_dir, base_directory)
-
-    for current_path, is_dir, is_file in entries:
-        if recursive and is_dir:
-            async for image_path in image_walk(
-                base_directory=current_path,
-                recursive=True,
-                skip_if_caption_exists=skip_if_caption_exists,
-                output_format=output_format,
-                model=model,
-                concat_prompt=concat_prompt,
-            ):
+    pool = ThreadPoolExecutor(max_workers=max(1, walk_workers), thread_name_prefix="image_walk")
+    loop = asyncio.get_running_loop()
+
+    def list_dir(path: str) -> "asyncio.Future[List[Tuple[str, bool, bool]]]":
+        # In the caller's context, like asyncio.to_thread, e.g. so a job's prints stay with it
+        context = contextvars.copy_context()
+        if walk_snapshot is not None:
+            return loop.run_in_executor(pool, context.run, walk_snapshot.listing, path, _scan_dir)
+        return loop.run_in_executor(pool, context.run, _scan_dir, path)
+
+    walk = _walk_ordered if ordered else _walk_unordered
+    try:
+        async for files in walk(base_directory, recursive, list_dir, max(1, walk_workers)):
+            images = [path for path in files if path.lower().endswith(IMAGE_EXTENSIONS)]
+            if skip_if_caption_exists and images:
+                captioned = await _captioned_images(images, files, output_format, model, concat_prompt, caption_index)
+                images = [path for path in images if path not in captioned]
+            for image_path in images:
                 yield image_path
-        elif not recursive and is_dir:
-            continue
-        elif is_file and current_path.lower().endswith(IMAGE_EXTENSIONS):
-            if skip_if_caption_exists:
-                exists = await asyncio.to_thread(
-                    caption_exists, current_path, output_format, model, concat_prompt
-                )
-                if exists:
-                    continue
-            yield current_path
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def _captioned_images(
+    images: List[str],
+    files: List[str],
+    output_format: str,
+    model: str,
+    concat_prompt: str,
+    caption_index: Optional[Union[CaptionIndex, ShardOutput]],
+) -> Set[str]:
+    """The images of one directory that already have a matching caption, decided
+    from the directory listing in bulk. A .txt caption exists iff the listing
+    has the sidecar. A jsonl sidecar still has to be checked for the model and
+    prompt, but only when the listing has it, and in one call per directory.
+    Captions in shards are looked up in the shard index, also one call per directory."""
+    if output_format in SHARD_FORMATS:
+        if caption_index is None:
+            return set()
+        found = await caption_index.contains_many(images, model, concat_prompt)
+        return {path for path, exists in zip(images, found) if exists}
+
+    names = {os.path.normcase(path) for path in files}
+    if output_format != OUTPUT_FORMAT_JSONL:
+        return {path for path in images if os.path.normcase(_txt_path_for(path)) in names}
+
+    candidates = [path for path in images if os.path.normcase(_jsonl_path_for(path)) in names]
+    if not candidates:
+        return set()
+    if caption_index is not None:
+        found = await caption_index.contains_many(candidates, model, concat_prompt)
+    else:
+        found = await asyncio.to_thread(
+            lambda: [caption_exists(path, output_format, model, concat_prompt) for path in candidates]
+        )
+    return {path for path, exists in zip(candidates, found) if exists}
+
+
+async def _walk_unordered(base_directory: str, recursive: bool, list_dir, workers: int) -> AsyncGenerator[List[str], None]:
+    """Yield each directory's file paths as its listing completes, keeping up to
+    workers listings in flight."""
+    pending_dirs = deque([base_directory])
+    listings = set()
+    while pending_dirs or listings:
+        while pending_dirs and len(listings) < workers:
+            listings.add(list_dir(pending_dirs.popleft()))
+        done, listings = await asyncio.wait(listings, return_when=asyncio.FIRST_COMPLETED)
+        for listing in done:
+            files = []
+            for current_path, is_dir, is_file in listing.result():
+                if is_dir:
+                    if recursive:
+                        pending_dirs.append(current_path)
+                elif is_file:
+                    files.append(current_path)
+            yield files
+
+
+async def _walk_ordered(base_directory: str, recursive: bool, list_dir, workers: int) -> AsyncGenerator[List[str], None]:
+    """Yield each directory's file paths depth-first in name order, a directory's
+    files before its subdirectories, listing up to workers subdirectories of each
+    directory ahead of the one being walked."""
+    async def walk(listing) -> AsyncGenerator[List[str], None]:
+        entries = sorted(await listing)
+        yield [path for path, is_dir, is_file in entries if is_file and not is_dir]
+        if not recursive:
+            return
+        subdirs = [path for path, is_dir, _ in entries if is_dir]
+        prefetched = deque()
+        for subdir in subdirs[:workers]:
+            prefetched.append(list_dir(subdir))
+        for i in range(len(subdirs)):
+            child_listing = prefetched.popleft()
+            if i + workers < len(subdirs):
+                prefetched.append(list_dir(subdirs[i + workers]))
+            async for files in walk(child_listing):
+                yield files
+
+    async for files in walk(list_dir(base_directory)):
+        yield files
+
+
+@contextmanager
+def _locked(f):
+    """Hold an exclusive lock on an open file, so appends from other processes
+    captioning the same images cannot interleave with ours."""
+    if os.name == "nt":
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def write_txt_atomic(txt_path: str, caption_text: str) -> None:
+    """Replace txt_path with caption_text through a temporary file and a rename, so
+    readers see the old caption or the new one, never a partly written file."""
+    tmp_path = f"{txt_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(caption_text)
+        os.replace(tmp_path, txt_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def jsonl_line(caption_text: str, model: str, concat_prompt: str) -> str:
+    return json.dumps({"text": caption_text, "model": model, "prompt": concat_prompt}, ensure_ascii=False) + "\n"
+
+
+def append_jsonl_locked(jsonl_path: str, lines: List[str]) -> Tuple[Optional[Tuple[int, int]], Optional[Tuple[int, int]]]:
+    """Append lines to jsonl_path in one write under an exclusive lock. Returns the
+    sidecar's (size, mtime_ns) before and after the append, for the caption index."""
+    with open(jsonl_path, "ab") as f:
+        with _locked(f):
+            before = sidecar_stat(jsonl_path)
+            f.write("".join(lines).encode("utf-8"))
+            f.flush()
+            after = sidecar_stat(jsonl_path)
+    return before, after
 
 
 async def save_caption(
@@ -128,26 +280,30 @@ async def save_caption(
     output_format: str = OUTPUT_FORMAT_TXT,
     model: str = "",
     concat_prompt: str = "",
+    caption_index: Optional[CaptionIndex] = None,
+    shard_output: Optional[ShardOutput] = None,
 ) -> None:
     """
     Save the caption for the given image.
 
-    txt: write/overwrite a .txt sidecar with caption_text.
+    txt: write/overwrite a .txt sidecar with caption_text, atomically.
     jsonl: append one JSON object per line ({"text", "model", "prompt"}) so multiple
-    captions per image (different models/prompt sets) can coexist.
+    captions per image (different models/prompt sets) can coexist. The append is
+    made under a file lock and recorded in caption_index when one is given.
+    jsonl_shards / tar_shards: add the caption to the current shard of shard_output.
+    Raises if the caption could not be saved, so the image is not recorded as done.
     """
-    try:
-        if output_format == OUTPUT_FORMAT_JSONL:
-            jsonl_path = _jsonl_path_for(file_path)
-            entry = {"text": caption_text, "model": model, "prompt": concat_prompt}
-            line = json.dumps(entry, ensure_ascii=False) + "\n"
-            async with aiofiles.open(jsonl_path, "a", encoding="utf-8") as f_cap:
-                await f_cap.write(line)
-            return
+    if output_format in SHARD_FORMATS:
+        if shard_output is None:
+            raise ValueError(f"output_format {output_format} needs a shard output")
+        await shard_output.write(file_path, caption_text, model, concat_prompt)
+        return
 
-        txt_path = _txt_path_for(file_path)
-        async with aiofiles.open(txt_path, "w", encoding="utf-8") as f_cap:
-            await asyncio.gather(f_cap.write(caption_text))
+    if output_format == OUTPUT_FORMAT_JSONL:
+        before, after = await asyncio.to_thread(
+            append_jsonl_locked, _jsonl_path_for(file_path), [jsonl_line(caption_text, model, concat_prompt)])
+        if caption_index is not None:
+            await caption_index.record(file_path, model, concat_prompt, before, after)
+        return
 
-    except Exception as e:
-        print(f"Error saving caption for {file_path}: {e}")
+    await asyncio.to_thread(write_txt_atomic, _txt_path_for(file_path), caption_text)
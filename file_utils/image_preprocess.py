@@ -0,0 +1,143 @@
+import io
+import os
+import base64
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Optional, Tuple
+
+from PIL import Image, ImageOps
+
+MIME_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".gif": "image/gif",
+    ".bmp": "image/bmp",
+    ".tiff": "image/tiff",
+    ".webp": "image/webp",
+    ".avif": "image/avif",
+}
+
+# Pillow format name -> (save format, mime type) for the encodings we emit.
+_TARGET_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+# Source formats every OpenAI-compatible vision endpoint accepts as-is.
+_PASSTHROUGH_FORMATS = {"JPEG": "jpeg", "PNG": "png", "WEBP": "webp"}
+
+
+def mime_type_for(image_path: str) -> str:
+    """MIME type for an image path based on its extension, defaulting to jpeg."""
+    return MIME_TYPES.get(os.path.splitext(image_path)[1].lower(), "image/jpeg")
+
+
+def preprocess_enabled(preprocess_conf) -> bool:
+    return bool(preprocess_conf) and bool(preprocess_conf.get("enabled", False))
+
+
+def preprocess_settings(preprocess_conf) -> Tuple[int, int, str, int]:
+    """The settings the preprocessed payload depends on: max_long_side, max_pixels, format and quality."""
+    return (
+        preprocess_conf.get("max_long_side", 0),
+        preprocess_conf.get("max_pixels", 0),
+        preprocess_conf.get("format", "jpeg"),
+        preprocess_conf.get("quality", 90),
+    )
+
+
+def _target_size(width: int, height: int, max_long_side: int, max_pixels: int) -> Tuple[int, int]:
+    scale = 1.0
+    if max_long_side and max(width, height) > max_long_side:
+        scale = min(scale, max_long_side / max(width, height))
+    if max_pixels and width * height > max_pixels:
+        scale = min(scale, (max_pixels / (width * height)) ** 0.5)
+    if scale >= 1.0:
+        return width, height
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def preprocess_image_bytes(
+    data: bytes,
+    max_long_side: int = 0,
+    max_pixels: int = 0,
+    target_format: str = "jpeg",
+    quality: int = 90,
+) -> Tuple[str, str]:
+    """Downscale and re-encode raw image bytes. Returns (mime_type, base64 string).
+
+    Runs in a worker process, so it only takes and returns picklable values.
+    target_format may be "jpeg", "png", "webp" or "keep" (keep jpeg/png/webp
+    sources as they are and convert anything else to jpeg). An image that is
+    already within the size limits and in the requested format is passed
+    through untouched so it is not recompressed.
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        source_format = _PASSTHROUGH_FORMATS.get(img.format or "")
+        if target_format == "keep":
+            target_format = source_format or "jpeg"
+        save_format, mime_type = _TARGET_FORMATS.get(target_format, _TARGET_FORMATS["jpeg"])
+
+        width, height = img.size
+        new_size = _target_size(width, height, max_long_side, max_pixels)
+
+        if new_size == (width, height) and source_format == target_format:
+            return mime_type, base64.b64encode(data).decode("utf-8")
+
+        if img.format == "JPEG":
+            # Let the JPEG decoder do most of the downscale with DCT scaling.
+            img.draft("RGB", new_size)
+        img = ImageOps.exif_transpose(img)
+        new_size = _target_size(img.width, img.height, max_long_side, max_pixels)
+        if new_size != img.size:
+            img = img.resize(new_size, Image.Resampling.LANCZOS)
+
+        if save_format == "JPEG" and img.mode != "RGB":
+            if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+                rgba = img.convert("RGBA")
+                flattened = Image.new("RGB", rgba.size, (255, 255, 255))
+                flattened.paste(rgba, mask=rgba.getchannel("A"))
+                img = flattened
+            else:
+                img = img.convert("RGB")
+
+        out = io.BytesIO()
+        save_kwargs = {"quality": quality} if save_format in ("JPEG", "WEBP") else {"optimize": True}
+        img.save(out, format=save_format, **save_kwargs)
+        return mime_type, base64.b64encode(out.getvalue()).decode("utf-8")
+
+
+def create_preprocess_executor(preprocess_conf) -> Optional[Executor]:
+    """Process pool for image preprocessing, or None when preprocessing is disabled."""
+    if not preprocess_enabled(preprocess_conf):
+        return None
+    workers = preprocess_conf.get("workers", 0) or None  # None -> os.cpu_count()
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+async def encode_image(
+    file_contents: bytes,
+    image_path: str,
+    preprocess_conf=None,
+    executor: Optional[Executor] = None,
+) -> Tuple[str, str]:
+    """Returns (mime_type, base64 string) for the image payload sent to the API.
+
+    Without preprocessing the original bytes are sent, labeled with the MIME
+    type matching the file extension. With preprocessing the Pillow decode,
+    resize and encode run on the executor so the event loop is never blocked.
+    """
+    if not preprocess_enabled(preprocess_conf):
+        return mime_type_for(image_path), base64.b64encode(file_contents).decode("utf-8")
+
+    args = (file_contents, *preprocess_settings(preprocess_conf))
+    try:
+        if executor is None:
+            return await asyncio.to_thread(preprocess_image_bytes, *args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, preprocess_image_bytes, *args)
+    except Exception as e:
+        print(f"Warning: preprocessing failed for {image_path}, sending original: {e}")
+        return mime_type_for(image_path), base64.b64encode(file_contents).decode("utf-8")
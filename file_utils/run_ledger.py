@@ -0,0 +1,198 @@
+import time
+import hashlib
+from typing import AsyncGenerator, Dict, List, Optional
+
+from file_utils.sqlite_store import SqliteStore
+
+STATE_QUEUED = "queued"
+STATE_IN_FLIGHT = "in_flight"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+
+def ledger_job_key(conf, concat_prompt: str) -> str:
+    """Identity of a captioning job. A ledger written for a different job is reset."""
+    identity = "\n".join([
+        str(conf.get("base_directory", "")),
+        str(conf.get("recursive", False)),
+        str(conf.get("model", "")),
+        str(conf.get("output_format", "")),
+        concat_prompt,
+    ])
+    if int(conf.get("shard_count", 1) or 1) > 1:
+        # A ledger only holds the images of the shard it was written for
+        identity += f"\nshard {conf.get('shard_index', 0)}/{conf.shard_count}"
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+
+class RunLedger(SqliteStore):
+    """Per-job record of every image's state so an interrupted run can resume.
+
+    Rows move queued -> in_flight -> done | failed, with attempt counts, timings
+    and token usage. Once a walk of the whole tree has finished the ledger knows
+    every image in the job, and a restarted run reads its pending images from the
+    ledger instead of walking and stat'ing the tree again.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS images (
+        path TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        queued_at REAL,
+        started_at REAL,
+        finished_at REAL,
+        prompt_tokens INTEGER NOT NULL DEFAULT 0,
+        completion_tokens INTEGER NOT NULL DEFAULT 0,
+        error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS images_state ON images (state);
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    """
+
+    QUEUE_FLUSH_SIZE = 500
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self._queued_buffer: List[str] = []
+
+    async def open_job(self, job_key: str, retry_failed: bool = True) -> Dict[str, int]:
+        """Prepare the ledger for a run of job_key and return the per-state counts.
+
+        Images left in flight by a crashed run (and failed ones when retry_failed)
+        go back to queued. A ledger from another job is cleared. A ledger whose
+        images are all done is kept, but is marked for a fresh walk so images
+        added since the last run are discovered.
+        """
+        def _open(conn):
+            row = conn.execute("SELECT value FROM meta WHERE key='job_key'").fetchone()
+            if row is None or row[0] != job_key:
+                conn.execute("DELETE FROM images")
+                conn.execute("DELETE FROM meta")
+                conn.execute("INSERT INTO meta VALUES ('job_key', ?)", (job_key,))
+            requeue = [STATE_IN_FLIGHT, STATE_FAILED] if retry_failed else [STATE_IN_FLIGHT]
+            conn.execute(
+                f"UPDATE images SET state=? WHERE state IN ({','.join('?' * len(requeue))})",
+                (STATE_QUEUED, *requeue),
+            )
+            pending = conn.execute(
+                "SELECT COUNT(*) FROM images WHERE state != ?", (STATE_DONE,)
+            ).fetchone()[0]
+            if pending == 0:
+                conn.execute("DELETE FROM meta WHERE key='walk_complete'")
+            conn.commit()
+            return _counts(conn)
+        return await self._call(_open)
+
+    async def walk_complete(self) -> bool:
+        def _get(conn):
+            return conn.execute("SELECT 1 FROM meta WHERE key='walk_complete'").fetchone() is not None
+        return await self._call(_get)
+
+    async def mark_walk_complete(self) -> None:
+        await self.flush_queued()
+
+        def _set(conn):
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('walk_complete', ?)", (str(time.time()),))
+            conn.commit()
+        await self._call(_set)
+
+    async def is_done(self, path: str) -> bool:
+        def _get(conn, path):
+            row = conn.execute("SELECT state FROM images WHERE path=?", (path,)).fetchone()
+            return row is not None and row[0] == STATE_DONE
+        return await self._call(_get, path)
+
+    async def add_queued(self, path: str) -> None:
+        """Record a newly discovered image. Inserts are batched; existing rows are left as they are."""
+        self._queued_buffer.append(path)
+        if len(self._queued_buffer) >= self.QUEUE_FLUSH_SIZE:
+            await self.flush_queued()
+
+    async def flush_queued(self) -> None:
+        if not self._queued_buffer:
+            return
+        paths, self._queued_buffer = self._queued_buffer, []
+
+        def _insert(conn, rows):
+            conn.executemany(
+                "INSERT OR IGNORE INTO images (path, state, queued_at) VALUES (?, ?, ?)", rows
+            )
+            conn.commit()
+        now = time.time()
+        await self._call(_insert, [(p, STATE_QUEUED, now) for p in paths])
+
+    async def mark_in_flight(self, path: str) -> None:
+        def _set(conn, path, now):
+            conn.execute(
+                "INSERT INTO images (path, state, attempts, queued_at, started_at) VALUES (?, ?, 1, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET state=excluded.state, attempts=attempts+1, "
+                "started_at=excluded.started_at, finished_at=NULL, error=NULL",
+                (path, STATE_IN_FLIGHT, now, now),
+            )
+            conn.commit()
+        await self._call(_set, path, time.time())
+
+    async def mark_done(self, path: str, prompt_tokens: int = 0, completion_tokens: int = 0) -> None:
+        # Upserts: cache hits and prefetch failures often finish while the image is
+        # still in the add_queued buffer, before it has a row to update.
+        def _set(conn, row):
+            conn.execute(
+                "INSERT INTO images (path, state, queued_at, finished_at, prompt_tokens, completion_tokens) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET state=excluded.state, finished_at=excluded.finished_at, "
+                "prompt_tokens=excluded.prompt_tokens, completion_tokens=excluded.completion_tokens, error=NULL",
+                row,
+            )
+            conn.commit()
+        now = time.time()
+        await self._call(_set, (path, STATE_DONE, now, now, prompt_tokens, completion_tokens))
+
+    async def mark_failed(self, path: str, error: str) -> None:
+        def _set(conn, row):
+            conn.execute(
+                "INSERT INTO images (path, state, queued_at, finished_at, error) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET state=excluded.state, finished_at=excluded.finished_at, "
+                "error=excluded.error",
+                row,
+            )
+            conn.commit()
+        now = time.time()
+        await self._call(_set, (path, STATE_FAILED, now, now, error))
+
+    async def iter_queued(self, page_size: int = 1000) -> AsyncGenerator[str, None]:
+        """Yield queued image paths in discovery order, paging through the table by rowid."""
+        def _page(conn, after_rowid):
+            return conn.execute(
+                "SELECT rowid, path FROM images WHERE state=? AND rowid>? ORDER BY rowid LIMIT ?",
+                (STATE_QUEUED, after_rowid, page_size),
+            ).fetchall()
+        last_rowid = 0
+        while True:
+            rows = await self._call(_page, last_rowid)
+            if not rows:
+                return
+            for rowid, path in rows:
+                last_rowid = rowid
+                yield path
+
+    async def counts(self) -> Dict[str, int]:
+        return await self._call(_counts)
+
+
+def _counts(conn) -> Dict[str, int]:
+    counts = {STATE_QUEUED: 0, STATE_IN_FLIGHT: 0, STATE_DONE: 0, STATE_FAILED: 0}
+    for state, count in conn.execute("SELECT state, COUNT(*) FROM images GROUP BY state"):
+        counts[state] = count
+    return counts
+
+
+def open_run_ledger(conf) -> Optional[RunLedger]:
+    """Open the ledger configured by run_ledger_file, or None if the ledger is off."""
+    ledger_file = conf.get("run_ledger_file", "")
+    if not ledger_file:
+        return None
+    return RunLedger(ledger_file)
@@ -0,0 +1,210 @@
+"""
+Caption output collected into a few large shard files instead of one sidecar per
+image: JSONL shards (one {"image_path", "text", "model", "prompt"} object per
+line), or webdataset-style tar shards (a <key>.txt caption and a <key>.json with
+the image path, model and prompt per sample). An index next to the shards
+records which image and (model, prompt) pairs they hold, for skip checks.
+Several workers may write to one shard directory, e.g. on a network share.
+"""
+
+import io
+import os
+import re
+import json
+import time
+import asyncio
+import tarfile
+from typing import Dict, List, Optional
+
+from file_utils.caption_index import caption_key
+from file_utils.sqlite_store import SqliteStore
+
+OUTPUT_FORMAT_JSONL_SHARDS = "jsonl_shards"
+OUTPUT_FORMAT_TAR_SHARDS = "tar_shards"
+SHARD_FORMATS = (OUTPUT_FORMAT_JSONL_SHARDS, OUTPUT_FORMAT_TAR_SHARDS)
+
+DEFAULT_SHARD_MB = 256
+DEFAULT_SHARD_PREFIX = "captions"
+
+
+class ShardOutput(SqliteStore):
+    """Rolling, size-bounded shard files plus the index of what they contain.
+
+    write() queues a caption and returns once it is in a shard and in the index.
+    Captions that arrive while a batch is being written are written together as
+    the next batch, all on the store thread, so there is one file append and one
+    index commit per batch rather than per caption. A shard is closed once it
+    reaches max_bytes or max_records and the next one is started. Every run
+    starts a new shard, so shards left by an earlier (possibly interrupted) run
+    are never appended to; a shard number another worker took first is skipped.
+    The index is only updated after the data it points to has been written.
+
+    Image paths are indexed relative to base_directory (default: the shard
+    directory), so workers that mount a share at different paths agree on them.
+    The index uses a rollback journal rather than WAL, which needs shared memory
+    that network filesystems do not provide.
+    """
+
+    JOURNAL_MODE = "DELETE"
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS entries (
+        image_path TEXT NOT NULL,
+        key TEXT NOT NULL,
+        shard TEXT NOT NULL,
+        PRIMARY KEY (image_path, key)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS shards (
+        name TEXT PRIMARY KEY,
+        records INTEGER NOT NULL,
+        bytes INTEGER NOT NULL,
+        updated REAL NOT NULL
+    );
+    """
+
+    def __init__(self, directory: str, output_format: str = OUTPUT_FORMAT_JSONL_SHARDS,
+                 prefix: str = DEFAULT_SHARD_PREFIX, max_bytes: int = DEFAULT_SHARD_MB * 1024 * 1024,
+                 max_records: int = 0, base_directory: Optional[str] = None):
+        if output_format not in SHARD_FORMATS:
+            raise ValueError(f"Unknown shard output format '{output_format}', expected one of {', '.join(SHARD_FORMATS)}")
+        super().__init__(os.path.join(directory, f"{prefix}-index.sqlite"))
+        self.directory = directory
+        self.base_directory = os.path.abspath(base_directory or directory)
+        self.output_format = output_format
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.extension = "tar" if output_format == OUTPUT_FORMAT_TAR_SHARDS else "jsonl"
+        self.batches = 0
+        self._pending: List = []
+        self._flushing: Optional[asyncio.Task] = None
+        # Current shard, only touched on the store thread
+        self._number: Optional[int] = None
+        self._file = None
+        self._tar: Optional[tarfile.TarFile] = None
+        self._records = 0
+
+    @property
+    def shard_name(self) -> str:
+        return f"{self.prefix}-{self._number:06d}.{self.extension}"
+
+    def relative(self, image_path: str) -> str:
+        path = os.path.relpath(os.path.abspath(image_path), self.base_directory)
+        return os.path.normcase(path).replace("\\", "/")
+
+    async def contains(self, image_path: str, model: str, concat_prompt: str) -> bool:
+        return (await self.contains_many([image_path], model, concat_prompt))[0]
+
+    async def contains_many(self, image_paths: List[str], model: str, concat_prompt: str) -> List[bool]:
+        """Whether each image already has a caption for model and prompt in the shards."""
+        def _contains_many(conn, paths, key):
+            return [conn.execute("SELECT 1 FROM entries WHERE image_path=? AND key=?", (path, key)).fetchone() is not None
+                    for path in paths]
+        return await self._call(_contains_many, [self.relative(p) for p in image_paths], caption_key(model, concat_prompt))
+
+    async def write(self, image_path: str, caption_text: str, model: str, concat_prompt: str) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(({"image_path": image_path, "text": caption_text, "model": model, "prompt": concat_prompt}, future))
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.ensure_future(self._flush())
+        await future
+
+    async def _flush(self) -> None:
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                await self._call(self._commit, [entry for entry, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+
+    def _next_number(self, conn) -> int:
+        pattern = re.compile(rf"^{re.escape(self.prefix)}-(\d+)\.(jsonl|tar)$")
+        numbers = [int(m.group(1)) for m in map(pattern.match, os.listdir(self.directory)) if m]
+        numbers += [int(m.group(1)) for m in (pattern.match(row[0]) for row in conn.execute("SELECT name FROM shards")) if m]
+        return max(numbers, default=-1) + 1
+
+    def _open_shard(self, conn) -> None:
+        self._number = self._next_number(conn)
+        while True:
+            try:
+                self._file = open(os.path.join(self.directory, self.shard_name), "xb")
+                break
+            except FileExistsError:
+                # Another worker writing to this directory started the same shard first
+                self._number += 1
+        if self.output_format == OUTPUT_FORMAT_TAR_SHARDS:
+            self._tar = tarfile.open(fileobj=self._file, mode="w", format=tarfile.PAX_FORMAT)
+        self._records = 0
+
+    def _close_shard(self) -> None:
+        if self._tar is not None:
+            self._tar.close()
+            self._tar = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _append(self, entry: Dict) -> None:
+        if self._tar is None:
+            self._file.write((json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8"))
+            return
+        key = f"{self._number:06d}_{self._records:07d}"
+        metadata = {"image_path": entry["image_path"], "model": entry["model"], "prompt": entry["prompt"]}
+        for name, data in ((f"{key}.txt", entry["text"].encode("utf-8")),
+                           (f"{key}.json", json.dumps(metadata, ensure_ascii=False).encode("utf-8"))):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self._tar.addfile(info, io.BytesIO(data))
+
+    def _commit(self, conn, entries: List[Dict]) -> None:
+        """Append one batch to the shards and index it. Runs on the store thread."""
+        rows = []
+        for entry in entries:
+            if self._file is None:
+                self._open_shard(conn)
+            self._append(entry)
+            self._records += 1
+            rows.append((self.relative(entry["image_path"]), caption_key(entry["model"], entry["prompt"]), self.shard_name))
+            size = self._file.tell()
+            conn.execute("INSERT OR REPLACE INTO shards VALUES (?, ?, ?, ?)", (self.shard_name, self._records, size, time.time()))
+            if size >= self.max_bytes or (self.max_records and self._records >= self.max_records):
+                self._close_shard()
+        if self._file is not None:
+            self._file.flush()
+        conn.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", rows)
+        conn.commit()
+        self.batches += 1
+
+    def close(self) -> None:
+        self._executor.submit(self._close_shard).result()
+        super().close()
+
+
+def open_shard_output(conf) -> Optional[ShardOutput]:
+    """Open the shard output when output_format is one of the shard formats, else None.
+
+    Settings come from the optional shard_output section: directory (default: a
+    caption_shards folder in base_directory), prefix, max_mb and max_records.
+    The index holds image paths relative to base_directory.
+    """
+    output_format = conf.get("output_format", "txt")
+    if output_format not in SHARD_FORMATS:
+        return None
+    settings = conf.get("shard_output", None) or {}
+    directory = settings.get("directory", None) or os.path.join(conf.base_directory, "caption_shards")
+    os.makedirs(directory, exist_ok=True)
+    return ShardOutput(
+        directory,
+        output_format,
+        prefix=settings.get("prefix", DEFAULT_SHARD_PREFIX),
+        max_bytes=int(settings.get("max_mb", DEFAULT_SHARD_MB) * 1024 * 1024),
+        max_records=settings.get("max_records", 0),
+        base_directory=conf.base_directory,
+    )
@@ -0,0 +1,58 @@
+import os
+import asyncio
+import sqlite3
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class SqliteStore:
+    """Base for the small SQLite files the captioner keeps (cache, ledger, indexes).
+
+    The connection is created and used only on one dedicated worker thread, so
+    the async methods of subclasses never block the event loop and sqlite's
+    same-thread rule holds without extra locking. Subclasses define SCHEMA and
+    write their queries as plain synchronous functions taking the connection.
+    """
+
+    SCHEMA = ""
+    JOURNAL_MODE = "WAL"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=type(self).__name__)
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute(f"PRAGMA journal_mode={self.JOURNAL_MODE}")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.SCHEMA)
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _invoke(self, fn: Callable, args) -> Any:
+        return fn(self._connection(), *args)
+
+    async def _call(self, fn: Callable[..., Any], *args) -> Any:
+        """Run fn(conn, *args) on the store thread from async code."""
+        loop = asyncio.get_running_loop()
+        # In the caller's context, like asyncio.to_thread, e.g. so a job's prints stay with it
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, context.run, self._invoke, fn, args)
+
+    def _call_sync(self, fn: Callable[..., Any], *args) -> Any:
+        """Run fn(conn, *args) on the store thread from synchronous code."""
+        return self._executor.submit(self._invoke, fn, args).result()
+
+    def close(self) -> None:
+        def _close(conn):
+            conn.close()
+            self._conn = None
+        if self._conn is not None:
+            self._call_sync(_close)
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,130 @@
+"""
+On-disk snapshot of directory listings, so walking an unchanged tree again
+costs one stat per directory instead of one full listing per directory.
+"""
+
+import os
+import json
+import time
+from typing import List, Optional, Tuple
+
+from file_utils.sqlite_store import SqliteStore
+
+# (path, is_dir, is_file), as returned by file_access._scan_dir
+Entry = Tuple[str, bool, bool]
+
+# A listing taken less than this long after the directory's mtime is not trusted:
+# on file systems with coarse timestamps (FAT's 2 s, some SMB servers) an entry
+# added in the same tick leaves the mtime unchanged.
+RACY_NS = 3_000_000_000
+
+
+def _norm(path: str) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+def _dir_mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class WalkSnapshot(SqliteStore):
+    """Each directory's listing, stored with the directory's mtime.
+
+    A directory's mtime changes whenever an entry is added, removed or renamed
+    in it, so a listing whose stored mtime still matches is served from the
+    snapshot; anything else is listed again and replaces the stored one. The
+    mtime is read before listing, so a directory that changes mid-listing is
+    simply listed again next time. As in git's racy index check, a listing
+    started within RACY_NS of the directory's mtime is listed again on the next
+    walk too, since an entry added in the same timestamp tick would not have
+    changed the mtime; by then the new listing is far enough past it to be
+    trusted. Changes inside files (e.g. a jsonl sidecar
+    being appended to) do not show up here; the caption index covers those.
+
+    listing() is synchronous and meant to run on the walker's threads; the
+    store's own thread serializes the database access.
+    """
+
+    SCHEMA = """
+    DROP TABLE IF EXISTS dirs;
+    CREATE TABLE IF NOT EXISTS listings (
+        path TEXT PRIMARY KEY,
+        mtime_ns INTEGER NOT NULL,
+        listed_ns INTEGER NOT NULL,
+        entries TEXT NOT NULL
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.hits = 0
+        self.misses = 0
+
+    def listing(self, directory: str, scan) -> List[Entry]:
+        """The entries of directory, from the snapshot if it is unchanged, otherwise
+        from scan(directory), which is then stored."""
+        mtime = _dir_mtime(directory)
+        if mtime is None:
+            return scan(directory)
+        key = _norm(directory)
+
+        def _get(conn):
+            row = conn.execute("SELECT mtime_ns, listed_ns, entries FROM listings WHERE path=?", (key,)).fetchone()
+            if row is None or row[0] != mtime or row[1] - row[0] < RACY_NS:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[2]
+
+        stored = self._call_sync(_get)
+        if stored is not None:
+            return [(os.path.join(directory, name), is_dir, is_file) for name, is_dir, is_file in json.loads(stored)]
+
+        listed = time.time_ns()
+        entries = scan(directory)
+        names = [(os.path.basename(path), is_dir, is_file) for path, is_dir, is_file in entries]
+
+        def _put(conn):
+            conn.execute("INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)", (key, mtime, listed, json.dumps(names)))
+            conn.commit()
+
+        self._call_sync(_put)
+        return entries
+
+    async def count_images(self, base_directory: str, recursive: bool, extensions: Tuple[str, ...],
+                           uncaptioned_txt: bool = False) -> Optional[int]:
+        """Number of images under base_directory as of the last walk, without touching
+        the file system, or None if the snapshot has never seen base_directory.
+        With uncaptioned_txt, images that have a .txt sidecar are not counted."""
+        def _count(conn):
+            total = 0
+            pending = [_norm(base_directory)]
+            seen_base = False
+            while pending:
+                directory = pending.pop()
+                row = conn.execute("SELECT entries FROM listings WHERE path=?", (directory,)).fetchone()
+                if row is None:
+                    continue
+                seen_base = True
+                entries = json.loads(row[0])
+                files = {name.lower() for name, _, is_file in entries if is_file}
+                for name, is_dir, is_file in entries:
+                    if is_dir and recursive:
+                        pending.append(_norm(os.path.join(directory, name)))
+                    elif is_file and name.lower().endswith(extensions):
+                        if uncaptioned_txt and f"{os.path.splitext(name)[0]}.txt".lower() in files:
+                            continue
+                        total += 1
+            return total if seen_base else None
+        return await self._call(_count)
+
+
+def open_walk_snapshot(conf) -> Optional[WalkSnapshot]:
+    """Open the snapshot configured by walk_snapshot_file, or None when it is not set."""
+    snapshot_file = conf.get("walk_snapshot_file", "")
+    if not snapshot_file:
+        return None
+    return WalkSnapshot(snapshot_file)
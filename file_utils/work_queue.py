@@ -0,0 +1,284 @@
+"""
+Shared work queue for several workers captioning one dataset: a SQLite file on
+the dataset share from which each worker claims batches of images under a lease
+that it keeps renewing while it works.
+"""
+
+import os
+import time
+import uuid
+import socket
+import asyncio
+import hashlib
+from typing import Dict, List, Optional
+
+from file_utils.sqlite_store import SqliteStore
+
+STATE_QUEUED = "queued"
+STATE_LEASED = "leased"
+STATE_DONE = "done"
+STATE_FAILED = "failed"
+
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_CLAIM_SIZE = 16
+DEFAULT_MAX_ATTEMPTS = 3
+
+
+def queue_job_key(conf, concat_prompt: str) -> str:
+    """Identity of the job a queue is for. Unlike the run ledger's, it leaves out
+    base_directory, since every worker may mount the dataset somewhere else."""
+    identity = "\n".join([
+        str(conf.get("recursive", False)),
+        str(conf.get("model", "")),
+        str(conf.get("output_format", "")),
+        concat_prompt,
+    ])
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+
+def default_worker_name() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+class WorkQueue(SqliteStore):
+    """Images of one job, shared by every worker through a file on the dataset share.
+
+    Images are stored by their path relative to base_directory. One worker at a
+    time holds the walk lease and adds the images it finds; meanwhile every
+    worker claims batches of queued images. A claim leases the images to the
+    worker for lease_seconds, and heartbeat() renews all of its leases, so only
+    the images of a worker that stopped renewing (crashed, hung, disconnected)
+    expire and can be claimed by another. The same holds for the walk lease.
+    Done images are never handed out again. An image whose lease expired
+    max_attempts times, or that failed that many times, is marked failed
+    instead of being retried forever.
+
+    Completions that arrive while another one is being committed are committed
+    together, so a busy worker does not pay one network round trip per image.
+    """
+
+    # WAL needs shared memory between the processes using the file, which network
+    # file systems do not provide; the rollback journal works over SMB and NFS.
+    JOURNAL_MODE = "DELETE"
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS items (
+        path TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        worker TEXT,
+        lease_expires REAL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        updated REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS items_state ON items (state, lease_expires);
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    );
+    CREATE TABLE IF NOT EXISTS walk (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        worker TEXT,
+        lease_expires REAL,
+        complete INTEGER NOT NULL DEFAULT 0
+    );
+    """
+
+    def __init__(self, path: str, base_directory: str, worker: Optional[str] = None,
+                 lease_seconds: float = DEFAULT_LEASE_SECONDS, max_attempts: int = DEFAULT_MAX_ATTEMPTS):
+        super().__init__(path)
+        self.base_directory = base_directory
+        self.worker = worker or default_worker_name()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.completed = 0
+        self._pending: List = []
+        self._flushing: Optional[asyncio.Task] = None
+
+    def relative(self, image_path: str) -> str:
+        return os.path.relpath(image_path, self.base_directory).replace("\\", "/")
+
+    def absolute(self, path: str) -> str:
+        return os.path.join(self.base_directory, *path.split("/"))
+
+    async def open_job(self, job_key: str, retry_failed: bool = True) -> Dict[str, int]:
+        """Join the job and return the per-state counts. Raises ValueError if the
+        queue was created for another job, since other workers may still be on it.
+        Once every image is done or failed the walk is opened again, so images
+        added since are found by the next run (done ones stay done), and with
+        retry_failed the failed images are queued again."""
+        def _open(conn):
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT value FROM meta WHERE key='job_key'").fetchone()
+            if row is None:
+                conn.execute("INSERT INTO meta VALUES ('job_key', ?)", (job_key,))
+            elif row[0] == job_key and not conn.execute("SELECT 1 FROM items WHERE state IN (?, ?) LIMIT 1",
+                                                        (STATE_QUEUED, STATE_LEASED)).fetchone():
+                conn.execute("DELETE FROM walk WHERE complete=1")
+                if retry_failed:
+                    conn.execute("UPDATE items SET state=?, attempts=0 WHERE state=?", (STATE_QUEUED, STATE_FAILED))
+            conn.commit()
+            return row is None or row[0] == job_key
+        if not await self._call(_open):
+            raise ValueError(f"Work queue {self.path} belongs to a job with another model, output format or prompts; "
+                             "use a new work_queue_file for this one")
+        return await self.counts()
+
+    async def claim_walk(self) -> bool:
+        """Take the walk lease if nobody holds a live one and the walk is not complete."""
+        def _claim(conn, now):
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT worker, lease_expires, complete FROM walk WHERE id=0").fetchone()
+            if row is not None and (row[2] or (row[0] != self.worker and row[1] >= now)):
+                conn.commit()
+                return False
+            conn.execute("INSERT OR REPLACE INTO walk VALUES (0, ?, ?, 0)", (self.worker, now + self.lease_seconds))
+            conn.commit()
+            return True
+        return await self._call(_claim, time.time())
+
+    async def finish_walk(self) -> None:
+        def _finish(conn):
+            conn.execute("UPDATE walk SET complete=1 WHERE id=0 AND worker=?", (self.worker,))
+            conn.commit()
+        await self._call(_finish)
+
+    async def walk_complete(self) -> bool:
+        def _get(conn):
+            row = conn.execute("SELECT complete FROM walk WHERE id=0").fetchone()
+            return bool(row and row[0])
+        return await self._call(_get)
+
+    async def add(self, image_paths: List[str]) -> int:
+        """Queue newly found images. Images already in the queue, in any state, are left alone."""
+        def _add(conn, rows):
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO items (path, state, updated) VALUES (?, ?, ?)", rows)
+            conn.commit()
+            return conn.total_changes - before
+        now = time.time()
+        return await self._call(_add, [(self.relative(p), STATE_QUEUED, now) for p in image_paths])
+
+    async def claim(self, limit: int = DEFAULT_CLAIM_SIZE) -> List[str]:
+        """Lease up to limit queued images, or images whose lease has expired, to this worker."""
+        def _claim(conn, now):
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("UPDATE items SET state=?, worker=NULL, error='lease expired', updated=? "
+                         "WHERE state=? AND lease_expires<? AND attempts>=?",
+                         (STATE_FAILED, now, STATE_LEASED, now, self.max_attempts))
+            paths = [row[0] for row in conn.execute(
+                "SELECT path FROM items WHERE state=? OR (state=? AND lease_expires<?) LIMIT ?",
+                (STATE_QUEUED, STATE_LEASED, now, limit))]
+            conn.executemany("UPDATE items SET state=?, worker=?, lease_expires=?, attempts=attempts+1, updated=? "
+                             "WHERE path=?",
+                             [(STATE_LEASED, self.worker, now + self.lease_seconds, now, path) for path in paths])
+            conn.commit()
+            return paths
+        return [self.absolute(path) for path in await self._call(_claim, time.time())]
+
+    async def heartbeat(self) -> None:
+        """Renew the leases of every image (and the walk) this worker holds."""
+        def _renew(conn, expires):
+            conn.execute("UPDATE items SET lease_expires=? WHERE state=? AND worker=?",
+                         (expires, STATE_LEASED, self.worker))
+            conn.execute("UPDATE walk SET lease_expires=? WHERE id=0 AND worker=? AND complete=0",
+                         (expires, self.worker))
+            conn.commit()
+        await self._call(_renew, time.time() + self.lease_seconds)
+
+    async def complete(self, image_path: str) -> bool:
+        """Mark an image done once its caption has been written. Returns once committed,
+        with False if this worker's lease on it was lost (it expired and the image
+        was claimed again or failed); the image is then left to its new owner."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((self.relative(image_path), future))
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.ensure_future(self._flush())
+        return await future
+
+    async def _flush(self) -> None:
+        def _done(conn, paths, now):
+            held = [conn.execute("UPDATE items SET state=?, lease_expires=NULL, error=NULL, updated=? "
+                                 "WHERE path=? AND state=? AND worker=?",
+                                 (STATE_DONE, now, path, STATE_LEASED, self.worker)).rowcount == 1
+                    for path in paths]
+            conn.commit()
+            return held
+
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                held = await self._call(_done, [path for path, _ in batch], time.time())
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                self.completed += sum(held)
+                for (_, future), still_held in zip(batch, held):
+                    if not future.done():
+                        future.set_result(still_held)
+
+    async def fail(self, image_path: str, error: str) -> str:
+        """Put a failed image back in the queue for any worker to retry, or mark it
+        failed after max_attempts. Returns its new state. If this worker's lease on
+        it was lost, the image is left alone and its current state is returned."""
+        def _fail(conn, path, now):
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT attempts, state, worker FROM items WHERE path=?", (path,)).fetchone()
+            if row is None or row[1] != STATE_LEASED or row[2] != self.worker:
+                conn.commit()
+                return row[1] if row else STATE_FAILED
+            state = STATE_FAILED if row[0] >= self.max_attempts else STATE_QUEUED
+            conn.execute("UPDATE items SET state=?, worker=NULL, lease_expires=NULL, error=?, updated=? WHERE path=?",
+                         (state, error, now, path))
+            conn.commit()
+            return state
+        return await self._call(_fail, self.relative(image_path), time.time())
+
+    async def release(self) -> int:
+        """Give back the images this worker claimed but did not finish, e.g. when it
+        is stopped, without counting an attempt. Returns how many."""
+        def _release(conn, now):
+            cursor = conn.execute("UPDATE items SET state=?, worker=NULL, lease_expires=NULL, "
+                                  "attempts=MAX(attempts-1, 0), updated=? WHERE state=? AND worker=?",
+                                  (STATE_QUEUED, now, STATE_LEASED, self.worker))
+            conn.execute("UPDATE walk SET lease_expires=0 WHERE id=0 AND worker=? AND complete=0", (self.worker,))
+            conn.commit()
+            return cursor.rowcount
+        return await self._call(_release, time.time())
+
+    async def remaining(self) -> int:
+        """Images not finished yet: queued, or leased to some worker."""
+        def _remaining(conn):
+            return conn.execute("SELECT COUNT(*) FROM items WHERE state IN (?, ?)", (STATE_QUEUED, STATE_LEASED)).fetchone()[0]
+        return await self._call(_remaining)
+
+    async def counts(self) -> Dict[str, int]:
+        def _counts(conn):
+            counts = {state: 0 for state in (STATE_QUEUED, STATE_LEASED, STATE_DONE, STATE_FAILED)}
+            counts.update(conn.execute("SELECT state, COUNT(*) FROM items GROUP BY state").fetchall())
+            return counts
+        return await self._call(_counts)
+
+
+def format_queue_counts(counts: Dict[str, int]) -> str:
+    return ", ".join(f"{counts[state]} {state}" for state in (STATE_DONE, STATE_QUEUED, STATE_LEASED, STATE_FAILED))
+
+
+def open_work_queue(conf) -> Optional[WorkQueue]:
+    """Open the queue at work_queue_file, or None when it is not set. Settings come
+    from the optional work_queue section: lease_seconds, max_attempts and worker
+    (a name for this worker, by default host name and process id); claim_size,
+    heartbeat_seconds, poll_seconds and retry_failed are read by the run itself."""
+    queue_file = conf.get("work_queue_file", "")
+    if not queue_file:
+        return None
+    settings = conf.get("work_queue", None) or {}
+    return WorkQueue(
+        queue_file,
+        conf.base_directory,
+        worker=settings.get("worker", None),
+        lease_seconds=settings.get("lease_seconds", DEFAULT_LEASE_SECONDS),
+        max_attempts=settings.get("max_attempts", DEFAULT_MAX_ATTEMPTS),
+    )
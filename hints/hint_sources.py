@@ -1,41 +1,62 @@
 """
 Hint sources module for providing additional context to image captioning prompts.
 Each hint source can provide specific information that gets prepended to the first prompt.
+
+Hint functions may be plain functions or `async def` coroutine functions. Plain
+functions are run on a worker thread by get_hints_async so slow storage does
+not stall the event loop; coroutine functions are awaited directly.
 """
 
+import asyncio
+import inspect
 from typing import List, Optional
 from .registration import HINT_FUNCTIONS
 
 
-def get_hints(hint_sources_config: List[str], image_path: str, **kwargs) -> Optional[str]:
+async def _call_hint(hint_function, image_path: str, **kwargs) -> Optional[str]:
+    if inspect.iscoroutinefunction(hint_function):
+        return await hint_function(image_path, **kwargs)
+    return await asyncio.to_thread(hint_function, image_path, **kwargs)
+
+
+async def get_hints_async(hint_sources_config: List[str], image_path: str, **kwargs) -> Optional[str]:
     """
-    Main function to collect all hints based on configuration.
-    
+    Collect all hints based on configuration, running the hint sources concurrently.
+
     Args:
         hint_sources_config: List of hint source names from configuration
         image_path: Path to the image being processed
         **kwargs: Additional parameters for hint sources
-        
+
     Returns:
-        Combined hint text to prepend to the first prompt, or None if no hints
+        Combined hint text (in configuration order) to prepend to the first prompt, or None if no hints
     """
     if not hint_sources_config:
         return None
-        
-    hints = []
-    
-    # Use the centralized hint functions registry
+
+    names = []
+    calls = []
     for hint_source in hint_sources_config:
         if hint_source in HINT_FUNCTIONS:
-            try:
-                hint_text = HINT_FUNCTIONS[hint_source](image_path, **kwargs)
-                if hint_text:
-                    hints.append(hint_text)
-            except Exception as e:
-                print(f"Warning: Failed to get hint from '{hint_source}': {e}")
+            names.append(hint_source)
+            calls.append(_call_hint(HINT_FUNCTIONS[hint_source], image_path, **kwargs))
         else:
             print(f"Warning: Unknown hint source '{hint_source}' - skipping")
-    
+
+    hints = []
+    for hint_source, hint_text in zip(names, await asyncio.gather(*calls, return_exceptions=True)):
+        if isinstance(hint_text, BaseException):
+            print(f"Warning: Failed to get hint from '{hint_source}': {hint_text}")
+        elif hint_text:
+            hints.append(hint_text)
+
     if hints:
         return "\n".join(hints)
     return None
+
+
+def get_hints(hint_sources_config: List[str], image_path: str, **kwargs) -> Optional[str]:
+    """
+    Synchronous version of get_hints_async, for use outside of an event loop.
+    """
+    return asyncio.run(get_hints_async(hint_sources_config, image_path, **kwargs))
@@ -6,10 +6,50 @@ for both the main captioning script and the GUI interface.
 
 import os
 import json
-from typing import Dict, Callable, Optional, Any
+import asyncio
+import threading
+import aiofiles
+from collections import OrderedDict
+from typing import Dict, Callable, Optional, Any, Tuple
 
-# Cache for metadata to avoid re-reading
-_metadata_cache: Dict[str, Optional[Dict[str, Any]]] = {}
+# Directories whose metadata.json is kept in memory; least recently used are dropped first
+METADATA_CACHE_SIZE = 1024
+
+
+class _LRUCache:
+    """Small least-recently-used cache, bounded by number of entries."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, Any]" = OrderedDict()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> Any:
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key: str, value: Any) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+async def _read_json(path: str) -> Optional[Any]:
+    """Parsed contents of a json file, or None if it does not exist. Raises on bad json."""
+    try:
+        async with aiofiles.open(path, 'r', encoding='utf-8') as f:
+            return json.loads(await f.read())
+    except FileNotFoundError:
+        return None
 
 def get_full_path_hint(image_path: str, **kwargs) -> str:
     """
@@ -29,7 +69,7 @@ def get_full_path_hint(image_path: str, **kwargs) -> str:
 
     return hint_text
 
-def get_json_hint(image_path: str, **kwargs) -> Optional[str]:
+async def get_json_hint(image_path: str, **kwargs) -> Optional[str]:
     """
     Returns hint text from the [image].json
     
@@ -42,15 +82,11 @@ def get_json_hint(image_path: str, **kwargs) -> Optional[str]:
     """
     normalized_path = os.path.normpath(image_path)
     json_path = os.path.splitext(normalized_path)[0] + ".json"
-    metadata = None
-
-    if os.path.exists(json_path):
-        try:
-            with open(json_path, 'r', encoding='utf-8') as f:
-                metadata = json.load(f)
-        except (json.JSONDecodeError, IOError) as e:
-            print(f"Warning: Failed to read or parse {json_path}: {e}")
-            metadata = None
+    try:
+        metadata = await _read_json(json_path)
+    except (json.JSONDecodeError, IOError) as e:
+        print(f"Warning: Failed to read or parse {json_path}: {e}")
+        metadata = None
 
     if metadata:    
         hint_text = f"Json Metadata:\n"
@@ -59,13 +95,74 @@ def get_json_hint(image_path: str, **kwargs) -> Optional[str]:
 
     return None
 
-def get_metadata_hint(image_path: str, **kwargs) -> Optional[str]:
+async def _load_metadata(image_dir: str) -> Optional[Dict[str, Any]]:
+    try:
+        return await _read_json(os.path.join(image_dir, "metadata.json"))
+    except (json.JSONDecodeError, IOError) as e:
+        print(f"Warning: Failed to read or parse metadata.json in {image_dir}: {e}")
+        return None
+
+
+class HintCache:
+    """Metadata read by the hint sources during one run, so every image of a
+    directory does not read its metadata.json again. Each run (a CLI run, a web
+    app job, a batch export) makes its own and passes it to get_hints_async as
+    hint_cache, so runs side by side never see or clear each other's entries.
+
+    Images of one directory being prepared at the same time share a single read.
+    That read is a future of the event loop that started it, so in-flight reads
+    are kept per loop: a caller on another loop starts its own instead of
+    awaiting a future it cannot use. Entries are guarded by a lock, as plain
+    hint functions run on worker threads.
+    """
+
+    def __init__(self, maxsize: int = METADATA_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._metadata = _LRUCache(maxsize)
+        self._loading: Dict[Tuple[asyncio.AbstractEventLoop, str], "asyncio.Future[Optional[Dict[str, Any]]]"] = {}
+
+    def __contains__(self, image_dir: str) -> bool:
+        with self._lock:
+            return image_dir in self._metadata
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._metadata)
+
+    async def metadata(self, image_dir: str) -> Optional[Dict[str, Any]]:
+        """Parsed metadata.json of image_dir, or None if it has none (also cached)."""
+        loop = asyncio.get_running_loop()
+        key = (loop, image_dir)
+        with self._lock:
+            if image_dir in self._metadata:
+                return self._metadata.get(image_dir)
+            loading = self._loading.get(key)
+            if loading is None:
+                loading = loop.create_task(self._load(image_dir))
+                self._loading[key] = loading
+                loading.add_done_callback(lambda _: self._forget(key))
+        # shield: one waiter being cancelled must not cancel the read the others share
+        return await asyncio.shield(loading)
+
+    async def _load(self, image_dir: str) -> Optional[Dict[str, Any]]:
+        metadata = await _load_metadata(image_dir)
+        with self._lock:
+            self._metadata.put(image_dir, metadata)
+        return metadata
+
+    def _forget(self, key: Tuple[asyncio.AbstractEventLoop, str]) -> None:
+        with self._lock:
+            self._loading.pop(key, None)
+
+
+async def get_metadata_hint(image_path: str, hint_cache: Optional[HintCache] = None, **kwargs) -> Optional[str]:
     """
     Reads metadata.json from the image's directory and includes it as context.
-    Uses caching to avoid re-reading the same directory's metadata.
+    With a hint_cache, the run's images share one read per directory.
     
     Args:
         image_path: Full path to the image file
+        hint_cache: The run's HintCache, if any; without one the file is read every time
         **kwargs: Additional parameters (unused for this hint source)
         
     Returns:
@@ -73,22 +170,10 @@ def get_metadata_hint(image_path: str, **kwargs) -> Optional[str]:
     """
     image_dir = os.path.dirname(os.path.normpath(image_path))
     
-    if image_dir in _metadata_cache:
-        metadata = _metadata_cache[image_dir]
+    if hint_cache is not None:
+        metadata = await hint_cache.metadata(image_dir)
     else:
-        metadata_path = os.path.join(image_dir, "metadata.json")
-        metadata = None
-        
-        if os.path.exists(metadata_path):
-            try:
-                with open(metadata_path, 'r', encoding='utf-8') as f:
-                    metadata = json.load(f)
-            except (json.JSONDecodeError, IOError) as e:
-                print(f"Warning: Failed to read or parse metadata.json in {image_dir}: {e}")
-                metadata = None
-        
-        # Cache the result (even if None)
-        _metadata_cache[image_dir] = metadata
+        metadata = await _load_metadata(image_dir)
     
     # Return formatted hint if metadata exists
     if metadata:
@@ -0,0 +1,111 @@
+import time
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from metrics.timing import RunMetrics
+
+# Event types. Every event is a JSON-ready dict with "type" and "time" (unix
+# seconds); EventBuffer adds "seq", its offset in the run's event stream.
+RUN_STARTED = "run_started"
+IMAGE_DONE = "image_done"
+IMAGE_FAILED = "image_failed"
+PROGRESS = "progress"
+RUN_FINISHED = "run_finished"
+LOG = "log"
+STATUS = "status"  # complete, cancelled or error, from app.py once main() returns
+
+# Progress events are sent at most this often (seconds), and always at the end.
+PROGRESS_EVENT_INTERVAL = 1.0
+
+EventSink = Callable[[Dict], None]
+
+
+class EventBuffer:
+    """Bounded ring buffer of events, numbered from 0 for as long as the buffer
+    lives. Readers keep their own offset and can come back later (e.g. a client
+    that reconnected) to replay from it, as long as the events are still in the
+    buffer; older ones are dropped once capacity is reached. append() is the
+    event sink: it only takes a lock, so it can be called from the captioning
+    event loop while request threads wait on the buffer."""
+
+    def __init__(self, capacity: int = 10000):
+        self._events: Deque[Dict] = deque(maxlen=capacity)
+        self._next = 0
+        self._changed = threading.Condition()
+
+    @property
+    def end(self) -> int:
+        """Offset of the next event to be appended."""
+        with self._changed:
+            return self._next
+
+    def append(self, event: Dict) -> None:
+        with self._changed:
+            self._events.append(dict(event, seq=self._next))
+            self._next += 1
+            self._changed.notify_all()
+
+    def read(self, offset: int, limit: int = 500) -> Tuple[List[Dict], int, int]:
+        """Up to limit events from offset on. Returns the events, the offset to
+        read from next and how many events after offset were already dropped."""
+        with self._changed:
+            first = self._next - len(self._events)
+            dropped = max(0, first - offset)
+            start = max(offset, first) - first
+            events = [self._events[i] for i in range(start, min(len(self._events), start + limit))]
+            return events, max(offset, first) + len(events), dropped
+
+    def wait(self, offset: int, timeout: float) -> bool:
+        """Block until there are events at or after offset, or timeout. Returns
+        whether there are."""
+        with self._changed:
+            return self._changed.wait_for(lambda: self._next > offset, timeout)
+
+
+class ProgressEvents:
+    """Typed progress events of one run, handed to a sink. Without a sink every
+    method is a no-op, so the CLI pays nothing for them."""
+
+    def __init__(self, sink: Optional[EventSink] = None):
+        self.sink = sink
+        self._last_progress = 0.0
+
+    def emit(self, event_type: str, **fields) -> None:
+        if self.sink is not None:
+            self.sink({"type": event_type, "time": round(time.time(), 3), **fields})
+
+    def run_started(self, base_directory: str, concurrency: int, endpoints: List[str]) -> None:
+        self.emit(RUN_STARTED, base_directory=base_directory, concurrency=concurrency, endpoints=endpoints)
+
+    def image_finished(self, result: Dict) -> None:
+        """One result dict from write_image."""
+        if self.sink is None:
+            return
+        if not result["success"]:
+            self.emit(IMAGE_FAILED, image_path=result["image_path"], error=result.get("error", ""))
+            return
+        timing = result.get("timing") or {}
+        self.emit(
+            IMAGE_DONE,
+            image_path=result["image_path"],
+            cached=result.get("cached", False),
+            prompt_tokens=result.get("prompt_token_usage", 0),
+            completion_tokens=result.get("completion_token_usage", 0),
+            seconds=round(result.get("processing_time", 0.0), 3),
+            stages=timing.get("stages", {}),
+        )
+
+    def progress(self, metrics: RunMetrics, force: bool = False) -> None:
+        """Counts, throughput and ETA so far, at most every PROGRESS_EVENT_INTERVAL
+        seconds unless forced."""
+        if self.sink is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_progress < PROGRESS_EVENT_INTERVAL:
+            return
+        self._last_progress = now
+        self.emit(PROGRESS, **metrics.snapshot())
+
+    def run_finished(self, totals: Dict, cancelled: bool = False) -> None:
+        self.emit(RUN_FINISHED, cancelled=cancelled, **totals)
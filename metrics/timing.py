@@ -0,0 +1,326 @@
+import json
+import math
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from scheduling.turns import TurnObserver
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# Per-image records are written to the metrics file in batches of this many, or this often (seconds)
+DEFAULT_FLUSH_RECORDS = 64
+DEFAULT_FLUSH_INTERVAL = 5.0
+
+
+class ImageTimer(TurnObserver):
+    """Timing of one image: wall time per stage (read, hash, cache, encode, hints,
+    turns, retry_rules, save) and the stats of every chat turn it sent. Passed to
+    stream_chat_turn as an observer alongside the run-wide ones."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.turns: List[dict] = []
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def after_turn(self, request: dict, stats: dict) -> None:
+        self.turns.append({key: stats[key] for key in
+                           ("ttft", "latency", "prompt_tokens", "completion_tokens", "tokens_per_s")})
+
+    def record(self) -> dict:
+        return {
+            "total": round(time.perf_counter() - self.started, 4),
+            "stages": {name: round(seconds, 4) for name, seconds in self.stages.items()},
+            "turns": [{key: round(value, 4) if isinstance(value, float) else value for key, value in turn.items()}
+                      for turn in self.turns],
+        }
+
+
+def quantile(sorted_values: Sequence[float], q: float) -> float:
+    """Nearest-rank quantile of an already sorted, non-empty sequence."""
+    rank = max(1, math.ceil(q * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class _Series:
+    """Rolling window of samples for quantiles, plus run-wide sum and count."""
+
+    def __init__(self, window: int):
+        self.samples: Deque[float] = deque(maxlen=window)
+        self.sum = 0.0
+        self.count = 0
+
+    def add(self, value: float) -> None:
+        self.samples.append(value)
+        self.sum += value
+        self.count += 1
+
+    def quantiles(self) -> Dict[float, float]:
+        values = sorted(self.samples)
+        return {q: quantile(values, q) for q in QUANTILES} if values else {}
+
+
+class RunMetrics:
+    """Aggregated timing of a captioning run.
+
+    Every finished image is observed once. Quantiles are over the last `window`
+    images (or turns), throughput is over the last `window` completions, and the
+    ETA is known once the walk has found every image, or earlier from an
+    expected image count. With jsonl_path set, each image's timing record is
+    appended to that file as one JSON line: observe() only buffers the record,
+    and flush() writes the buffer on a worker thread once flush_records are
+    waiting or flush_interval seconds have passed, so the event loop never
+    waits on the disk. Updated from the captioning event loop and read from
+    app.py's request threads, hence the lock.
+    """
+
+    def __init__(self, window: int = 1000, jsonl_path: Optional[str] = None,
+                 flush_records: int = DEFAULT_FLUSH_RECORDS, flush_interval: float = DEFAULT_FLUSH_INTERVAL):
+        self._lock = threading.Lock()
+        self.window = window
+        self.started = time.monotonic()
+        self.outcomes = {"done": 0, "failed": 0, "cached": 0}
+        self.tokens = {"prompt": 0, "completion": 0}
+        self.discovered = 0
+        self.expected = 0
+        self.walk_done = False
+        self._completions: Deque[float] = deque(maxlen=window)
+        self._image = _Series(window)
+        self._stages: Dict[str, _Series] = {}
+        self._ttft = _Series(window)
+        self._tokens_per_s = _Series(window)
+        self._file = open(jsonl_path, "a", encoding="utf-8") if jsonl_path else None
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self._records: List[str] = []
+        self._flushed = time.monotonic()
+        self._write_lock = asyncio.Lock()
+
+    def image_discovered(self) -> None:
+        with self._lock:
+            self.discovered += 1
+
+    def expect_images(self, count: int) -> None:
+        """Estimated number of images in the run, known before the walk finishes."""
+        with self._lock:
+            self.expected = count
+
+    def walk_complete(self) -> None:
+        with self._lock:
+            self.walk_done = True
+
+    def observe(self, result: dict) -> None:
+        """Record one result dict from write_image."""
+        timing = result.get("timing") or {}
+        with self._lock:
+            self._completions.append(time.monotonic())
+            if not result["success"]:
+                self.outcomes["failed"] += 1
+            else:
+                self.outcomes["cached" if result.get("cached") else "done"] += 1
+                self.tokens["prompt"] += result.get("prompt_token_usage", 0)
+                self.tokens["completion"] += result.get("completion_token_usage", 0)
+                if not result.get("cached") and timing:
+                    self._image.add(timing["total"])
+                    for stage, seconds in timing["stages"].items():
+                        self._stages.setdefault(stage, _Series(self.window)).add(seconds)
+                    for turn in timing["turns"]:
+                        self._ttft.add(turn["ttft"])
+                        if turn["tokens_per_s"]:
+                            self._tokens_per_s.add(turn["tokens_per_s"])
+
+        if self._file is not None:
+            record = {
+                "time": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+                "image_path": result["image_path"],
+                "success": result["success"],
+                "cached": result.get("cached", False),
+                "prompt_tokens": result.get("prompt_token_usage", 0),
+                "completion_tokens": result.get("completion_token_usage", 0),
+                **timing,
+            }
+            if not result["success"]:
+                record["error"] = result.get("error", "")
+            self._records.append(json.dumps(record) + "\n")
+
+    def _write(self, records: List[str]) -> None:
+        self._file.write("".join(records))
+        self._file.flush()
+
+    async def flush(self, force: bool = False) -> None:
+        """Write the buffered records to the metrics file on a worker thread, if
+        enough are waiting or it is time to (always with force)."""
+        if self._file is None or not self._records:
+            return
+        if (not force and len(self._records) < self.flush_records
+                and time.monotonic() - self._flushed < self.flush_interval):
+            return
+        records, self._records = self._records, []
+        self._flushed = time.monotonic()
+        # Writes go out one at a time, in the order their records were taken
+        async with self._write_lock:
+            await asyncio.to_thread(self._write, records)
+
+    def _images_per_minute(self) -> float:
+        if not self._completions:
+            return 0.0
+        # Until the window is full, the rate is over the whole run so far.
+        since = self.started if len(self._completions) < self.window else self._completions[0]
+        elapsed = time.monotonic() - since
+        return 60.0 * len(self._completions) / elapsed if elapsed > 0 else 0.0
+
+    def _eta_seconds(self) -> Optional[float]:
+        rate = self._images_per_minute()
+        if rate <= 0 or not (self.walk_done or self.expected):
+            return None
+        total = self.discovered if self.walk_done else max(self.discovered, self.expected)
+        remaining = max(0, total - sum(self.outcomes.values()))
+        return 60.0 * remaining / rate
+
+    def progress_line(self) -> str:
+        with self._lock:
+            finished = sum(self.outcomes.values())
+            rate = self._images_per_minute()
+            eta = self._eta_seconds()
+            image = self._image.quantiles()
+            ttft = self._ttft.quantiles()
+        line = f" -> Progress: {finished} images, {rate:.1f} images/min"
+        if image:
+            line += f", image p50/p95 {image[0.5]:.1f}s/{image[0.95]:.1f}s"
+        if ttft:
+            line += f", ttft p50 {ttft[0.5]:.2f}s"
+        if eta is not None:
+            line += f", ETA {_format_duration(eta)}"
+        return line
+
+    def snapshot(self) -> dict:
+        """Counts, throughput and ETA so far, for progress events."""
+        with self._lock:
+            eta = self._eta_seconds()
+            return {
+                "finished": sum(self.outcomes.values()),
+                "outcomes": dict(self.outcomes),
+                "tokens": dict(self.tokens),
+                "discovered": self.discovered,
+                "expected": self.expected,
+                "walk_complete": self.walk_done,
+                "images_per_minute": round(self._images_per_minute(), 2),
+                "eta_seconds": round(eta, 1) if eta is not None else None,
+            }
+
+    def summary(self) -> str:
+        with self._lock:
+            lines = [f"Throughput: {self._images_per_minute():.1f} images/min over the last {len(self._completions)} images"]
+            rows = [("image", self._image)] + sorted(self._stages.items()) + [("ttft", self._ttft)]
+            for name, series in rows:
+                q = series.quantiles()
+                if q:
+                    lines.append(f"  {name:<14} p50 {q[0.5]:.3f}s  p95 {q[0.95]:.3f}s  p99 {q[0.99]:.3f}s")
+            q = self._tokens_per_s.quantiles()
+            if q:
+                lines.append(f"  {'tokens/s':<14} p50 {q[0.5]:.1f}  p95 {q[0.95]:.1f}  p99 {q[0.99]:.1f}")
+        return "\n".join(lines)
+
+    def prometheus_samples(self, labels: Optional[Dict[str, str]] = None) -> Dict[str, List[str]]:
+        """The sample lines of each metric family (see PROMETHEUS_FAMILIES), every
+        one carrying labels, e.g. the job the run belongs to."""
+        samples: Dict[str, List[str]] = {}
+
+        def sample(family: str, value, name: str = "", **extra: str) -> None:
+            samples.setdefault(family, []).append(f"{name or family}{_labels(labels, extra)} {value}")
+
+        def summary(family: str, series: _Series, **extra: str) -> None:
+            for q, value in series.quantiles().items():
+                sample(family, f"{value:.6f}", **extra, quantile=str(q))
+            sample(family, f"{series.sum:.6f}", f"{family}_sum", **extra)
+            sample(family, series.count, f"{family}_count", **extra)
+
+        with self._lock:
+            for outcome, count in self.outcomes.items():
+                sample("vlm_caption_images_total", count, outcome=outcome)
+            for kind, count in self.tokens.items():
+                sample("vlm_caption_tokens_total", count, kind=kind)
+            sample("vlm_caption_images_discovered", self.discovered)
+            sample("vlm_caption_images_expected", self.expected)
+            sample("vlm_caption_images_per_minute", f"{self._images_per_minute():.3f}")
+            eta = self._eta_seconds()
+            if eta is not None:
+                sample("vlm_caption_eta_seconds", f"{eta:.1f}")
+            summary("vlm_caption_image_seconds", self._image)
+            for stage, series in sorted(self._stages.items()):
+                summary("vlm_caption_stage_seconds", series, stage=stage)
+            summary("vlm_caption_ttft_seconds", self._ttft)
+            summary("vlm_caption_tokens_per_second", self._tokens_per_s)
+        return samples
+
+    def prometheus_text(self, labels: Optional[Dict[str, str]] = None) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        return prometheus_text([(labels or {}, self)])
+
+    def close(self) -> None:
+        """Write what is still buffered (after the last flush) and close the file."""
+        if self._file is not None:
+            if self._records:
+                self._write(self._records)
+                self._records = []
+            self._file.close()
+            self._file = None
+
+
+def _format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+
+# Metric family -> (type, help), in the order they are exposed
+PROMETHEUS_FAMILIES = {
+    "vlm_caption_images_total": ("counter", "Images finished, by outcome."),
+    "vlm_caption_tokens_total": ("counter", "Tokens used, by kind."),
+    "vlm_caption_images_discovered": ("gauge", "Images found by the walk so far."),
+    "vlm_caption_images_expected": ("gauge", "Estimated images in the run, from the run ledger or walk snapshot."),
+    "vlm_caption_images_per_minute": ("gauge", "Rolling throughput."),
+    "vlm_caption_eta_seconds": ("gauge", "Estimated time until every discovered image is finished."),
+    "vlm_caption_image_seconds": ("summary", "Wall time per captioned image."),
+    "vlm_caption_stage_seconds": ("summary", "Wall time per image spent in each stage."),
+    "vlm_caption_ttft_seconds": ("summary", "Time to first token per chat turn."),
+    "vlm_caption_tokens_per_second": ("summary", "Decode speed per chat turn."),
+}
+
+
+def _labels(labels: Optional[Dict[str, str]], extra: Dict[str, str]) -> str:
+    pairs = {**(labels or {}), **extra}
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in pairs.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(pairs, escaped)) + "}"
+
+
+def prometheus_text(runs: Sequence[Tuple[Dict[str, str], RunMetrics]]) -> str:
+    """The metrics of several runs in the Prometheus text exposition format, one
+    HELP/TYPE header per family and each run's samples told apart by its labels."""
+    samples = [metrics.prometheus_samples(labels) for labels, metrics in runs]
+    out: List[str] = []
+    for family, (kind, help_text) in PROMETHEUS_FAMILIES.items():
+        lines = [line for run in samples for line in run.get(family, [])]
+        if lines:
+            out += [f"# HELP {family} {help_text}", f"# TYPE {family} {kind}"] + lines
+    return "\n".join(out) + "\n" if out else ""
+
+
+def create_run_metrics(conf) -> RunMetrics:
+    """Metrics for a run; per-image records go to metrics_file when it is set."""
+    return RunMetrics(window=conf.get("metrics_window", 1000), jsonl_path=conf.get("metrics_file", "") or None)
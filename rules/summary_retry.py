@@ -1,13 +1,15 @@
 import openai
-from typing import List, Tuple
+from typing import List, Sequence, Tuple
 from response_filters import filter_thinking
+from scheduling.turns import TurnObserver, stream_chat_turn
 
 async def run_summary_retry_rules(client:openai.AsyncClient, 
                                   conf, 
                                   messages:List, 
                                   summary_response:str, 
                                   completion_tokens_usage,
-                                  prompt_tokens_usage) -> Tuple[str, int, int]:
+                                  prompt_tokens_usage,
+                                  observers: Sequence[TurnObserver] = ()) -> Tuple[str, int, int]:
     def run_rules(retry_rules, response_to_check) -> dict:
         rejections = {}
         for rule in retry_rules:
@@ -40,21 +42,15 @@ async def run_summary_retry_rules(client:openai.AsyncClient,
     retry_request_message.strip() # remove final line break
 
     messages.append({"role": "user", "content": [{"type": "text", "text": retry_request_message}]})
-    stream = await client.chat.completions.create(
+    response_text, prompt_tokens, completion_tokens = await stream_chat_turn(
+        client,
+        messages,
+        observers,
         model=conf["model"],
-        messages=messages,
-        stream=True,
         stream_options={"include_usage": True}
         )
-
-    response_text = ""
-    async for event in stream:
-        if event.choices and event.choices[0].delta.content is not None:
-            chunk = event.choices[0].delta.content
-            response_text += chunk
-        if event.usage:
-            completion_tokens_usage += event.usage.completion_tokens
-            prompt_tokens_usage += event.usage.prompt_tokens
+    completion_tokens_usage += completion_tokens
+    prompt_tokens_usage += prompt_tokens
 
     response_text = filter_thinking(response_text)
     rejections = run_rules(retry_rules, response_text)
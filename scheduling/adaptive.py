@@ -0,0 +1,113 @@
+import time
+from typing import List, Optional, Tuple
+
+import openai
+
+from scheduling.endpoints import EndpointPool
+from scheduling.turns import TurnObserver
+
+
+def is_overload_error(error: BaseException) -> bool:
+    """429 rate limits and 5xx responses: the server is asking us to slow down."""
+    if isinstance(error, openai.RateLimitError):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class AdaptiveConcurrency(TurnObserver):
+    """AIMD controller for the number of in-flight image conversations.
+
+    Each completed turn gives a cost sample: seconds per completion token,
+    time-to-first-token included, so both prefill queueing and slower decode
+    under contention show up in it. The smoothed cost is compared with the best
+    seen so far. While it stays within latency_tolerance of that baseline, the
+    limit grows by one after every full window (limit turns) of successes. When
+    the cost inflates past the tolerance, or the server answers 429/5xx, the
+    limit is multiplied by decrease_factor. Only turns started after the last
+    decrease can trigger another one, so one overload episode backs off once.
+    """
+
+    def __init__(self, pool: EndpointPool, min_limit: int = 1, max_limit: int = 16, initial: int = 0,
+                 latency_tolerance: float = 2.0, decrease_factor: float = 0.7, smoothing: float = 0.2):
+        self.pool = pool
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.smoothing = smoothing
+        self.limit = min(self.max_limit, max(self.min_limit, initial or self.min_limit))
+        self.history: List[Tuple[float, int, str]] = [(time.monotonic(), self.limit, "start")]
+        self._cost_ewma: Optional[float] = None
+        self._baseline: Optional[float] = None
+        self._successes_since_change = 0
+        self._last_decrease = float("-inf")
+        pool.set_limit(self.limit)
+
+    def _set_limit(self, limit: int, reason: str) -> None:
+        limit = min(self.max_limit, max(self.min_limit, limit))
+        if limit == self.limit:
+            return
+        print(f" -> Concurrency {self.limit} -> {limit} ({reason})")
+        self.limit = limit
+        self.history.append((time.monotonic(), limit, reason))
+        self._successes_since_change = 0
+        self.pool.set_limit(limit)
+
+    def _decrease(self, reason: str) -> None:
+        self._last_decrease = time.perf_counter()
+        self._set_limit(int(self.limit * self.decrease_factor), reason)
+
+    def after_turn(self, request: dict, stats: dict) -> None:
+        tokens = stats["completion_tokens"] or max(1, stats["response_chars"] // 4)
+        cost = stats["latency"] / max(1, tokens)
+        if self._cost_ewma is None:
+            self._cost_ewma = cost
+        else:
+            self._cost_ewma = self.smoothing * cost + (1 - self.smoothing) * self._cost_ewma
+        # The baseline follows improvements at once and drifts up slowly, so a
+        # lucky early sample cannot pin the limit down for the whole run.
+        if self._baseline is None:
+            self._baseline = self._cost_ewma
+        else:
+            self._baseline = min(self._cost_ewma, self._baseline * 1.002)
+
+        if self._cost_ewma > self.latency_tolerance * self._baseline:
+            if stats["started"] > self._last_decrease:
+                self._decrease(f"latency {self._cost_ewma / self._baseline:.1f}x baseline")
+            return
+
+        self._successes_since_change += 1
+        if self._successes_since_change >= self.limit:
+            self._set_limit(self.limit + 1, f"{stats['tokens_per_s']:.1f} tok/s per stream")
+
+    def on_error(self, request: dict, error: BaseException, elapsed: float) -> None:
+        if is_overload_error(error) and time.perf_counter() - elapsed > self._last_decrease:
+            status = getattr(error, "status_code", "")
+            self._decrease(f"server returned {status}".strip())
+
+    def summary(self) -> str:
+        """Final, min, max and time-weighted average concurrency over the run."""
+        now = time.monotonic()
+        limits = [limit for _, limit, _ in self.history]
+        weighted = 0.0
+        for (t, limit, _), (t_next, _, _) in zip(self.history, self.history[1:] + [(now, 0, "")]):
+            weighted += limit * (t_next - t)
+        duration = now - self.history[0][0]
+        average = weighted / duration if duration > 0 else float(self.limit)
+        return (f"Concurrency: final {self.limit}, min {min(limits)}, max {max(limits)}, "
+                f"average {average:.1f}, {len(self.history) - 1} adjustment(s)")
+
+
+def create_adaptive_concurrency(conf, pool: EndpointPool) -> Optional[AdaptiveConcurrency]:
+    """Controller configured by adaptive_concurrency, or None when it is disabled."""
+    adaptive = conf.get("adaptive_concurrency", None)
+    if not adaptive or not adaptive.get("enabled", False):
+        return None
+    return AdaptiveConcurrency(
+        pool,
+        min_limit=adaptive.get("min", 1),
+        max_limit=min(adaptive.get("max", 0) or pool.capacity, pool.capacity),
+        initial=adaptive.get("initial", 0),
+        latency_tolerance=adaptive.get("latency_tolerance", 2.0),
+        decrease_factor=adaptive.get("decrease_factor", 0.7),
+    )
@@ -0,0 +1,232 @@
+import asyncio
+from collections import deque
+from typing import Callable, List, Optional
+
+import openai
+from omegaconf import OmegaConf
+
+from scheduling.shared_budget import SharedConcurrencyBudget
+
+
+def is_endpoint_failure(error: BaseException) -> bool:
+    """Errors that say the endpoint itself is unhealthy (unreachable, timing out, 5xx),
+    as opposed to a problem with one particular request."""
+    return isinstance(error, (openai.APIConnectionError, openai.InternalServerError))
+
+
+class Endpoint:
+    """One OpenAI-compatible server with its own client, concurrency limit and config.
+
+    conf is the job config with this endpoint's model and api key applied, so an
+    image conversation dispatched here uses it for every turn. Acts as the slot
+    taken by the caption stage: release() gives the slot back to the pool.
+    """
+
+    def __init__(self, pool: "EndpointPool", name: str, client, conf, concurrency: int):
+        self.pool = pool
+        self.name = name
+        self.client = client
+        self.conf = conf
+        self.concurrency = max(1, int(concurrency))
+        self.in_flight = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.completed = 0
+        self.failed = 0
+
+    @property
+    def model(self) -> str:
+        return self.conf.get("model", None) or ""
+
+    @property
+    def load(self) -> float:
+        return self.in_flight / self.concurrency
+
+    def release(self) -> None:
+        self.pool._release(self)
+
+
+class EndpointPool:
+    """Dispatches whole image conversations to the least-loaded healthy endpoint.
+
+    acquire() blocks until some healthy endpoint has a free slot. Endpoints that
+    fail failure_threshold times in a row with connection/5xx errors are ejected
+    (unless they are the last healthy one) and re-admitted once a health check
+    against their /models route succeeds. With a shared budget, a slot is only
+    free if the endpoint also has room in the budget shared with other jobs.
+    """
+
+    def __init__(self, failure_threshold: int = 3, check_interval: float = 30.0, budget: Optional[SharedConcurrencyBudget] = None):
+        self.endpoints: List[Endpoint] = []
+        self.failure_threshold = failure_threshold
+        self.check_interval = check_interval
+        self.limit: Optional[int] = None  # global in-flight cap across endpoints, None = capacity
+        self._waiters: deque = deque()
+        self._health_task: Optional[asyncio.Task] = None
+        self.budget = budget
+        self._wake: Optional[Callable[[], None]] = None
+
+    def add(self, name: str, client, conf, concurrency: int) -> Endpoint:
+        endpoint = Endpoint(self, name, client, conf, concurrency)
+        self.endpoints.append(endpoint)
+        if self.budget is not None:
+            self.budget.register(name, endpoint.concurrency, endpoint.model)
+        return endpoint
+
+    @property
+    def capacity(self) -> int:
+        return sum(e.concurrency for e in self.endpoints)
+
+    @property
+    def in_flight(self) -> int:
+        return sum(e.in_flight for e in self.endpoints)
+
+    def set_limit(self, limit: Optional[int]) -> None:
+        """Cap the total in-flight conversations below the summed endpoint capacity."""
+        self.limit = limit
+        self._notify()
+
+    def _pick(self) -> Optional[Endpoint]:
+        if self.limit is not None and self.in_flight >= self.limit:
+            return None
+        candidates = [e for e in self.endpoints if e.healthy and e.in_flight < e.concurrency]
+        for endpoint in sorted(candidates, key=lambda e: (e.load, e.in_flight)):
+            if self.budget is None or self.budget.try_acquire(endpoint.name, endpoint.model):
+                return endpoint
+        return None
+
+    async def acquire(self) -> Endpoint:
+        if self.budget is not None and self._wake is None:
+            # Slots given back by other jobs' pools wake this one on its own loop
+            loop = asyncio.get_running_loop()
+            self._wake = lambda: loop.call_soon_threadsafe(self._notify)
+            self.budget.subscribe(self._wake)
+        endpoint = self._pick()
+        while endpoint is None:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+            endpoint = self._pick()
+        endpoint.in_flight += 1
+        return endpoint
+
+    def _release(self, endpoint: Endpoint) -> None:
+        endpoint.in_flight -= 1
+        if self.budget is not None:
+            self.budget.release(endpoint.name, endpoint.model)
+        self._notify()
+
+    def _notify(self) -> None:
+        """Wake every waiting acquire(); each re-checks for a free slot."""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def report(self, endpoint: Endpoint, success: bool, error: Optional[BaseException] = None) -> None:
+        """Record the outcome of a conversation on endpoint for health tracking."""
+        if success:
+            endpoint.completed += 1
+            endpoint.consecutive_failures = 0
+            return
+        endpoint.failed += 1
+        if error is None or not is_endpoint_failure(error):
+            return
+        endpoint.consecutive_failures += 1
+        if (endpoint.healthy
+                and endpoint.consecutive_failures >= self.failure_threshold
+                and sum(e.healthy for e in self.endpoints) > 1):
+            endpoint.healthy = False
+            print(f" -> Endpoint {endpoint.name} ejected after {endpoint.consecutive_failures} consecutive failures")
+            self._ensure_health_checks()
+
+    def _ensure_health_checks(self) -> None:
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.get_running_loop().create_task(self._health_check_loop())
+
+    async def _health_check_loop(self) -> None:
+        while any(not e.healthy for e in self.endpoints):
+            await asyncio.sleep(self.check_interval)
+            for endpoint in [e for e in self.endpoints if not e.healthy]:
+                try:
+                    await asyncio.wait_for(endpoint.client.models.list(), timeout=max(1.0, self.check_interval / 2))
+                except Exception:
+                    continue
+                endpoint.healthy = True
+                endpoint.consecutive_failures = 0
+                print(f" -> Endpoint {endpoint.name} passed health check, re-admitted")
+                self._notify()
+
+    async def close(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+        if self.budget is not None:
+            if self._wake is not None:
+                self.budget.unsubscribe(self._wake)
+            for endpoint in self.endpoints:
+                self.budget.unregister(endpoint.name, endpoint.concurrency, endpoint.model)
+        for endpoint in self.endpoints:
+            try:
+                await endpoint.client.close()
+            except Exception:
+                pass
+
+
+def endpoint_configs(conf) -> List[dict]:
+    """Normalize base_url into a list of {url, concurrency, model, api_key} dicts.
+
+    base_url may be a single url string (the original form), or a list whose items
+    are url strings or mappings with url and optional concurrency, model and
+    api_key. Missing values fall back to concurrent_batch_size, model and api_key.
+    With adaptive_concurrency enabled the default concurrency is its max (if set,
+    i.e. not 0), since the controller then decides how much of it to use.
+    """
+    default_concurrency = conf.get("concurrent_batch_size", 1)
+    adaptive = conf.get("adaptive_concurrency", None)
+    if adaptive and adaptive.get("enabled", False):
+        default_concurrency = adaptive.get("max", 0) or default_concurrency
+
+    base_url = conf.base_url
+    items = list(base_url) if OmegaConf.is_list(base_url) or isinstance(base_url, list) else [base_url]
+    configs = []
+    for item in items:
+        if isinstance(item, str):
+            item = {"url": item}
+        configs.append({
+            "url": item.get("url"),
+            "concurrency": item.get("concurrency", None) or default_concurrency,
+            "model": item.get("model", None) or conf.get("model", ""),
+            "api_key": item.get("api_key", None),
+        })
+    return configs
+
+
+def create_endpoint_pool(conf, client_factory: Callable, resolve_api_key: Callable, budget: Optional[SharedConcurrencyBudget] = None) -> EndpointPool:
+    """Build the pool of endpoints from conf.base_url.
+
+    client_factory(base_url, api_key) creates the API client for one endpoint.
+    resolve_api_key(conf) turns an api_key config value into the key to use.
+    budget, when several jobs run at once, is the concurrency they share.
+    """
+    health = conf.get("endpoint_health", None) or {}
+    pool = EndpointPool(
+        failure_threshold=health.get("failure_threshold", 3),
+        check_interval=health.get("check_interval", 30.0),
+        budget=budget,
+    )
+    for item in endpoint_configs(conf):
+        overrides = {"model": item["model"]}
+        if item["api_key"] is not None:
+            overrides["api_key"] = item["api_key"]
+        endpoint_conf = OmegaConf.merge(conf, overrides)
+        api_key = resolve_api_key(endpoint_conf)
+        pool.add(item["url"], client_factory(item["url"], api_key), endpoint_conf, item["concurrency"])
+    return pool
@@ -0,0 +1,110 @@
+from typing import Any, Dict, Optional
+
+import openai
+
+# The connection limits and timeout types of the HTTP library the installed openai
+# package is built on, taken from its own defaults so this works with whichever
+# library (and version) that is.
+Limits = type(openai.DEFAULT_CONNECTION_LIMITS)
+Timeout = openai.Timeout
+
+
+class ConnectionStats:
+    """Counts requests and the connections opened for them, from the HTTP
+    library's trace events. Every request beyond the connections opened went out
+    on a kept-alive connection; a high connection count relative to requests
+    means connections are being churned (keep-alive expiry or pool too small)."""
+
+    def __init__(self):
+        self.requests = 0
+        self.http2_requests = 0
+        self.connections = 0
+        self.tls_handshakes = 0
+        self.connect_failures = 0
+
+    @property
+    def reused(self) -> int:
+        return max(0, self.requests - self.connections)
+
+    async def trace(self, event: str, info: Dict[str, Any]) -> None:
+        if event in ("http11.send_request_headers.started", "http2.send_request_headers.started"):
+            self.requests += 1
+            if event.startswith("http2."):
+                self.http2_requests += 1
+        elif event in ("connection.connect_tcp.complete", "connection.connect_unix_socket.complete"):
+            self.connections += 1
+        elif event in ("connection.connect_tcp.failed", "connection.connect_unix_socket.failed"):
+            self.connect_failures += 1
+        elif event == "connection.start_tls.complete":
+            self.tls_handshakes += 1
+
+    async def on_request(self, request) -> None:
+        """Request event hook: attach the trace callback, keeping any already set."""
+        previous = request.extensions.get("trace")
+        if previous is None:
+            request.extensions["trace"] = self.trace
+            return
+
+        async def trace(event: str, info: Dict[str, Any]) -> None:
+            await self.trace(event, info)
+            await previous(event, info)
+        request.extensions["trace"] = trace
+
+    def summary(self) -> str:
+        share = self.reused / self.requests if self.requests else 0.0
+        text = (f"HTTP: {self.requests} requests over {self.connections} connections "
+                f"({self.reused} on reused connections, {share:.0%})")
+        if self.tls_handshakes:
+            text += f", {self.tls_handshakes} TLS handshakes"
+        if self.http2_requests:
+            text += f", {self.http2_requests} over HTTP/2"
+        if self.connect_failures:
+            text += f", {self.connect_failures} failed connects"
+        return text
+
+
+def _timeout(settings) -> Timeout:
+    default = openai.DEFAULT_TIMEOUT
+    return Timeout(
+        connect=settings.get("connect_timeout", default.connect),
+        read=settings.get("read_timeout", default.read),
+        write=settings.get("write_timeout", default.write),
+        pool=settings.get("pool_timeout", default.pool),
+    )
+
+
+def create_http_client(conf, stats: Optional[ConnectionStats] = None):
+    """The HTTP client shared by every endpoint's API client, from the optional
+    http_client section: max_connections, max_keepalive_connections,
+    keepalive_expiry, connect/read/write/pool_timeout (seconds) and http2.
+    Anything not set keeps the openai package's defaults. HTTP/2 needs the h2
+    package."""
+    settings = conf.get("http_client", None) or {}
+    default_limits = openai.DEFAULT_CONNECTION_LIMITS
+    limits = Limits(
+        max_connections=settings.get("max_connections", default_limits.max_connections),
+        max_keepalive_connections=settings.get("max_keepalive_connections", default_limits.max_keepalive_connections),
+        keepalive_expiry=settings.get("keepalive_expiry", default_limits.keepalive_expiry),
+    )
+    kwargs = {"limits": limits, "timeout": _timeout(settings)}
+    if settings.get("http2", False):
+        kwargs["http2"] = True
+    if stats is not None:
+        kwargs["event_hooks"] = {"request": [stats.on_request]}
+    try:
+        return openai.DefaultAsyncHttpxClient(**kwargs)
+    except ImportError as e:
+        raise ImportError(f"http_client.http2 needs the h2 package (pip install h2): {e}") from e
+
+
+def client_options(conf, rate_limited: bool = False) -> Dict[str, Any]:
+    """Options for openai.AsyncOpenAI besides the http_client: the request timeout
+    and http_client.max_retries. With the rate limiter handling retries, the
+    client's own silent retries are turned off so every 429 reaches the limiter."""
+    settings = conf.get("http_client", None) or {}
+    options: Dict[str, Any] = {"timeout": _timeout(settings)}
+    if rate_limited:
+        options["max_retries"] = 0
+    elif settings.get("max_retries", None) is not None:
+        options["max_retries"] = settings.max_retries
+    return options
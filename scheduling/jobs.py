@@ -0,0 +1,225 @@
+"""
+Captioning jobs run side by side in one process (the web app's backend): each
+job has its own config, thread, event loop and event buffer, and all of them
+share one SharedConcurrencyBudget so together they do not overload a server.
+"""
+
+import sys
+import time
+import uuid
+import asyncio
+import threading
+import contextvars
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from metrics.events import LOG, STATUS, EventBuffer, ProgressEvents
+from metrics.timing import RunMetrics
+from scheduling.shared_budget import SharedConcurrencyBudget
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETE = "complete"
+JOB_CANCELLED = "cancelled"
+JOB_ERROR = "error"
+
+DEFAULT_EVENT_CAPACITY = 10000
+DEFAULT_KEEP_FINISHED = 20
+
+
+# The events of the job whose code is running. Set on the job's thread, so its
+# tasks carry it, and asyncio.to_thread and the stores' executors pass it on to
+# the worker threads they run code on.
+_job_events: "contextvars.ContextVar[Optional[ProgressEvents]]" = contextvars.ContextVar("job_events", default=None)
+
+
+class JobStdout:
+    """Stdout replacement while jobs run: writes through to the console, and adds
+    each line printed by a job's code, on its own thread or a worker thread
+    running for it, to that job's events as a log event."""
+
+    def __init__(self, original_stdout):
+        self.original_stdout = original_stdout
+        self.encoding = 'utf-8'
+        self._lock = threading.Lock()
+        self._partial: Dict[Tuple[int, int], List[str]] = {}  # (thread id, events id) -> partial line parts
+
+    def attach(self, events: ProgressEvents) -> None:
+        """Send what the current thread (and the tasks it starts from now on) prints to events."""
+        _job_events.set(events)
+
+    def detach(self) -> None:
+        events = _job_events.get()
+        _job_events.set(None)
+        if events is not None:
+            with self._lock:
+                for key in [key for key in self._partial if key[1] == id(events)]:
+                    del self._partial[key]
+
+    def write(self, text):
+        self.original_stdout.write(text)
+        self.original_stdout.flush()
+
+        events = _job_events.get()
+        if events is None:
+            return
+        key = (threading.get_ident(), id(events))
+        with self._lock:
+            partial = self._partial.setdefault(key, [])
+            if '\n' not in text:
+                partial.append(text)
+                return
+            lines = (''.join(partial) + text).split('\n')
+            rest = lines.pop()
+            if rest:
+                self._partial[key] = [rest]
+            else:
+                del self._partial[key]
+        for line in lines:
+            events.emit(LOG, text=line)
+
+    def flush(self):
+        self.original_stdout.flush()
+
+
+class Job:
+    """One captioning run: its config, state, events and (once it starts) metrics."""
+
+    def __init__(self, config_path: str, overrides: Optional[Dict] = None, name: str = "",
+                 event_capacity: int = DEFAULT_EVENT_CAPACITY):
+        self.id = uuid.uuid4().hex[:12]
+        self.name = name or self.id
+        self.config_path = config_path
+        self.overrides = dict(overrides or {})
+        self.status = JOB_QUEUED
+        self.error = ""
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.events = EventBuffer(capacity=event_capacity)
+        self.metrics: Optional[RunMetrics] = None
+        self.thread: Optional[threading.Thread] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop_requested = False
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.status in (JOB_QUEUED, JOB_RUNNING)
+
+    def stop(self) -> bool:
+        """Cancel the job from any thread. Returns False if it already finished."""
+        with self._lock:
+            if not self.running:
+                return False
+            self._stop_requested = True
+            if self._task is not None:
+                try:
+                    self._loop.call_soon_threadsafe(self._task.cancel)
+                except RuntimeError:
+                    # Finished (and its loop closed) just now
+                    return False
+            return True
+
+    def set_metrics(self, metrics: RunMetrics) -> None:
+        self.metrics = metrics
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "config_path": self.config_path,
+            "overrides": self.overrides,
+            "status": self.status,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "events": self.events.end,
+        }
+
+
+class JobManager:
+    """Starts, tracks and stops jobs. run_job(config_path, overrides, event_sink,
+    concurrency_budget, metrics_sink) is the coroutine function a job runs,
+    caption_openai.main by default. Only the most recent keep_finished finished
+    jobs are kept."""
+
+    def __init__(self, budget: Optional[SharedConcurrencyBudget] = None, run_job: Optional[Callable] = None,
+                 keep_finished: int = DEFAULT_KEEP_FINISHED):
+        if run_job is None:
+            from caption_openai import main as run_job
+        self.budget = budget or SharedConcurrencyBudget()
+        self.run_job = run_job
+        self.keep_finished = keep_finished
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stdout: Optional[JobStdout] = None
+
+    def start(self, config_path: str = "caption.yaml", overrides: Optional[Dict] = None, name: str = "") -> Job:
+        job = Job(config_path, overrides, name)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._prune()
+            if self._stdout is None:
+                self._stdout = JobStdout(sys.stdout)
+                sys.stdout = self._stdout
+        job.thread = threading.Thread(target=self._run, args=(job,), name=f"job-{job.id}", daemon=True)
+        job.thread.start()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def running(self) -> List[Job]:
+        return [job for job in self.list() if job.running]
+
+    def stop(self, job_id: str) -> bool:
+        job = self.get(job_id)
+        return job is not None and job.stop()
+
+    def _prune(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if not job.running]
+        for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[job_id]
+
+    def _run(self, job: Job) -> None:
+        events = ProgressEvents(job.events.append)
+        stdout = self._stdout
+        stdout.attach(events)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            with job._lock:
+                job._loop = loop
+                job._task = loop.create_task(self.run_job(job.config_path, job.overrides, job.events.append,
+                                                            self.budget, job.set_metrics))
+                if job._stop_requested:
+                    job._task.cancel()
+                job.status = JOB_RUNNING
+                job.started = time.time()
+            try:
+                loop.run_until_complete(job._task)
+                job.status = JOB_COMPLETE
+            except asyncio.CancelledError:
+                job.status = JOB_CANCELLED
+                events.emit(STATUS, status='cancelled', message='Captioning was cancelled by user')
+            events.emit(STATUS, status='complete')
+        except Exception as e:
+            job.status = JOB_ERROR
+            job.error = str(e)
+            events.emit(STATUS, status='error', message=f'Captioning failed: {e}')
+        finally:
+            job.finished = time.time()
+            loop.close()
+            stdout.detach()
+            with self._lock:
+                if self._stdout is stdout and not any(j.running for j in self._jobs.values()):
+                    sys.stdout = stdout.original_stdout
+                    self._stdout = None
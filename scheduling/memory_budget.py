@@ -0,0 +1,120 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+MB = 1024 * 1024
+
+# In-flight copies of an image's base64 payload: the string itself, and the request
+# body serialized to a string and then encoded to bytes.
+PAYLOAD_COPIES = 3
+
+
+def base64_size(size: int) -> int:
+    return 4 * ((size + 2) // 3)
+
+
+def estimate_payload_bytes(file_size: int) -> int:
+    """Memory an image is expected to take before it is read: its raw bytes plus the
+    base64 copies made of them."""
+    return file_size + PAYLOAD_COPIES * base64_size(file_size)
+
+
+def encoded_payload_bytes(b64_length: int) -> int:
+    """Memory an image takes once encoded and the raw bytes are dropped."""
+    return PAYLOAD_COPIES * b64_length
+
+
+@dataclass
+class _Waiter:
+    amount: int
+    future: asyncio.Future
+    passed: int = 0
+
+
+class ByteBudget:
+    """Admission control on the bytes of image payloads held in memory at once.
+
+    acquire(amount) waits until amount fits in what is left of limit. Waiters are
+    admitted in order, except that a smaller request which fits may pass a larger
+    one that does not, so a big image waiting for room does not hold up small ones.
+    After it has been passed max_passes times the larger request stops being
+    passed, and everything behind it waits until it fits. A request larger than
+    the whole budget is admitted once nothing else is in use.
+    """
+
+    def __init__(self, limit: int, max_passes: int = 16):
+        self.limit = max(1, int(limit))
+        self.max_passes = max_passes
+        self.used = 0
+        self.peak = 0
+        self._waiters: deque = deque()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for waiter in self._waiters if not waiter.future.done())
+
+    def _fits(self, amount: int) -> bool:
+        return self.used == 0 or self.used + amount <= self.limit
+
+    def _take(self, amount: int) -> None:
+        self.used += amount
+        self.peak = max(self.peak, self.used)
+
+    def _wake(self) -> None:
+        index = 0
+        while index < len(self._waiters):
+            waiter = self._waiters[index]
+            if waiter.future.done():
+                del self._waiters[index]
+                continue
+            if self._fits(waiter.amount):
+                self._take(waiter.amount)
+                waiter.future.set_result(None)
+                del self._waiters[index]
+                if index:
+                    self._waiters[0].passed += 1
+                continue
+            if index == 0 and waiter.passed >= self.max_passes:
+                break
+            index += 1
+
+    async def acquire(self, amount: int) -> int:
+        """Wait for room for amount bytes and take it. Returns amount, for release()."""
+        waiter = _Waiter(amount, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self._wake()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release(amount)
+            raise
+        return amount
+
+    def resize(self, amount: int, new_amount: int) -> int:
+        """Replace a held amount with new_amount, e.g. once the real size is known.
+        Growing never waits; it may take the budget over its limit for a while."""
+        self._take(new_amount - amount)
+        if new_amount < amount:
+            self._wake()
+        return new_amount
+
+    def release(self, amount: int) -> None:
+        self.used -= amount
+        self._wake()
+
+    def status(self) -> str:
+        text = f"memory {self.used / MB:.0f}/{self.limit / MB:.0f} MB"
+        waiting = self.waiting
+        if waiting:
+            text += f" ({waiting} waiting)"
+        return text
+
+
+def create_memory_budget(conf) -> Optional[ByteBudget]:
+    """A ByteBudget of memory_budget_mb megabytes, or None when it is not set."""
+    budget_mb = conf.get("memory_budget_mb", 0)
+    if not budget_mb:
+        return None
+    return ByteBudget(int(budget_mb * MB))
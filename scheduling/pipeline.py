@@ -0,0 +1,88 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Any, AsyncIterable, Awaitable, Callable, Dict, List, Optional, Sequence
+
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    """One step of a Pipeline.
+
+    run(item) is awaited by each of the stage's workers in turn, and returns the
+    item to hand to the next stage, or None to drop it. Items for which
+    bypass(item) is true skip this stage entirely and go straight on to the next.
+    queue_size bounds the queue in front of the stage, so a slow stage holds
+    back the ones feeding it instead of letting items pile up in memory.
+    """
+    name: str
+    run: Callable[[Any], Awaitable[Any]]
+    workers: int = 1
+    queue_size: int = 1
+    bypass: Optional[Callable[[Any], bool]] = None
+
+
+class Pipeline:
+    """Stages connected by bounded queues, fed from an async iterable.
+
+    Each stage runs its own number of workers; a worker only takes the next item
+    once it has handed its current one on, so at most workers + queue_size items
+    are held per stage. Stage functions are expected to deal with per-item
+    errors themselves: an exception escaping run() stops the whole pipeline and
+    is raised from run(). Cancelling run() cancels every worker.
+    """
+
+    def __init__(self, stages: Sequence[Stage]):
+        self.stages: List[Stage] = list(stages)
+        self._queues = [asyncio.Queue(maxsize=max(1, stage.queue_size)) for stage in self.stages]
+        self._running = [0] * len(self.stages)
+
+    def depths(self) -> Dict[str, int]:
+        """Number of items waiting in front of each stage."""
+        return {stage.name: queue.qsize() for stage, queue in zip(self.stages, self._queues)}
+
+    async def _forward(self, index: int, item) -> None:
+        """Put item in front of stage index, or the first stage after it that it does not bypass."""
+        while index < len(self.stages):
+            bypass = self.stages[index].bypass
+            if bypass is None or not bypass(item):
+                await self._queues[index].put(item)
+                return
+            index += 1
+
+    async def _feed(self, source: AsyncIterable) -> None:
+        async for item in source:
+            await self._forward(0, item)
+        await self._queues[0].put(_DONE)
+
+    async def _work(self, index: int) -> None:
+        stage = self.stages[index]
+        queue = self._queues[index]
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            result = await stage.run(item)
+            if result is not None:
+                await self._forward(index + 1, result)
+        # Every item ahead of _DONE has been taken: pass it on to the next idle worker,
+        # and once the last worker of this stage is done, on to the next stage.
+        self._running[index] -= 1
+        if self._running[index]:
+            await queue.put(_DONE)
+        elif index + 1 < len(self.stages):
+            await self._queues[index + 1].put(_DONE)
+
+    async def run(self, source: AsyncIterable) -> None:
+        """Push every item of source through the stages; returns once all are through."""
+        tasks = [asyncio.create_task(self._feed(source))]
+        for index, stage in enumerate(self.stages):
+            self._running[index] = max(1, stage.workers)
+            tasks.extend(asyncio.create_task(self._work(index)) for _ in range(self._running[index]))
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
@@ -0,0 +1,151 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from file_utils.file_access import concat_prompts
+
+
+@dataclass(frozen=True)
+class PromptNode:
+    name: str
+    prompt: str
+    depends_on: Tuple[str, ...]
+
+
+def prompt_nodes(conf) -> List[PromptNode]:
+    """The conversation turns to run for each image, in definition order.
+
+    Without prompt_graph, prompts is a plain chain where each turn depends on the
+    one before it. With prompt_graph, each entry is {name, prompt, depends_on}:
+    the first entry is the image turn, depends_on (a name or list of names of
+    earlier entries) defaults to the previous entry, and the last entry is the
+    summary whose response is saved.
+    """
+    graph = conf.get("prompt_graph", None)
+    if not graph:
+        prompts = list(conf.get("prompts", []))
+        return [PromptNode(f"turn{i}", prompt, (f"turn{i - 1}",) if i else ())
+                for i, prompt in enumerate(prompts)]
+
+    nodes: List[PromptNode] = []
+    for i, entry in enumerate(graph):
+        name = str(entry.get("name", f"turn{i}"))
+        if name in (node.name for node in nodes):
+            raise ValueError(f"prompt_graph: duplicate turn name '{name}'")
+        depends_on = entry.get("depends_on", None)
+        if depends_on is None:
+            depends_on = [nodes[-1].name] if nodes else []
+        elif isinstance(depends_on, str):
+            depends_on = [depends_on]
+        depends_on = tuple(str(dep) for dep in depends_on)
+        if i == 0 and depends_on:
+            raise ValueError(f"prompt_graph: the first turn '{name}' cannot depend on other turns")
+        if i > 0 and not depends_on:
+            raise ValueError(f"prompt_graph: turn '{name}' must depend on at least one earlier turn")
+        for dep in depends_on:
+            if dep not in (node.name for node in nodes):
+                raise ValueError(f"prompt_graph: turn '{name}' depends on '{dep}', which is not an earlier turn")
+        nodes.append(PromptNode(name, str(entry["prompt"]), depends_on))
+
+    final_ancestors = _ancestors(nodes, len(nodes) - 1)
+    for i, node in enumerate(nodes[:-1]):
+        if i not in final_ancestors:
+            raise ValueError(f"prompt_graph: turn '{node.name}' does not lead to the final summary turn")
+    return nodes
+
+
+def prompt_identity(conf) -> str:
+    """Identity string of the prompt setup, used for jsonl matching and cache keys.
+    For a plain prompts list this is the prompts joined as before; a prompt graph
+    also records each turn's dependencies, since they change the conversation."""
+    if not conf.get("prompt_graph", None):
+        return concat_prompts(list(conf.get("prompts", [])))
+    return "\n\n".join(f"[{node.name} <- {', '.join(node.depends_on)}] {node.prompt}"
+                       for node in prompt_nodes(conf))
+
+
+def _ancestors(nodes: List[PromptNode], index: int) -> List[int]:
+    """Indices of every turn the given turn depends on, directly or not, in definition order."""
+    positions = {node.name: i for i, node in enumerate(nodes)}
+    found = set()
+    pending = [positions[dep] for dep in nodes[index].depends_on]
+    while pending:
+        i = pending.pop()
+        if i not in found:
+            found.add(i)
+            pending.extend(positions[dep] for dep in nodes[i].depends_on)
+    return sorted(found)
+
+
+def turn_stages(nodes: List[PromptNode]) -> List[int]:
+    """The stage of each turn: 0 for the image turn, else one more than the latest
+    stage it depends on. Turns of one stage only depend on earlier stages, so
+    they can all be sent at once."""
+    positions = {node.name: i for i, node in enumerate(nodes)}
+    stages: List[int] = []
+    for node in nodes:
+        stages.append(max((stages[positions[dep]] + 1 for dep in node.depends_on), default=0))
+    return stages
+
+
+def turn_messages(nodes: List[PromptNode], index: int, prefix: List, first_message: List, responses: Dict[int, str]) -> List:
+    """The messages sent for turn index: prefix, then the user/assistant pairs of all
+    its ancestors (whose responses must be known) in definition order, then its
+    own prompt. The first turn's user content is first_message."""
+    def user_message(i: int) -> Dict:
+        content = first_message if i == 0 else [{"type": "text", "text": nodes[i].prompt}]
+        return {"role": "user", "content": content}
+
+    messages = list(prefix)
+    for a in _ancestors(nodes, index):
+        messages.append(user_message(a))
+        messages.append({"role": "assistant", "content": [{"type": "text", "text": responses[a]}]})
+    messages.append(user_message(index))
+    return messages
+
+
+TurnRunner = Callable[[int, List], Awaitable[Tuple[str, int, int]]]
+
+
+async def run_prompt_graph(nodes: List[PromptNode], prefix: List, first_message: List, run_turn: TurnRunner) -> Tuple[List, int, int]:
+    """Run every turn as soon as the turns it depends on have answered.
+
+    Each turn sees prefix (e.g. the system prompt), then the user/assistant pairs
+    of all its ancestors in definition order, then its own prompt. The first
+    turn's user content is first_message (the image and hints). Independent
+    branches fork from their shared ancestors and run concurrently; a turn
+    depending on several branches sees all of them merged in definition order.
+
+    run_turn(index, messages) sends one turn and returns
+    (response_text, prompt_tokens, completion_tokens).
+    Returns (messages of the final turn, prompt_tokens, completion_tokens).
+    """
+    responses: Dict[int, str] = {}
+    usage = [0, 0]
+
+    def conversation(i: int) -> List:
+        return turn_messages(nodes, i, prefix, first_message, responses)
+
+    tasks: Dict[str, asyncio.Task] = {}
+
+    async def run_node(i: int) -> None:
+        await asyncio.gather(*(tasks[dep] for dep in nodes[i].depends_on))
+        messages = conversation(i)
+        response_text, prompt_tokens, completion_tokens = await run_turn(i, messages)
+        usage[0] += prompt_tokens
+        usage[1] += completion_tokens
+        responses[i] = response_text
+
+    for i, node in enumerate(nodes):
+        tasks[node.name] = asyncio.create_task(run_node(i))
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+
+    final = conversation(len(nodes) - 1)
+    final.append({"role": "assistant", "content": [{"type": "text", "text": responses[len(nodes) - 1]}]})
+    return final, usage[0], usage[1]
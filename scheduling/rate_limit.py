@@ -0,0 +1,167 @@
+import time
+import random
+import asyncio
+import email.utils
+from typing import List, Optional
+
+import openai
+
+from scheduling.turns import TurnObserver
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at per_minute / 60 per second, holding at
+    most one minute's worth. Waiters are served in FIFO order. A request larger
+    than the bucket waits for a full bucket and then goes into debt, which later
+    requests pay back."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def take(self, amount: float) -> None:
+        async with self._lock:
+            need = min(amount, self.capacity)
+            self._refill()
+            while self.level < need:
+                await asyncio.sleep((need - self.level) / self.rate)
+                self._refill()
+            self.level -= amount
+
+    def adjust(self, delta: float) -> None:
+        """Charge (positive) or refund (negative) tokens after the fact."""
+        self._refill()
+        self.level = min(self.capacity, self.level - delta)
+
+
+def estimate_prompt_tokens(messages: List, image_tokens: int) -> int:
+    """Rough prompt size before the request is sent: ~4 characters per text token
+    plus a fixed estimate per image."""
+    chars = 0
+    images = 0
+    for message in messages:
+        content = message.get("content", "")
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for item in content:
+            if item.get("type") == "image_url":
+                images += 1
+            else:
+                chars += len(item.get("text", ""))
+    return chars // 4 + images * image_tokens
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """Seconds the server asked us to wait (retry-after-ms or Retry-After), if any."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable_error(error: BaseException) -> bool:
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class RateLimiter(TurnObserver):
+    """Client-side requests-per-minute and tokens-per-minute limits, shared by every
+    turn of every image, plus retries of rate limited and transient failures.
+
+    Before a turn, one request and the estimated prompt tokens are taken from the
+    buckets. Afterwards the token bucket is corrected with the actual usage (or,
+    if the server reports none, the estimate plus the response length). A 429 with
+    Retry-After pauses all turns until then, not just the one that got it. Retry
+    delays are exponential with full jitter, and never shorter than Retry-After.
+    """
+
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0,
+                 image_token_estimate: int = 1000, max_retries: int = 5,
+                 backoff_base: float = 1.0, backoff_max: float = 60.0):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.image_token_estimate = image_token_estimate
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retries = 0
+        self._paused_until = 0.0
+
+    async def before_turn(self, request: dict) -> None:
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        if self.requests is not None:
+            await self.requests.take(1)
+        if self.tokens is not None:
+            estimate = estimate_prompt_tokens(request["messages"], self.image_token_estimate)
+            request["rate_limit_estimate"] = estimate
+            await self.tokens.take(estimate)
+
+    def after_turn(self, request: dict, stats: dict) -> None:
+        if self.tokens is None:
+            return
+        estimate = request.get("rate_limit_estimate", 0)
+        if stats["prompt_tokens"] or stats["completion_tokens"]:
+            actual = stats["prompt_tokens"] + stats["completion_tokens"]
+        else:
+            actual = estimate + stats["response_chars"] // 4
+        self.tokens.adjust(actual - estimate)
+
+    def retry_delay(self, request: dict, error: BaseException, attempt: int) -> Optional[float]:
+        if attempt >= self.max_retries or not is_retryable_error(error):
+            return None
+        if self.tokens is not None:
+            # The failed attempt's reservation is not spent; the retry takes it again.
+            self.tokens.adjust(-request.get("rate_limit_estimate", 0))
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            delay = retry_after + random.uniform(0, self.backoff_base)
+            if isinstance(error, openai.RateLimitError):
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        self.retries += 1
+        print(f"  --> {type(error).__name__}, retrying in {delay:.1f}s (attempt {attempt + 1}/{self.max_retries})")
+        return delay
+
+
+def create_rate_limiter(conf) -> Optional[RateLimiter]:
+    """Limiter configured by the rate_limit section, or None when it is absent."""
+    rate_limit = conf.get("rate_limit", None)
+    if not rate_limit:
+        return None
+    return RateLimiter(
+        requests_per_minute=rate_limit.get("requests_per_minute", 0),
+        tokens_per_minute=rate_limit.get("tokens_per_minute", 0),
+        image_token_estimate=rate_limit.get("image_token_estimate", 1000),
+        max_retries=rate_limit.get("max_retries", 5),
+        backoff_base=rate_limit.get("backoff_base", 1.0),
+        backoff_max=rate_limit.get("backoff_max", 60.0),
+    )
@@ -0,0 +1,53 @@
+import os
+import hashlib
+from typing import Optional
+
+
+def shard_of(relative_path: str, shard_count: int) -> int:
+    """The shard an image belongs to, from a hash of its path relative to
+    base_directory. Separators are normalized, so workers on Windows and on
+    POSIX (or with the share mounted in different places) agree."""
+    key = relative_path.replace("\\", "/")
+    digest = hashlib.sha256(key.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % shard_count
+
+
+class Shard:
+    """Selects this worker's part of the image set: index out of count disjoint
+    shards. Any number of workers, each with its own index, the same count and
+    base_directory pointing at the same dataset (it may be mounted in different
+    places), cover every image exactly once without talking to each other.
+    Counts every image it is asked about, for the per-shard summary."""
+
+    def __init__(self, index: int, count: int, base_directory: str):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"shard_index must be between 0 and shard_count - 1 ({count - 1}), got {index}")
+        self.index = index
+        self.count = count
+        self.base_directory = base_directory
+        self.seen = 0
+        self.selected = 0
+
+    @property
+    def label(self) -> str:
+        return f"shard {self.index}/{self.count}"
+
+    def selects(self, image_path: str) -> bool:
+        self.seen += 1
+        if shard_of(os.path.relpath(image_path, self.base_directory), self.count) != self.index:
+            return False
+        self.selected += 1
+        return True
+
+    def summary(self) -> str:
+        return (f"Shard {self.index} of {self.count}: {self.selected} of {self.seen} walked images belong to this shard "
+                f"(the other shards' runs should report the remaining {self.seen - self.selected})")
+
+
+def create_shard(conf) -> Optional[Shard]:
+    """The Shard set by shard_index and shard_count, or None when shard_count is 1 (the default)."""
+    count = int(conf.get("shard_count", 1) or 1)
+    index = int(conf.get("shard_index", 0) or 0)
+    if count == 1 and index == 0:
+        return None
+    return Shard(index, count, conf.base_directory)
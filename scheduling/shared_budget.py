@@ -0,0 +1,83 @@
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class SharedConcurrencyBudget:
+    """Conversations in flight per endpoint, shared by every job of the process.
+
+    Each job runs on its own thread and event loop with its own EndpointPool, and
+    takes a slot here as well as in its pool for every conversation, so jobs
+    running side by side together stay within what each server can take. An
+    endpoint's limit is the highest concurrency any running job gives it, i.e.
+    what that job alone would send it. An endpoint is a url and the model
+    asked for there, so base_url entries of one server with different models
+    keep separate limits instead of overwriting each other's. When a slot is
+    given back every subscribed pool is woken, on its own loop, to try again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._limits: Dict[Tuple[str, str], List[int]] = {}
+        self._in_flight: Dict[Tuple[str, str], int] = {}
+        self._wakers: List[Callable[[], None]] = []
+
+    @staticmethod
+    def _key(url: str, model: str) -> Tuple[str, str]:
+        return url.rstrip("/"), model or ""
+
+    def register(self, url: str, concurrency: int, model: str = "") -> None:
+        """A job's endpoint, with the concurrency that job gives it."""
+        with self._lock:
+            self._limits.setdefault(self._key(url, model), []).append(concurrency)
+
+    def unregister(self, url: str, concurrency: int, model: str = "") -> None:
+        key = self._key(url, model)
+        with self._lock:
+            limits = self._limits.get(key, [])
+            if concurrency in limits:
+                limits.remove(concurrency)
+            if not limits:
+                self._limits.pop(key, None)
+
+    def limit(self, url: str, model: str = "") -> Optional[int]:
+        with self._lock:
+            limits = self._limits.get(self._key(url, model))
+            return max(limits) if limits else None
+
+    def try_acquire(self, url: str, model: str = "") -> bool:
+        key = self._key(url, model)
+        with self._lock:
+            limits = self._limits.get(key)
+            in_flight = self._in_flight.get(key, 0)
+            if limits and in_flight >= max(limits):
+                return False
+            self._in_flight[key] = in_flight + 1
+            return True
+
+    def release(self, url: str, model: str = "") -> None:
+        key = self._key(url, model)
+        with self._lock:
+            self._in_flight[key] = max(0, self._in_flight.get(key, 0) - 1)
+            wakers = list(self._wakers)
+        for wake in wakers:
+            try:
+                wake()
+            except RuntimeError:
+                # The loop of a pool that is shutting down is already closed
+                pass
+
+    def subscribe(self, wake: Callable[[], None]) -> None:
+        """Call wake, from any thread, whenever a slot is given back."""
+        with self._lock:
+            self._wakers.append(wake)
+
+    def unsubscribe(self, wake: Callable[[], None]) -> None:
+        with self._lock:
+            if wake in self._wakers:
+                self._wakers.remove(wake)
+
+    def status(self) -> Dict[str, Dict[str, int]]:
+        """In-flight conversations and limit of every endpoint in use, by "url (model)"."""
+        with self._lock:
+            return {f"{url} ({model})" if model else url: {"in_flight": self._in_flight.get((url, model), 0), "limit": max(limits)}
+                    for (url, model), limits in self._limits.items()}
@@ -0,0 +1,92 @@
+import time
+import asyncio
+from typing import List, Optional, Sequence, Tuple
+
+
+class TurnObserver:
+    """Hooks around each chat completion turn. Subclasses override what they need.
+
+    request is a dict with the turn's messages and create() kwargs, shared by all
+    hooks of one attempt, so observers may stash their own bookkeeping in it.
+    before_turn is awaited before the request is sent and may delay it.
+    after_turn receives a stats dict for a completed turn:
+        started, latency, ttft, prompt_tokens, completion_tokens, tokens_per_s, response_chars
+    on_error receives the exception of a failed attempt and the seconds it took.
+    retry_delay may return the seconds to wait before retrying a failed attempt,
+    or None to leave it failed.
+    """
+
+    async def before_turn(self, request: dict) -> None:
+        pass
+
+    def after_turn(self, request: dict, stats: dict) -> None:
+        pass
+
+    def on_error(self, request: dict, error: BaseException, elapsed: float) -> None:
+        pass
+
+    def retry_delay(self, request: dict, error: BaseException, attempt: int) -> Optional[float]:
+        return None
+
+
+async def stream_chat_turn(client, messages: List, observers: Sequence[TurnObserver] = (), **create_kwargs) -> Tuple[str, int, int]:
+    """Send one streamed chat completion turn and collect the response.
+
+    Returns (response_text, prompt_tokens, completion_tokens); token counts are
+    0 when the server does not report usage. Observers see every attempt. A
+    failed attempt is retried from scratch if any observer asks for a retry.
+    """
+    attempt = 0
+    while True:
+        request = {"messages": messages, **create_kwargs}
+        try:
+            return await _stream_attempt(client, request, observers, messages, create_kwargs)
+        except Exception as e:
+            delays = [d for d in (o.retry_delay(request, e, attempt) for o in observers) if d is not None]
+            if not delays:
+                raise
+            attempt += 1
+            await asyncio.sleep(max(delays))
+
+
+async def _stream_attempt(client, request: dict, observers: Sequence[TurnObserver], messages: List, create_kwargs: dict) -> Tuple[str, int, int]:
+    for observer in observers:
+        await observer.before_turn(request)
+
+    started = time.perf_counter()
+    first_token_at = None
+    response_text = ""
+    prompt_tokens = 0
+    completion_tokens = 0
+    try:
+        stream = await client.chat.completions.create(messages=messages, stream=True, **create_kwargs)
+        async for event in stream:
+            if event.choices and event.choices[0].delta.content is not None:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                response_text += event.choices[0].delta.content
+            if event.usage:
+                completion_tokens += event.usage.completion_tokens
+                prompt_tokens += event.usage.prompt_tokens
+    except Exception as e:
+        elapsed = time.perf_counter() - started
+        for observer in observers:
+            observer.on_error(request, e, elapsed)
+        raise
+
+    finished = time.perf_counter()
+    latency = finished - started
+    ttft = (first_token_at - started) if first_token_at is not None else latency
+    decode_time = finished - first_token_at if first_token_at is not None else 0.0
+    stats = {
+        "started": started,
+        "latency": latency,
+        "ttft": ttft,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "tokens_per_s": completion_tokens / decode_time if decode_time > 0 else 0.0,
+        "response_chars": len(response_text),
+    }
+    for observer in observers:
+        observer.after_turn(request, stats)
+    return response_text, prompt_tokens, completion_tokens
@@ -0,0 +1,156 @@
+import asyncio
+import os
+import time
+
+import openai
+import pytest
+from omegaconf import OmegaConf
+
+from scheduling.adaptive import AdaptiveConcurrency, create_adaptive_concurrency
+from scheduling.endpoints import EndpointPool
+from scheduling.turns import TurnObserver, stream_chat_turn
+
+
+def _pool(capacity=32):
+    pool = EndpointPool()
+    pool.add("ep", object(), OmegaConf.create({"model": "m"}), capacity)
+    return pool
+
+
+def _stats(latency, tokens=100, started=None):
+    return {
+        "started": time.perf_counter() if started is None else started,
+        "latency": latency,
+        "ttft": 0.1,
+        "prompt_tokens": 10,
+        "completion_tokens": tokens,
+        "tokens_per_s": tokens / latency,
+        "response_chars": tokens * 4,
+    }
+
+
+def _rate_limit_error():
+    response = type('Response', (), {'status_code': 429, 'headers': {}, 'request': None})()
+    return openai.RateLimitError("slow down", response=response, body=None)
+
+
+class TestAdaptiveConcurrency:
+    def test_additive_increase_after_a_window_of_successes(self, capsys):
+        pool = _pool()
+        controller = AdaptiveConcurrency(pool, min_limit=2, max_limit=8)
+        assert pool.limit == 2
+        for _ in range(2):
+            controller.after_turn({}, _stats(1.0))
+        assert controller.limit == 3
+        assert pool.limit == 3
+        assert "Concurrency 2 -> 3" in capsys.readouterr().out
+
+    def test_never_exceeds_max(self):
+        controller = AdaptiveConcurrency(_pool(), min_limit=1, max_limit=3)
+        for _ in range(50):
+            controller.after_turn({}, _stats(1.0))
+        assert controller.limit == 3
+
+    def test_latency_inflation_decreases_once_per_episode(self):
+        controller = AdaptiveConcurrency(_pool(), min_limit=1, max_limit=16, initial=10,
+                                         latency_tolerance=1.5, smoothing=1.0)
+        controller.after_turn({}, _stats(1.0))
+        old_start = time.perf_counter()
+        controller.after_turn({}, _stats(5.0))
+        assert controller.limit == 7
+        # turns that started before the decrease do not cut the limit again
+        controller.after_turn({}, _stats(5.0, started=old_start))
+        assert controller.limit == 7
+
+    def test_rate_limit_error_decreases(self):
+        controller = AdaptiveConcurrency(_pool(), min_limit=2, max_limit=16, initial=10)
+        controller.on_error({}, _rate_limit_error(), 0.0)
+        assert controller.limit == 7
+
+    def test_request_errors_are_ignored(self):
+        controller = AdaptiveConcurrency(_pool(), min_limit=2, max_limit=16, initial=10)
+        controller.on_error({}, ValueError("bad"), 0.0)
+        assert controller.limit == 10
+
+    def test_summary_reports_range(self):
+        controller = AdaptiveConcurrency(_pool(), min_limit=1, max_limit=4)
+        for _ in range(3):
+            controller.after_turn({}, _stats(1.0))
+        summary = controller.summary()
+        assert "final 3" in summary
+        assert "min 1" in summary
+        assert "max 3" in summary
+
+    def test_disabled_by_default(self):
+        assert create_adaptive_concurrency(OmegaConf.create({}), _pool()) is None
+
+    def test_max_capped_by_pool_capacity(self):
+        conf = OmegaConf.create({"adaptive_concurrency": {"enabled": True, "min": 1, "max": 64}})
+        assert create_adaptive_concurrency(conf, _pool(capacity=8)).max_limit == 8
+
+    def test_shipped_config_block(self):
+        conf = OmegaConf.load(os.path.join(os.path.dirname(__file__), "..", "caption.yaml"))
+        assert create_adaptive_concurrency(conf, _pool()) is None
+        conf.adaptive_concurrency.enabled = True
+        # max 0 leaves the endpoints' concurrency as the ceiling
+        assert create_adaptive_concurrency(conf, _pool(capacity=8)).max_limit == 8
+
+
+class _Event:
+    def __init__(self, content=None, usage=None):
+        self.choices = [type('C', (), {'delta': type('D', (), {'content': content})()})()] if content is not None else []
+        self.usage = usage
+
+
+class _Client:
+    def __init__(self, fail=None):
+        self.fail = fail
+        self.kwargs = None
+        self.chat = type('Chat', (), {'completions': type('Comp', (), {'create': self._create})()})()
+
+    async def _create(self, **kwargs):
+        self.kwargs = kwargs
+        if self.fail:
+            raise self.fail
+
+        async def gen():
+            yield _Event("hello ")
+            yield _Event("world")
+            yield _Event(usage=type('U', (), {'prompt_tokens': 5, 'completion_tokens': 2})())
+        return gen()
+
+
+class _Recorder(TurnObserver):
+    def __init__(self):
+        self.before = []
+        self.after = []
+        self.errors = []
+
+    async def before_turn(self, request):
+        self.before.append(request)
+
+    def after_turn(self, request, stats):
+        self.after.append(stats)
+
+    def on_error(self, request, error, elapsed):
+        self.errors.append(error)
+
+
+class TestStreamChatTurn:
+    def test_collects_text_usage_and_notifies_observers(self):
+        client, recorder = _Client(), _Recorder()
+        text, prompt_tokens, completion_tokens = asyncio.run(
+            stream_chat_turn(client, [{"role": "user", "content": "hi"}], [recorder], model="m"))
+        assert (text, prompt_tokens, completion_tokens) == ("hello world", 5, 2)
+        assert client.kwargs["stream"] is True
+        assert client.kwargs["model"] == "m"
+        assert recorder.before[0]["model"] == "m"
+        assert recorder.after[0]["completion_tokens"] == 2
+        assert recorder.after[0]["response_chars"] == len("hello world")
+
+    def test_errors_reach_observers_and_propagate(self):
+        client, recorder = _Client(fail=ValueError("boom")), _Recorder()
+        with pytest.raises(ValueError):
+            asyncio.run(stream_chat_turn(client, [], [recorder], model="m"))
+        assert len(recorder.errors) == 1
+        assert recorder.after == []
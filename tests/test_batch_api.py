@@ -0,0 +1,171 @@
+import asyncio
+import json
+
+import openai
+import pytest
+from omegaconf import OmegaConf
+
+from batch_api.batch_job import (batch_main, custom_id, export_requests, import_results, open_batch_state, parse_custom_id,
+                                 parse_result_line)
+from batch_api.batch_state import STATUS_DONE, STATUS_EXPORTED, STATUS_PENDING
+from batch_api.local_runner import run_request_file
+from benchmarks.mock_server import MockServer, MockServerConfig
+
+GRAPH = [
+    {"name": "describe", "prompt": "Describe"},
+    {"name": "identify", "prompt": "Identify", "depends_on": "describe"},
+    {"name": "composition", "prompt": "Composition", "depends_on": "describe"},
+    {"name": "summary", "prompt": "Summarize", "depends_on": ["identify", "composition"]},
+]
+
+
+def _conf(tmp_path, **overrides):
+    for name in ("a.jpg", "b.png"):
+        (tmp_path / name).write_bytes(b"not really an image")
+    return OmegaConf.create({
+        "base_directory": str(tmp_path), "recursive": False, "model": "mock", "max_tokens": 100,
+        "system_prompt": "Be factual.", "prompts": ["Describe", "Summarize"], "output_format": "txt",
+        "batch_api": {"directory": str(tmp_path / "batch")}, **overrides,
+    })
+
+
+def _read_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+async def _round(conf, state, server, tmp_path, round_number):
+    paths = await export_requests(conf, state, conf.batch_api.directory)
+    client = openai.AsyncOpenAI(base_url=server.base_url, api_key="mock", max_retries=0)
+    try:
+        results = []
+        for number, path in enumerate(paths):
+            result_path = str(tmp_path / f"results-{round_number}-{number}.jsonl")
+            await run_request_file(client, path, result_path)
+            results.append(result_path)
+    finally:
+        await client.close()
+    requests = [line for path in paths for line in _read_lines(path)]
+    return requests, await import_results(conf, state, results)
+
+
+class TestResultLines:
+    def test_custom_id_round_trip(self):
+        assert parse_custom_id(custom_id(12, 3)) == (12, 3)
+        assert parse_custom_id("someone-else") is None
+
+    def test_success(self):
+        line = json.dumps({"custom_id": "img1-t0", "error": None, "response": {"status_code": 200, "body": {
+            "choices": [{"message": {"role": "assistant", "content": "a cat"}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 2}}}})
+        assert parse_result_line(line) == ("img1-t0", "a cat", 10, 2, None)
+
+    def test_failed_status_and_error(self):
+        failed = parse_result_line(json.dumps({"custom_id": "img1-t0", "response": {
+            "status_code": 400, "body": {"error": {"message": "bad image"}}}}))
+        assert failed.text is None and failed.error == "HTTP 400: bad image"
+        expired = parse_result_line(json.dumps({"custom_id": "img1-t0", "response": None,
+                                                "error": {"code": "batch_expired", "message": "expired"}}))
+        assert expired.error == "expired"
+
+
+class TestBatchRoundTrip:
+    def test_one_batch_per_stage(self, tmp_path):
+        conf = _conf(tmp_path, prompt_graph=GRAPH)
+
+        async def run():
+            state = open_batch_state(conf)
+            try:
+                async with MockServer(MockServerConfig(ttft=0, tokens_per_s=10000, completion_tokens=3)) as server:
+                    rounds = [await _round(conf, state, server, tmp_path, i) for i in range(4)]
+                return rounds, await state.counts()
+            finally:
+                state.close()
+
+        rounds, counts = asyncio.run(run())
+        turns = [sorted(parse_custom_id(r["custom_id"])[1] for r in requests) for requests, _ in rounds]
+        assert turns == [[0, 0], [1, 1, 2, 2], [3, 3], []]
+        assert [totals["captioned"] for _, totals in rounds] == [0, 0, 2, 0]
+        assert counts == {(STATUS_DONE, 2): 2}
+        assert (tmp_path / "a.txt").read_text().strip() == "tok tok tok"
+
+        first, summary = rounds[0][0][0]["body"], rounds[2][0][0]["body"]
+        assert first["max_tokens"] == 100 and first["messages"][0] == {"role": "system", "content": "Be factual."}
+        assert first["messages"][1]["content"][1]["image_url"]["url"].startswith("data:image/")
+        # The summary sees the image turn and both branches, not itself twice
+        assert [m["role"] for m in summary["messages"]] == ["system"] + ["user", "assistant"] * 3 + ["user"]
+        assert "max_tokens" not in summary
+
+    def test_failed_requests_are_exported_again(self, tmp_path):
+        conf = _conf(tmp_path)
+
+        async def run():
+            state = open_batch_state(conf)
+            try:
+                async with MockServer(MockServerConfig(ttft=0, error_rate=1.0, rate_limit_share=0)) as server:
+                    _, failed = await _round(conf, state, server, tmp_path, 0)
+                counts = await state.counts()
+                async with MockServer(MockServerConfig(ttft=0, tokens_per_s=10000, completion_tokens=2)) as server:
+                    retried, _ = await _round(conf, state, server, tmp_path, 1)
+                return failed, counts, retried, await state.failures()
+            finally:
+                state.close()
+
+        failed, counts, retried, failures = asyncio.run(run())
+        assert failed["failed"] == 2 and counts == {(STATUS_PENDING, 0): 2}
+        assert sorted(parse_custom_id(r["custom_id"])[1] for r in retried) == [0, 0]
+        assert failures == []
+
+    def test_stale_and_duplicate_results_ignored(self, tmp_path):
+        conf = _conf(tmp_path)
+
+        async def run():
+            state = open_batch_state(conf)
+            try:
+                async with MockServer(MockServerConfig(ttft=0, tokens_per_s=10000, completion_tokens=2)) as server:
+                    await _round(conf, state, server, tmp_path, 0)
+                    again = await import_results(conf, state, [str(tmp_path / "results-0-0.jsonl")])
+                return again, await state.counts()
+            finally:
+                state.close()
+
+        again, counts = asyncio.run(run())
+        assert again["ignored"] == 2 and again["responses"] == 0
+        assert counts == {(STATUS_PENDING, 1): 2}
+
+    def test_request_files_split_at_max_requests(self, tmp_path):
+        conf = _conf(tmp_path, batch_api={"directory": str(tmp_path / "batch"), "max_requests": 1})
+
+        async def run():
+            state = open_batch_state(conf)
+            try:
+                paths = await export_requests(conf, state, conf.batch_api.directory)
+                return paths, await state.counts()
+            finally:
+                state.close()
+
+        paths, counts = asyncio.run(run())
+        assert len(paths) == 2 and all(len(_read_lines(path)) == 1 for path in paths)
+        assert counts == {(STATUS_EXPORTED, 0): 2}
+
+    def test_changed_prompts_rejected(self, tmp_path):
+        conf = _conf(tmp_path)
+
+        async def run():
+            state = open_batch_state(conf)
+            try:
+                await export_requests(conf, state, conf.batch_api.directory)
+                conf.prompts = ["Something else"]
+                await export_requests(conf, state, conf.batch_api.directory)
+            finally:
+                state.close()
+
+        with pytest.raises(ValueError, match="different model or prompts"):
+            asyncio.run(run())
+
+    def test_sharding_rejected(self, tmp_path):
+        config = tmp_path / "caption.yaml"
+        OmegaConf.save(_conf(tmp_path), config)
+        with pytest.raises(ValueError, match="batch mode"):
+            asyncio.run(batch_main(str(config), export=True, overrides={"shard_index": 1, "shard_count": 4}))
+        assert not (tmp_path / "batch").exists()
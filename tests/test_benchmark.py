@@ -0,0 +1,67 @@
+import asyncio
+import sys
+
+import openai
+import pytest
+
+from benchmarks.mock_server import MockServer, MockServerConfig
+from benchmarks.run_benchmark import make_image_tree, run_level
+from scheduling.turns import stream_chat_turn
+
+
+def _client(server):
+    return openai.AsyncOpenAI(base_url=server.base_url, api_key="mock", max_retries=0)
+
+
+class TestMockServer:
+    def test_streams_tokens_and_usage(self):
+        async def run():
+            async with MockServer(MockServerConfig(ttft=0.01, tokens_per_s=1000, completion_tokens=5)) as server:
+                client = _client(server)
+                result = await stream_chat_turn(client, [{"role": "user", "content": "hi"}], model="mock")
+                await client.close()
+                return result
+        text, prompt_tokens, completion_tokens = asyncio.run(run())
+        assert text == "tok " * 5
+        assert completion_tokens == 5
+        assert prompt_tokens > 0
+
+    def test_lists_models(self):
+        async def run():
+            async with MockServer() as server:
+                client = _client(server)
+                models = await client.models.list()
+                await client.close()
+                return [model.id for model in models.data]
+        assert asyncio.run(run()) == ["mock"]
+
+    def test_injects_rate_limit_errors(self):
+        async def run():
+            config = MockServerConfig(error_rate=1.0, rate_limit_share=1.0, retry_after=2)
+            async with MockServer(config) as server:
+                client = _client(server)
+                try:
+                    await stream_chat_turn(client, [], model="mock")
+                finally:
+                    await client.close()
+        with pytest.raises(openai.RateLimitError) as error:
+            asyncio.run(run())
+        assert error.value.response.headers["retry-after"] == "2"
+
+
+class TestRunBenchmark:
+    def test_single_level(self, tmp_path):
+        image_dir = tmp_path / "images"
+        make_image_tree(str(image_dir), 3, per_dir=2, size=32)
+
+        async def run():
+            config = MockServerConfig(ttft=0.0, tokens_per_s=10000, completion_tokens=4)
+            async with MockServer(config) as server:
+                return await run_level(sys.executable, str(tmp_path), server.base_url, str(image_dir),
+                                       concurrency=2, prompts=2, overrides=[], verbose=False)
+        result = asyncio.run(run())
+        assert result["images"] == 3
+        assert result["failed"] == 0
+        assert result["turns"] == 6
+        assert result["images_per_s"] > 0
+        assert result["loop_lag_max_ms"] is not None
@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+from omegaconf import OmegaConf
+
+from caption_openai import ImageJob, cache_identity, prepare_image, write_image
+from file_utils.caption_cache import CaptionCache, hash_image_bytes
+
+
+class TestCaptionCache:
+    def test_roundtrip_and_miss(self, tmp_path):
+        async def run():
+            cache = CaptionCache(str(tmp_path / "cache.sqlite"))
+            try:
+                assert await cache.get("h1", "m", "p") is None
+                await cache.put("h1", "m", "p", "a caption")
+                assert await cache.get("h1", "m", "p") == "a caption"
+                assert await cache.get("h1", "other-model", "p") is None
+                assert await cache.get("h1", "m", "other prompt") is None
+            finally:
+                cache.close()
+        asyncio.run(run())
+
+    def test_persists_across_instances(self, tmp_path):
+        path = str(tmp_path / "cache.sqlite")
+
+        async def write():
+            cache = CaptionCache(path)
+            await cache.put("h1", "m", "p", "kept")
+            cache.close()
+
+        async def read():
+            cache = CaptionCache(path)
+            try:
+                return await cache.get("h1", "m", "p")
+            finally:
+                cache.close()
+
+        asyncio.run(write())
+        assert asyncio.run(read()) == "kept"
+
+    def test_hash_is_content_based(self):
+        assert hash_image_bytes(b"abc") == hash_image_bytes(b"abc")
+        assert hash_image_bytes(b"abc") != hash_image_bytes(b"abd")
+
+
+class TestPipelineCacheHit:
+    def test_copy_in_other_directory_materialized_from_cache(self, tmp_path):
+        (tmp_path / "a").mkdir()
+        (tmp_path / "b").mkdir()
+        original = tmp_path / "a" / "img.jpg"
+        copy = tmp_path / "b" / "renamed.jpg"
+        original.write_bytes(b"same bytes")
+        copy.write_bytes(b"same bytes")
+        conf = OmegaConf.create({"model": "m", "prompts": ["describe"], "output_format": "txt"})
+
+        async def run():
+            cache = CaptionCache(str(tmp_path / "cache.sqlite"))
+            try:
+                await cache.put(hash_image_bytes(b"same bytes"), "m", cache_identity(conf, None), "cached caption")
+                job = await prepare_image(ImageJob(str(copy)), conf, caption_cache=cache)
+                # A cache hit is ready before it is ever encoded or sent to an endpoint
+                assert job.ready and job.prefetched is None
+                assert "encode" not in job.timer.stages
+                return await write_image(job, conf, caption_cache=cache)
+            finally:
+                cache.close()
+
+        result = asyncio.run(run())
+        assert result["success"] is True
+        assert result["cached"] is True
+        assert (tmp_path / "b" / "renamed.txt").read_text(encoding="utf-8") == "cached caption"
+
+    def test_system_prompt_and_hints_are_part_of_the_key(self, tmp_path):
+        image = tmp_path / "img.jpg"
+        image.write_bytes(b"bytes")
+        conf = OmegaConf.create({"model": "m", "prompts": ["describe"], "system_prompt": "be brief"})
+        edited = OmegaConf.create({"model": "m", "prompts": ["describe"], "system_prompt": "be thorough"})
+        hinted = OmegaConf.create({"model": "m", "prompts": ["describe"], "system_prompt": "be brief",
+                                   "hint_sources": ["full_path"]})
+        assert len({cache_identity(conf, None), cache_identity(edited, None), cache_identity(conf, "in folder a")}) == 3
+
+        async def run():
+            cache = CaptionCache(str(tmp_path / "cache.sqlite"))
+            try:
+                await cache.put(hash_image_bytes(b"bytes"), "m", cache_identity(conf, None), "cached caption")
+                hits = []
+                for c in (conf, edited, hinted):
+                    hits.append((await prepare_image(ImageJob(str(image)), c, caption_cache=cache)).cached)
+                return hits
+            finally:
+                cache.close()
+
+        assert asyncio.run(run()) == [True, False, False]
+
+    def test_preprocess_and_generation_settings_are_part_of_the_key(self, tmp_path):
+        Image = pytest.importorskip("PIL.Image")
+        image = tmp_path / "img.png"
+        Image.new("RGB", (64, 32)).save(image)
+        base = {"model": "m", "prompts": ["describe"], "max_tokens": 500,
+                "image_preprocess": {"enabled": True, "max_long_side": 2048, "format": "jpeg", "quality": 90}}
+        conf = OmegaConf.create(base)
+        confs = [conf, OmegaConf.merge(conf, {"image_preprocess": {"workers": 4}}),
+                 OmegaConf.merge(conf, {"image_preprocess": {"max_long_side": 512}}),
+                 OmegaConf.merge(conf, {"image_preprocess": {"format": "webp"}}),
+                 OmegaConf.merge(conf, {"image_preprocess": {"enabled": False}}),
+                 OmegaConf.merge(conf, {"max_tokens": 50})]
+
+        async def run():
+            cache = CaptionCache(str(tmp_path / "cache.sqlite"))
+            try:
+                await cache.put(hash_image_bytes(image.read_bytes()), "m", cache_identity(conf, None), "cached caption")
+                return [(await prepare_image(ImageJob(str(image)), c, caption_cache=cache)).cached for c in confs]
+            finally:
+                cache.close()
+
+        # The number of preprocess workers does not change the payload
+        assert asyncio.run(run()) == [True, True, False, False, False, False]
+
+    def test_failed_save_is_a_failure_and_not_cached(self, tmp_path):
+        conf = OmegaConf.create({"model": "m", "prompts": ["describe"]})
+
+        async def run():
+            cache = CaptionCache(str(tmp_path / "cache.sqlite"))
+            try:
+                job = ImageJob(str(tmp_path / "missing" / "img.jpg"), model="m", caption_text="a caption",
+                               image_hash="h1", cache_identity="p")
+                result = await write_image(job, conf, caption_cache=cache)
+                return result, await cache.get("h1", "m", "p")
+            finally:
+                cache.close()
+
+        result, cached = asyncio.run(run())
+        assert result["success"] is False and cached is None
+
+    def test_unreadable_image_fails_without_an_endpoint(self, tmp_path):
+        conf = OmegaConf.create({"model": "m", "prompts": ["describe"], "output_format": "txt"})
+
+        async def run():
+            job = await prepare_image(ImageJob(str(tmp_path / "missing.jpg")), conf)
+            assert job.ready
+            return await write_image(job, conf)
+
+        result = asyncio.run(run())
+        assert result["success"] is False
+        assert "missing.jpg" in result["error"]
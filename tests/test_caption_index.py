@@ -0,0 +1,146 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+import file_utils.caption_index as caption_index
+from file_utils.caption_index import CaptionIndex, main as caption_index_main
+from file_utils.file_access import OUTPUT_FORMAT_JSONL, image_walk, save_caption
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def _seed_jsonl(path, entries):
+    with open(path, "w", encoding="utf-8") as f:
+        for e in entries:
+            f.write(json.dumps(e) + "\n")
+
+
+class TestCaptionIndex:
+    def test_save_caption_records_and_contains_answers(self, tmp_path):
+        image = tmp_path / "img.jpg"
+        image.write_bytes(b"\x00")
+
+        async def run():
+            index = CaptionIndex(str(tmp_path / "index.sqlite"))
+            try:
+                before = await index.contains(str(image), "m", "p")
+                await save_caption(str(image), "cap", "", OUTPUT_FORMAT_JSONL, "m", "p", caption_index=index)
+                return before, await index.contains(str(image), "m", "p"), await index.contains(str(image), "m2", "p")
+            finally:
+                index.close()
+
+        assert _run(run()) == (False, True, False)
+
+    def test_picks_up_sidecar_written_without_index(self, tmp_path):
+        image = tmp_path / "img.jpg"
+        image.write_bytes(b"\x00")
+        _seed_jsonl(tmp_path / "img.jsonl", [{"text": "x", "model": "old", "prompt": "p"}])
+
+        async def run():
+            index = CaptionIndex(str(tmp_path / "index.sqlite"))
+            try:
+                return await index.contains(str(image), "old", "p")
+            finally:
+                index.close()
+
+        assert _run(run()) is True
+
+    def test_contains_many(self, tmp_path):
+        for name in ("a", "b", "c"):
+            (tmp_path / f"{name}.jpg").write_bytes(b"\x00")
+        _seed_jsonl(tmp_path / "a.jsonl", [{"text": "x", "model": "m", "prompt": "p"}])
+        _seed_jsonl(tmp_path / "b.jsonl", [{"text": "x", "model": "other", "prompt": "p"}])
+
+        async def run():
+            index = CaptionIndex(str(tmp_path / "index.sqlite"))
+            try:
+                return await index.contains_many([str(tmp_path / f"{n}.jpg") for n in "abc"], "m", "p")
+            finally:
+                index.close()
+
+        assert _run(run()) == [True, False, False]
+
+    def test_external_append_after_indexing_is_reparsed(self, tmp_path):
+        image = tmp_path / "img.jpg"
+        image.write_bytes(b"\x00")
+        sidecar = tmp_path / "img.jsonl"
+        _seed_jsonl(sidecar, [{"text": "x", "model": "a", "prompt": "p"}])
+
+        async def run():
+            index = CaptionIndex(str(tmp_path / "index.sqlite"))
+            try:
+                assert await index.contains(str(image), "b", "p") is False
+                with open(sidecar, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"text": "y", "model": "b", "prompt": "p"}) + "\n")
+                return await index.contains(str(image), "b", "p")
+            finally:
+                index.close()
+
+        assert _run(run()) is True
+
+    def test_image_walk_skips_using_index(self, tmp_path):
+        for name in ("done.jpg", "todo.jpg"):
+            (tmp_path / name).write_bytes(b"\x00")
+
+        async def run():
+            index = CaptionIndex(str(tmp_path / "index.sqlite"))
+            try:
+                await save_caption(str(tmp_path / "done.jpg"), "cap", "", OUTPUT_FORMAT_JSONL, "m", "p", caption_index=index)
+                return [os.path.basename(p) async for p in image_walk(
+                    str(tmp_path), recursive=False, skip_if_caption_exists=True,
+                    output_format=OUTPUT_FORMAT_JSONL, model="m", concat_prompt="p", caption_index=index)]
+            finally:
+                index.close()
+
+        assert _run(run()) == ["todo.jpg"]
+
+    def test_truncated_sidecar_is_captioned_again(self, tmp_path):
+        for name in ("a.jpg", "b.jpg"):
+            (tmp_path / name).write_bytes(b"\x00")
+
+        async def walk(index):
+            return [os.path.basename(p) async for p in image_walk(
+                str(tmp_path), recursive=False, skip_if_caption_exists=True,
+                output_format=OUTPUT_FORMAT_JSONL, model="m", concat_prompt="p", caption_index=index)]
+
+        async def run():
+            index = CaptionIndex(str(tmp_path / "index.sqlite"))
+            try:
+                for name in ("a.jpg", "b.jpg"):
+                    await save_caption(str(tmp_path / name), "cap", "", OUTPUT_FORMAT_JSONL, "m", "p", caption_index=index)
+                skipped_all = await walk(index)
+                # The caption is removed by hand, leaving an empty sidecar
+                (tmp_path / "a.jsonl").write_text("", encoding="utf-8")
+                return skipped_all, await walk(index)
+            finally:
+                index.close()
+
+        assert _run(run()) == ([], ["a.jpg"])
+
+    def test_rebuild_command(self, tmp_path, capsys, monkeypatch):
+        sub = tmp_path / "sub"
+        sub.mkdir()
+        _seed_jsonl(tmp_path / "a.jsonl", [{"text": "x", "model": "m", "prompt": "p"}])
+        _seed_jsonl(sub / "b.jsonl", [{"text": "x", "model": "m", "prompt": "p"}])
+        index_file = str(tmp_path / "index.sqlite")
+
+        assert caption_index_main([str(tmp_path), "--index", index_file]) == 0
+        assert "Indexed 2 sidecar(s)" in capsys.readouterr().out
+
+        def no_reparse(conn, sidecar, stat):
+            raise AssertionError(f"{sidecar} parsed again")
+        monkeypatch.setattr(caption_index, "_index_sidecar", no_reparse)
+
+        async def run():
+            index = CaptionIndex(index_file)
+            try:
+                # entries are found without parsing the unchanged sidecar again
+                return await index.contains(str(sub / "b.png"), "m", "p")
+            finally:
+                index.close()
+
+        assert _run(run()) is True
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import os
+
+import pytest
+from omegaconf import OmegaConf
+
+from file_utils.caption_index import CaptionIndex
+from file_utils.caption_writer import CaptionWriter, create_caption_writer
+from file_utils.file_access import OUTPUT_FORMAT_JSONL, OUTPUT_FORMAT_TXT, write_txt_atomic
+
+
+class TestCaptionWriter:
+    def test_batches_by_record_count(self, tmp_path):
+        async def run():
+            writer = CaptionWriter(flush_interval=60, flush_records=4)
+            for batch in range(2):
+                futures = [await writer.put(str(tmp_path / f"{batch}_{i}.jpg"), f"caption {i}") for i in range(4)]
+                await asyncio.wait_for(asyncio.gather(*futures), 5)
+            await writer.close()
+            return writer.batches
+
+        assert asyncio.run(run()) == 2
+        assert (tmp_path / "1_3.txt").read_text(encoding="utf-8") == "caption 3"
+
+    def test_flushes_after_interval(self, tmp_path):
+        async def run():
+            writer = CaptionWriter(flush_interval=0.05, flush_records=100)
+            future = await writer.put(str(tmp_path / "a.jpg"), "caption")
+            await asyncio.sleep(0.01)
+            assert not future.done()
+            await asyncio.wait_for(future, 1)
+            await writer.close()
+
+        asyncio.run(run())
+        assert (tmp_path / "a.txt").read_text(encoding="utf-8") == "caption"
+
+    def test_jsonl_lines_grouped_and_indexed(self, tmp_path):
+        image = str(tmp_path / "a.jpg")
+        index = CaptionIndex(str(tmp_path / "index.sqlite"))
+
+        async def run():
+            writer = CaptionWriter(flush_interval=60, flush_records=3, caption_index=index)
+            futures = [await writer.put(image, f"caption {model}", OUTPUT_FORMAT_JSONL, model, "p") for model in "xyz"]
+            await asyncio.gather(*futures)
+            await writer.close()
+            return writer.batches, await index.contains(image, "y", "p")
+
+        try:
+            assert asyncio.run(run()) == (1, True)
+        finally:
+            index.close()
+        lines = [json.loads(line) for line in (tmp_path / "a.jsonl").read_text(encoding="utf-8").splitlines()]
+        assert [line["model"] for line in lines] == ["x", "y", "z"]
+
+    def test_newest_txt_caption_wins(self, tmp_path):
+        async def run():
+            writer = CaptionWriter(flush_interval=60, flush_records=2)
+            futures = [await writer.put(str(tmp_path / "a.jpg"), text) for text in ("old", "new")]
+            await asyncio.gather(*futures)
+            await writer.close()
+
+        asyncio.run(run())
+        assert (tmp_path / "a.txt").read_text(encoding="utf-8") == "new"
+        assert os.listdir(tmp_path) == ["a.txt"]
+
+    def test_failed_write_fails_only_its_caption(self, tmp_path):
+        async def run():
+            writer = CaptionWriter(flush_interval=60, flush_records=2)
+            bad = await writer.put(str(tmp_path / "missing_dir" / "a.jpg"), "caption")
+            good = await writer.put(str(tmp_path / "b.jpg"), "caption")
+            results = await asyncio.gather(bad, good, return_exceptions=True)
+            await writer.close()
+            return results
+
+        bad, good = asyncio.run(run())
+        assert isinstance(bad, OSError)
+        assert good is None
+
+    def test_put_waits_when_full(self, tmp_path):
+        async def run():
+            writer = CaptionWriter(flush_interval=60, flush_records=100, max_pending=2)
+            await writer.put(str(tmp_path / "a.jpg"), "a")
+            await writer.put(str(tmp_path / "b.jpg"), "b")
+            third = asyncio.create_task(writer.put(str(tmp_path / "c.jpg"), "c"))
+            await asyncio.sleep(0.01)
+            assert not third.done()
+            await writer.close()
+            return third.done()
+
+        assert asyncio.run(run()) is True
+
+    def test_close_writes_pending(self, tmp_path):
+        async def run():
+            writer = CaptionWriter(flush_interval=60, flush_records=100)
+            future = await writer.put(str(tmp_path / "a.jpg"), "caption")
+            await writer.close()
+            return future.done()
+
+        assert asyncio.run(run()) is True
+
+    def test_create_caption_writer(self):
+        assert create_caption_writer(OmegaConf.create({})) is not None
+        assert create_caption_writer(OmegaConf.create({"caption_writer": {"enabled": False}})) is None
+        assert create_caption_writer(OmegaConf.create({"output_format": "jsonl_shards"})) is None
+        writer = create_caption_writer(OmegaConf.create({"caption_writer": {"flush_records": 8}}))
+        assert writer.flush_records == 8 and writer.max_pending == 32
+
+
+class TestWriteTxtAtomic:
+    def test_leaves_no_temp_file_on_error(self, tmp_path, monkeypatch):
+        def fail(src, dst):
+            raise OSError("rename failed")
+        monkeypatch.setattr(os, "replace", fail)
+        with pytest.raises(OSError):
+            write_txt_atomic(str(tmp_path / "a.txt"), "caption")
+        assert os.listdir(tmp_path) == []
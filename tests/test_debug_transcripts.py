@@ -0,0 +1,62 @@
+import asyncio
+import os
+
+import openai
+from omegaconf import OmegaConf
+
+from benchmarks.mock_server import MockServer, MockServerConfig
+from caption_openai import process_image
+from file_utils.debug_transcripts import DebugTranscriptStore, open_debug_transcripts
+
+
+class TestDebugTranscriptStore:
+    def test_add_and_read_back(self, tmp_path):
+        store = DebugTranscriptStore(str(tmp_path / "debug.sqlite"))
+        try:
+            store.add("a.jpg", {"image_path": "a.jpg", "turns": [{"turn": "turn0", "response": "hi"}]})
+            store.add("b.jpg", {"image_path": "b.jpg", "error": "boom"})
+            records = store.transcripts()
+            assert [r["image_path"] for r in records] == ["b.jpg", "a.jpg"]
+            assert store.transcripts("a.jpg")[0]["turns"][0]["response"] == "hi"
+        finally:
+            store.close()
+
+    def test_keeps_newest_records(self, tmp_path):
+        store = DebugTranscriptStore(str(tmp_path / "debug.sqlite"), max_records=3)
+        try:
+            for i in range(10):
+                store.add(f"{i}.jpg", {"image_path": f"{i}.jpg"})
+            assert [r["image_path"] for r in store.transcripts()] == ["9.jpg", "8.jpg", "7.jpg"]
+        finally:
+            store.close()
+
+    def test_disabled_by_default(self):
+        assert open_debug_transcripts(OmegaConf.create({})) is None
+
+
+class TestProcessImageTranscript:
+    def test_records_conversation_without_image(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        image = tmp_path / "img.png"
+        image.write_bytes(b"not really a png")
+        conf = OmegaConf.create({"model": "mock", "max_tokens": 10, "prompts": ["describe", "summarize"]})
+        store = DebugTranscriptStore(str(tmp_path / "debug.sqlite"))
+
+        async def run():
+            async with MockServer(MockServerConfig(ttft=0.0, tokens_per_s=10000, completion_tokens=3)) as server:
+                client = openai.AsyncOpenAI(base_url=server.base_url, api_key="mock", max_retries=0)
+                try:
+                    return await process_image(client, str(image), conf, debug_transcripts=store)
+                finally:
+                    await client.close()
+
+        try:
+            asyncio.run(run())
+            record = store.transcripts(str(image))[0]
+        finally:
+            store.close()
+        assert [turn["turn"] for turn in record["turns"]] == ["turn0", "turn1"]
+        assert record["turns"][1]["response"].strip() == "tok tok tok"
+        assert "base64" not in str(record["messages"])
+        assert "error" not in record
+        assert not [name for name in os.listdir(tmp_path) if name.startswith("messages_")]
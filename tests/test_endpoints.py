@@ -0,0 +1,114 @@
+import asyncio
+
+import openai
+import pytest
+from omegaconf import OmegaConf
+
+from scheduling.endpoints import EndpointPool, create_endpoint_pool, endpoint_configs
+
+
+class _FakeModels:
+    def __init__(self):
+        self.healthy = False
+
+    async def list(self):
+        if not self.healthy:
+            raise openai.APIConnectionError(request=None)
+        return []
+
+
+class _FakeClient:
+    def __init__(self, base_url="", api_key=""):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.models = _FakeModels()
+
+    async def close(self):
+        pass
+
+
+def _pool(*concurrencies, **kwargs):
+    pool = EndpointPool(**kwargs)
+    for i, c in enumerate(concurrencies):
+        pool.add(f"ep{i}", _FakeClient(), OmegaConf.create({"model": "m"}), c)
+    return pool
+
+
+class TestEndpointConfigs:
+    def test_single_string_uses_top_level_settings(self):
+        conf = OmegaConf.create({"base_url": "http://a/v1", "concurrent_batch_size": 4, "model": "m"})
+        assert endpoint_configs(conf) == [{"url": "http://a/v1", "concurrency": 4, "model": "m", "api_key": None}]
+
+    def test_list_with_overrides(self):
+        conf = OmegaConf.create({
+            "base_url": ["http://a/v1", {"url": "http://b/v1", "concurrency": 8, "model": "other", "api_key": "k"}],
+            "concurrent_batch_size": 2,
+            "model": "m",
+        })
+        configs = endpoint_configs(conf)
+        assert configs[0] == {"url": "http://a/v1", "concurrency": 2, "model": "m", "api_key": None}
+        assert configs[1] == {"url": "http://b/v1", "concurrency": 8, "model": "other", "api_key": "k"}
+
+    def test_create_pool_applies_per_endpoint_model_and_key(self):
+        conf = OmegaConf.create({
+            "base_url": [{"url": "http://a/v1", "model": "x", "api_key": "secret"}, "http://b/v1"],
+            "concurrent_batch_size": 3, "model": "m", "api_key": "",
+        })
+        pool = create_endpoint_pool(conf, _FakeClient, lambda c: c.api_key)
+        assert [e.conf.model for e in pool.endpoints] == ["x", "m"]
+        assert [e.client.api_key for e in pool.endpoints] == ["secret", ""]
+        assert pool.capacity == 6
+
+
+class TestEndpointPool:
+    def test_dispatches_to_least_loaded(self):
+        async def run():
+            pool = _pool(4, 2)
+            picks = [(await pool.acquire()).name for _ in range(6)]
+            return picks, pool.in_flight
+        picks, in_flight = asyncio.run(run())
+        assert sorted(picks) == ["ep0"] * 4 + ["ep1"] * 2
+        assert picks[:2] == ["ep0", "ep1"]
+        assert in_flight == 6
+
+    def test_acquire_waits_for_release(self):
+        async def run():
+            pool = _pool(1)
+            first = await pool.acquire()
+            waiter = asyncio.create_task(pool.acquire())
+            await asyncio.sleep(0)
+            assert not waiter.done()
+            first.release()
+            return await asyncio.wait_for(waiter, 1)
+        assert asyncio.run(run()).name == "ep0"
+
+    def test_ejects_after_consecutive_failures_and_readmits(self):
+        async def run():
+            pool = _pool(1, 1, failure_threshold=2, check_interval=0.01)
+            bad, good = pool.endpoints
+            error = openai.APIConnectionError(request=None)
+            pool.report(bad, False, error)
+            assert bad.healthy
+            pool.report(bad, False, error)
+            assert not bad.healthy
+            assert [(await pool.acquire()).name for _ in range(1)] == ["ep1"]
+            bad.client.models.healthy = True
+            await asyncio.sleep(0.05)
+            healthy = bad.healthy
+            await pool.close()
+            return healthy
+        assert asyncio.run(run()) is True
+
+    def test_request_errors_do_not_eject(self):
+        async def run():
+            pool = _pool(1, 1, failure_threshold=1)
+            pool.report(pool.endpoints[0], False, ValueError("bad image"))
+            return pool.endpoints[0].healthy
+        assert asyncio.run(run()) is True
+
+    def test_last_healthy_endpoint_never_ejected(self):
+        async def run():
+            pool = _pool(1, failure_threshold=1)
+            pool.report(pool.endpoints[0], False, openai.APIConnectionError(request=None))
+            return pool.endpoints[0].healthy
+        assert asyncio.run(run()) is True
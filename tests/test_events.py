@@ -0,0 +1,109 @@
+import io
+import json
+import threading
+import time
+
+import app
+from metrics.events import IMAGE_DONE, IMAGE_FAILED, LOG, PROGRESS, STATUS, EventBuffer, ProgressEvents
+from metrics.timing import RunMetrics
+from scheduling.jobs import JOB_COMPLETE, Job
+
+
+def _messages(body):
+    """SSE messages of a response body as (fields, data) pairs."""
+    messages = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.split("\n"))
+        messages.append((fields, fields.get("data")))
+    return messages
+
+
+class TestEventBuffer:
+    def test_read_from_offset(self):
+        buffer = EventBuffer(capacity=10)
+        for i in range(4):
+            buffer.append({"type": LOG, "text": str(i)})
+        events, next_offset, dropped = buffer.read(1, limit=2)
+        assert [e["seq"] for e in events] == [1, 2] and next_offset == 3 and dropped == 0
+        assert buffer.read(4) == ([], 4, 0)
+
+    def test_old_events_are_dropped(self):
+        buffer = EventBuffer(capacity=3)
+        for i in range(5):
+            buffer.append({"type": LOG, "text": str(i)})
+        events, next_offset, dropped = buffer.read(0)
+        assert [e["text"] for e in events] == ["2", "3", "4"]
+        assert (next_offset, dropped, buffer.end) == (5, 2, 5)
+
+    def test_wait_wakes_on_append(self):
+        buffer = EventBuffer()
+        assert not buffer.wait(0, timeout=0.01)
+        timer = threading.Timer(0.05, buffer.append, ({"type": LOG},))
+        timer.start()
+        started = time.monotonic()
+        assert buffer.wait(0, timeout=5)
+        assert time.monotonic() - started < 1
+
+
+class TestProgressEvents:
+    def test_image_events(self):
+        sent = []
+        events = ProgressEvents(sent.append)
+        events.image_finished({"image_path": "a.jpg", "success": True, "cached": False, "processing_time": 1.5,
+                               "prompt_token_usage": 10, "completion_token_usage": 20,
+                               "timing": {"stages": {"turns": 1.2}}})
+        events.image_finished({"image_path": "b.jpg", "success": False, "error": "boom"})
+        assert [e["type"] for e in sent] == [IMAGE_DONE, IMAGE_FAILED]
+        assert sent[0]["completion_tokens"] == 20 and sent[0]["stages"] == {"turns": 1.2}
+        assert sent[1]["error"] == "boom"
+        json.dumps(sent)
+
+    def test_progress_is_rate_limited(self):
+        sent = []
+        events = ProgressEvents(sent.append)
+        metrics = RunMetrics()
+        for _ in range(5):
+            events.progress(metrics)
+        events.progress(metrics, force=True)
+        assert [e["type"] for e in sent] == [PROGRESS, PROGRESS]
+        assert sent[0]["finished"] == 0 and sent[0]["eta_seconds"] is None
+
+    def test_no_sink(self):
+        events = ProgressEvents()
+        events.image_finished({"image_path": "a.jpg", "success": True})
+        events.progress(RunMetrics())
+
+
+class TestEventStream:
+    def _job(self, monkeypatch, capacity=100):
+        job = Job("caption.yaml", event_capacity=capacity)
+        monkeypatch.setattr(app, "ui_job", job)
+        monkeypatch.setattr(app, "STREAM_INTERVAL", 0)
+        monkeypatch.setattr(app, "STREAM_BATCH", 3)
+        events = ProgressEvents(job.events.append)
+        events.emit(LOG, text="Starting image processing...")
+        events.image_finished({"image_path": "a.jpg", "success": True})
+        events.image_finished({"image_path": "b.jpg", "success": False, "error": "boom"})
+        events.emit(LOG, text=" -> JOB COMPLETE.")
+        events.emit(STATUS, status="complete")
+        job.status = JOB_COMPLETE
+        return job
+
+    def test_replay_from_offset(self, monkeypatch):
+        self._job(monkeypatch)
+        body = app.app.test_client().get("/api/events?offset=1").get_data(as_text=True)
+        messages = _messages(body)
+        replayed = [e for _, data in messages for e in json.loads(data)["events"]]
+        assert [e["seq"] for e in replayed] == [1, 2, 3, 4]
+        # One message per batch of STREAM_BATCH events, each with the offset to resume from
+        assert [fields["id"] for fields, _ in messages] == ["4", "5"]
+
+    def test_console_lines_stay_plain(self, monkeypatch):
+        job = self._job(monkeypatch)
+        lines = [data for fields, data in _messages("".join(app.stream_events(job, 0, console=True))) if "event" not in fields]
+        assert lines == ["Starting image processing...", " -> JOB COMPLETE.", "[COMPLETE]"]
+
+    def test_dropped_events_are_reported(self, monkeypatch):
+        self._job(monkeypatch, capacity=2)
+        body = app.app.test_client().get("/api/events?offset=0").get_data(as_text=True)
+        assert json.loads(_messages(body)[0][1])["dropped"] == 3
@@ -9,6 +9,7 @@ from file_utils.file_access import (
     OUTPUT_FORMAT_TXT,
     caption_exists,
     concat_prompts,
+    image_walk,
     save_caption,
 )
 
@@ -58,6 +59,15 @@ class TestSaveCaptionTxt:
 
         assert (tmp_path / "img.txt").read_text(encoding="utf-8") == "new"
 
+    def test_failed_write_raises(self, tmp_path):
+        with pytest.raises(OSError):
+            _run(save_caption(
+                file_path=str(tmp_path / "missing" / "img.jpg"),
+                caption_text="a cat",
+                debug_info="",
+                output_format=OUTPUT_FORMAT_TXT,
+            ))
+
 
 class TestSaveCaptionJsonl:
     def test_appends_one_entry_per_call(self, tmp_path):
@@ -168,3 +178,89 @@ class TestCaptionExistsJsonl:
         )
         assert caption_exists(str(image), OUTPUT_FORMAT_JSONL, model="m1", concat_prompt="p1") is True
         assert caption_exists(str(image), OUTPUT_FORMAT_JSONL, model="m1", concat_prompt="missing") is False
+
+
+def _tree(root):
+    """root/a.jpg, root/notes.txt, root/d1/b.png, root/d1/d2/c.jpg, root/d3/e.webp, root/d3/f.jpg"""
+    for rel in ["a.jpg", "notes.txt", "d1/b.png", "d1/d2/c.jpg", "d3/e.webp", "d3/f.jpg"]:
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x")
+
+
+def _walk(root, **kwargs):
+    async def run():
+        return [os.path.relpath(p, root).replace(os.sep, "/") async for p in image_walk(
+            str(root), skip_if_caption_exists=kwargs.pop("skip", False), **kwargs)]
+    return _run(run())
+
+
+class TestImageWalk:
+    EXPECTED = ["a.jpg", "d1/b.png", "d1/d2/c.jpg", "d3/e.webp", "d3/f.jpg"]
+
+    def test_finds_all_images_concurrently(self, tmp_path):
+        _tree(tmp_path)
+        assert sorted(_walk(tmp_path, recursive=True)) == self.EXPECTED
+
+    def test_ordered_is_depth_first_by_name(self, tmp_path):
+        _tree(tmp_path)
+        for workers in (1, 2, 8):
+            assert _walk(tmp_path, recursive=True, ordered=True, walk_workers=workers) == self.EXPECTED
+
+    def test_not_recursive(self, tmp_path):
+        _tree(tmp_path)
+        assert _walk(tmp_path, recursive=False) == ["a.jpg"]
+        assert _walk(tmp_path, recursive=False, ordered=True) == ["a.jpg"]
+
+    def test_skips_existing_captions(self, tmp_path):
+        _tree(tmp_path)
+        (tmp_path / "d1" / "b.txt").write_text("caption")
+        assert sorted(_walk(tmp_path, recursive=True, skip=True)) == [
+            "a.jpg", "d1/d2/c.jpg", "d3/e.webp", "d3/f.jpg"]
+
+    def test_wide_tree_with_few_workers(self, tmp_path):
+        for i in range(30):
+            (tmp_path / f"dir{i:02d}").mkdir()
+            (tmp_path / f"dir{i:02d}" / "img.jpg").write_bytes(b"x")
+        found = _walk(tmp_path, recursive=True, walk_workers=3)
+        assert sorted(found) == [f"dir{i:02d}/img.jpg" for i in range(30)]
+        assert _walk(tmp_path, recursive=True, ordered=True, walk_workers=3) == sorted(found)
+
+    def test_early_exit_closes_cleanly(self, tmp_path):
+        _tree(tmp_path)
+
+        async def run():
+            walker = image_walk(str(tmp_path), recursive=True, skip_if_caption_exists=False)
+            first = await walker.__anext__()
+            await walker.aclose()
+            return first
+        assert _run(run()).endswith((".jpg", ".png", ".webp"))
+
+    def test_txt_skip_decided_from_listing(self, tmp_path, monkeypatch):
+        import file_utils.file_access as file_access
+        _tree(tmp_path)
+        (tmp_path / "a.txt").write_text("caption")
+        (tmp_path / "d3" / "f.txt").write_text("caption")
+        calls = []
+        monkeypatch.setattr(file_access, "caption_exists", lambda *args: calls.append(args) or True)
+        found = sorted(_walk(tmp_path, recursive=True, skip=True))
+        assert found == ["d1/b.png", "d1/d2/c.jpg", "d3/e.webp"]
+        assert calls == []
+
+    def test_jsonl_skip_only_checks_images_with_sidecars(self, tmp_path, monkeypatch):
+        import file_utils.file_access as file_access
+        _tree(tmp_path)
+        prompt = concat_prompts(["p"])
+        (tmp_path / "d3" / "f.jsonl").write_text(json.dumps({"text": "c", "model": "m", "prompt": prompt}) + "\n")
+        (tmp_path / "d3" / "e.jsonl").write_text(json.dumps({"text": "c", "model": "other", "prompt": prompt}) + "\n")
+        checked = []
+        original = file_access.caption_exists
+
+        def counting(path, *args):
+            checked.append(os.path.basename(path))
+            return original(path, *args)
+        monkeypatch.setattr(file_access, "caption_exists", counting)
+        found = sorted(_walk(tmp_path, recursive=True, skip=True, output_format=OUTPUT_FORMAT_JSONL,
+                             model="m", concat_prompt=prompt))
+        assert found == ["a.jpg", "d1/b.png", "d1/d2/c.jpg", "d3/e.webp"]
+        assert sorted(checked) == ["e.webp", "f.jpg"]
@@ -0,0 +1,100 @@
+import asyncio
+import json
+import threading
+
+import hints.registration as registration
+from hints.hint_sources import get_hints, get_hints_async
+from hints.registration import HintCache
+
+
+class TestHintSources:
+    def test_json_and_metadata_hints(self, tmp_path):
+        (tmp_path / "metadata.json").write_text(json.dumps({"scene": "forest"}))
+        (tmp_path / "img.json").write_text(json.dumps({"title": "hello"}))
+        image = str(tmp_path / "img.jpg")
+        hints = asyncio.run(get_hints_async(["metadata", "json"], image))
+        assert hints.index("- scene: forest") < hints.index('"title": "hello"')
+
+    def test_missing_files_give_no_hints(self, tmp_path):
+        assert asyncio.run(get_hints_async(["metadata", "json"], str(tmp_path / "img.jpg"))) is None
+
+    def test_sync_get_hints_still_works(self, tmp_path):
+        (tmp_path / "img.json").write_text(json.dumps({"title": "hello"}))
+        assert '"title": "hello"' in get_hints(["json"], str(tmp_path / "img.jpg"))
+
+    def test_plain_function_hint_sources_are_supported(self, monkeypatch):
+        monkeypatch.setitem(registration.HINT_FUNCTIONS, "custom", lambda image_path, **kwargs: f"custom {image_path}")
+        monkeypatch.setattr("hints.hint_sources.HINT_FUNCTIONS", registration.HINT_FUNCTIONS)
+        assert asyncio.run(get_hints_async(["custom"], "x.jpg")) == "custom x.jpg"
+
+    def test_failing_hint_source_is_skipped(self, monkeypatch, capsys):
+        def broken(image_path, **kwargs):
+            raise RuntimeError("nope")
+        monkeypatch.setitem(registration.HINT_FUNCTIONS, "broken", broken)
+        assert asyncio.run(get_hints_async(["broken", "full_path"], "x.jpg")).startswith("Image file information")
+        assert "Failed to get hint from 'broken'" in capsys.readouterr().out
+
+    def test_concurrent_images_share_one_metadata_read(self, tmp_path, monkeypatch):
+        (tmp_path / "metadata.json").write_text(json.dumps({"scene": "forest"}))
+        reads = _count_reads(monkeypatch)
+        cache = HintCache()
+
+        async def run():
+            return await asyncio.gather(*(get_hints_async(["metadata"], str(tmp_path / f"{i}.jpg"), hint_cache=cache)
+                                          for i in range(10)))
+        results = asyncio.run(run())
+        assert len(reads) == 1
+        assert all("scene: forest" in r for r in results)
+        # Later images of the run are answered from the cache
+        asyncio.run(run())
+        assert len(reads) == 1
+
+    def test_without_a_cache_metadata_is_read_every_time(self, tmp_path, monkeypatch):
+        (tmp_path / "metadata.json").write_text(json.dumps({"scene": "forest"}))
+        reads = _count_reads(monkeypatch)
+        for _ in range(2):
+            assert "scene: forest" in get_hints(["metadata"], str(tmp_path / "img.jpg"))
+        assert len(reads) == 2
+
+    def test_metadata_cache_is_bounded(self, tmp_path):
+        cache = HintCache(maxsize=3)
+        for i in range(5):
+            folder = tmp_path / f"d{i}"
+            folder.mkdir()
+            asyncio.run(registration.get_metadata_hint(str(folder / "img.jpg"), hint_cache=cache))
+        assert len(cache) == 3
+        assert str(tmp_path / "d0") not in cache
+        assert str(tmp_path / "d4") in cache
+
+    def test_reads_in_flight_are_not_shared_across_loops(self, tmp_path, monkeypatch):
+        (tmp_path / "metadata.json").write_text(json.dumps({"scene": "forest"}))
+        both_reading = threading.Barrier(2, timeout=5)
+        original = registration._read_json
+
+        async def slow(path):
+            await asyncio.to_thread(both_reading.wait)
+            return await original(path)
+        monkeypatch.setattr(registration, "_read_json", slow)
+        cache = HintCache()
+        results = []
+
+        def run():
+            results.append(get_hints(["metadata"], str(tmp_path / "img.jpg"), hint_cache=cache))
+        threads = [threading.Thread(target=run) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        assert len(results) == 2 and all("scene: forest" in r for r in results)
+
+
+def _count_reads(monkeypatch):
+    reads = []
+    original = registration._read_json
+
+    async def counting(path):
+        reads.append(path)
+        await asyncio.sleep(0.01)
+        return await original(path)
+    monkeypatch.setattr(registration, "_read_json", counting)
+    return reads
@@ -0,0 +1,53 @@
+import asyncio
+
+import openai
+from omegaconf import OmegaConf
+
+from benchmarks.mock_server import MockServer, MockServerConfig
+from scheduling.http_client import ConnectionStats, client_options, create_http_client
+
+
+def _conf(http_client=None):
+    conf = {"base_directory": "x"}
+    if http_client is not None:
+        conf["http_client"] = http_client
+    return OmegaConf.create(conf)
+
+
+class TestHttpClient:
+    def test_connections_are_reused(self):
+        stats = ConnectionStats()
+
+        async def run():
+            async with MockServer(MockServerConfig(ttft=0, tokens_per_s=10000, completion_tokens=2)) as server:
+                http_client = create_http_client(_conf(), stats)
+                client = openai.AsyncOpenAI(base_url=server.base_url, api_key="x", http_client=http_client)
+                try:
+                    for _ in range(5):
+                        await client.chat.completions.create(model="m", messages=[{"role": "user", "content": "hi"}])
+                finally:
+                    await client.close()
+
+        asyncio.run(run())
+        assert (stats.requests, stats.connections, stats.reused) == (5, 1, 4)
+        assert stats.summary().startswith("HTTP: 5 requests over 1 connections (4 on reused connections, 80%)")
+
+    def test_settings_are_applied(self):
+        conf = _conf({"max_connections": 8, "keepalive_expiry": 30, "connect_timeout": 2, "read_timeout": 90})
+
+        async def run():
+            http_client = create_http_client(conf)
+            try:
+                return http_client.timeout
+            finally:
+                await http_client.aclose()
+
+        timeout = asyncio.run(run())
+        assert (timeout.connect, timeout.read, timeout.pool) == (2, 90, openai.DEFAULT_TIMEOUT.pool)
+
+    def test_client_options(self):
+        assert "max_retries" not in client_options(_conf())
+        assert client_options(_conf({"max_retries": 5}))["max_retries"] == 5
+        # The rate limiter takes over retries, whatever the section says
+        assert client_options(_conf({"max_retries": 5}), rate_limited=True)["max_retries"] == 0
+        assert client_options(_conf({"read_timeout": 30}))["timeout"].read == 30
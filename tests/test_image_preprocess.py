@@ -0,0 +1,94 @@
+import asyncio
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+from file_utils.image_preprocess import (
+    encode_image,
+    mime_type_for,
+    preprocess_image_bytes,
+)
+
+
+def _image_bytes(size, fmt, mode="RGB"):
+    buf = io.BytesIO()
+    Image.new(mode, size, (10, 20, 30, 128)[:len(mode)] if mode != "L" else 10).save(buf, format=fmt)
+    return buf.getvalue()
+
+
+def _decode(b64):
+    return Image.open(io.BytesIO(base64.b64decode(b64)))
+
+
+class TestMimeTypeFor:
+    def test_known_extensions(self):
+        assert mime_type_for("a/b.PNG") == "image/png"
+        assert mime_type_for("a/b.jpeg") == "image/jpeg"
+        assert mime_type_for("a/b.avif") == "image/avif"
+
+    def test_unknown_defaults_to_jpeg(self):
+        assert mime_type_for("a/b.xyz") == "image/jpeg"
+
+
+class TestPreprocessImageBytes:
+    def test_downscales_long_side(self):
+        data = _image_bytes((4000, 1000), "PNG")
+        mime, b64 = preprocess_image_bytes(data, max_long_side=1000, target_format="jpeg")
+        assert mime == "image/jpeg"
+        img = _decode(b64)
+        assert img.format == "JPEG"
+        assert img.size == (1000, 250)
+
+    def test_max_pixels_budget(self):
+        data = _image_bytes((2000, 2000), "PNG")
+        _, b64 = preprocess_image_bytes(data, max_pixels=250_000, target_format="png")
+        w, h = _decode(b64).size
+        assert w * h <= 250_000
+        assert w == h
+
+    def test_passthrough_when_within_limits_and_same_format(self):
+        data = _image_bytes((100, 100), "JPEG")
+        mime, b64 = preprocess_image_bytes(data, max_long_side=1000, target_format="jpeg")
+        assert mime == "image/jpeg"
+        assert base64.b64decode(b64) == data
+
+    def test_keep_converts_unsupported_formats_to_jpeg(self):
+        data = _image_bytes((64, 64), "BMP")
+        mime, b64 = preprocess_image_bytes(data, target_format="keep")
+        assert mime == "image/jpeg"
+        assert _decode(b64).format == "JPEG"
+
+    def test_keep_preserves_png(self):
+        data = _image_bytes((64, 64), "PNG")
+        mime, b64 = preprocess_image_bytes(data, target_format="keep")
+        assert mime == "image/png"
+        assert base64.b64decode(b64) == data
+
+    def test_alpha_flattened_for_jpeg(self):
+        data = _image_bytes((64, 64), "PNG", mode="RGBA")
+        _, b64 = preprocess_image_bytes(data, target_format="jpeg")
+        assert _decode(b64).mode == "RGB"
+
+
+class TestEncodeImage:
+    def test_disabled_sends_original_with_extension_mime(self):
+        data = _image_bytes((32, 32), "PNG")
+        mime, b64 = asyncio.run(encode_image(data, "img.png", None))
+        assert mime == "image/png"
+        assert base64.b64decode(b64) == data
+
+    def test_enabled_without_executor_runs_in_thread(self):
+        data = _image_bytes((3000, 300), "PNG")
+        conf = {"enabled": True, "max_long_side": 300, "format": "webp"}
+        mime, b64 = asyncio.run(encode_image(data, "img.png", conf))
+        assert mime == "image/webp"
+        assert _decode(b64).size == (300, 30)
+
+    def test_undecodable_falls_back_to_original(self):
+        data = b"not an image"
+        conf = {"enabled": True, "max_long_side": 300}
+        mime, b64 = asyncio.run(encode_image(data, "img.tiff", conf))
+        assert mime == "image/tiff"
+        assert base64.b64decode(b64) == data
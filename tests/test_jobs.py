@@ -0,0 +1,242 @@
+import asyncio
+import io
+import json
+import sys
+import threading
+import time
+
+from omegaconf import OmegaConf
+
+import app
+import file_utils.file_access as file_access
+import hints.registration as registration
+from caption_openai import ImageJob, load_config, prepare_image
+from hints.registration import HintCache
+from metrics.events import LOG, STATUS, EventBuffer, ProgressEvents
+from metrics.timing import RunMetrics
+from file_utils.sqlite_store import SqliteStore
+from scheduling.endpoints import EndpointPool
+from scheduling.jobs import JOB_CANCELLED, JOB_COMPLETE, JOB_ERROR, JobManager, JobStdout
+from scheduling.shared_budget import SharedConcurrencyBudget
+
+
+class _FakeClient:
+    async def close(self):
+        pass
+
+
+def _wait_for(jobs, timeout=10):
+    deadline = time.monotonic() + timeout
+    while any(job.running for job in jobs) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not any(job.running for job in jobs)
+
+
+def _log(job):
+    return [e["text"] for e in job.events.read(0)[0] if e["type"] == LOG]
+
+
+class TestSharedConcurrencyBudget:
+    def test_limit_is_the_largest_registered(self):
+        budget = SharedConcurrencyBudget()
+        budget.register("http://a/v1/", 2)
+        budget.register("http://a/v1", 3)
+        assert [budget.try_acquire("http://a/v1") for _ in range(4)] == [True, True, True, False]
+        budget.unregister("http://a/v1", 3)
+        budget.release("http://a/v1")
+        assert not budget.try_acquire("http://a/v1")
+        assert budget.status() == {"http://a/v1": {"in_flight": 2, "limit": 2}}
+
+    def test_models_of_one_url_have_their_own_limits(self):
+        budget = SharedConcurrencyBudget()
+        pool = EndpointPool(budget=budget)
+        pool.add("http://a/v1", _FakeClient(), OmegaConf.create({"model": "small"}), 4)
+        pool.add("http://a/v1", _FakeClient(), OmegaConf.create({"model": "large"}), 1)
+        assert budget.limit("http://a/v1", "small") == 4 and budget.limit("http://a/v1", "large") == 1
+        assert [budget.try_acquire("http://a/v1", "large") for _ in range(2)] == [True, False]
+        assert budget.try_acquire("http://a/v1", "small")
+        assert budget.status() == {"http://a/v1 (small)": {"in_flight": 1, "limit": 4},
+                                   "http://a/v1 (large)": {"in_flight": 1, "limit": 1}}
+        asyncio.run(pool.close())
+        assert budget.status() == {}
+
+    def test_jobs_share_an_endpoint(self):
+        budget = SharedConcurrencyBudget()
+        peak = {"in_flight": 0, "max": 0}
+        lock = threading.Lock()
+
+        async def job():
+            pool = EndpointPool(budget=budget)
+            pool.add("http://a/v1", _FakeClient(), OmegaConf.create({}), 4)
+
+            async def conversation():
+                endpoint = await pool.acquire()
+                with lock:
+                    peak["in_flight"] += 1
+                    peak["max"] = max(peak["max"], peak["in_flight"])
+                await asyncio.sleep(0.005)
+                with lock:
+                    peak["in_flight"] -= 1
+                endpoint.release()
+
+            await asyncio.gather(*(conversation() for _ in range(40)))
+            await pool.close()
+
+        threads = [threading.Thread(target=asyncio.run, args=(job(),)) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+        assert not any(thread.is_alive() for thread in threads)
+        assert peak["max"] == 4 and budget.status() == {}
+
+
+class TestJobStdout:
+    def test_lines_go_to_the_thread_job(self):
+        stdout = JobStdout(io.StringIO())
+        buffer = EventBuffer()
+        stdout.attach(ProgressEvents(buffer.append))
+        print("first", file=stdout)
+        print("", file=stdout)
+        stdout.write("sec")
+        stdout.write("ond\nthi")
+        other = threading.Thread(target=print, args=("not this job",), kwargs={"file": stdout})
+        other.start()
+        other.join()
+        assert [e["text"] for e in buffer.read(0)[0]] == ["first", "", "second"]
+        assert "not this job" in stdout.original_stdout.getvalue()
+
+
+class TestJobManager:
+    def test_jobs_run_side_by_side(self):
+        started = threading.Barrier(2, timeout=5)
+
+        async def run_job(config_path, overrides, event_sink, concurrency_budget, metrics_sink):
+            await asyncio.get_running_loop().run_in_executor(None, started.wait)
+            print(f"captioning {overrides['base_directory']}")
+
+        manager = JobManager(run_job=run_job)
+        jobs = [manager.start("caption.yaml", {"base_directory": name}, name=name) for name in ("big", "urgent")]
+        _wait_for(jobs)
+        assert [job.status for job in jobs] == [JOB_COMPLETE, JOB_COMPLETE]
+        assert [_log(job) for job in jobs] == [["captioning big"], ["captioning urgent"]]
+        assert not isinstance(sys.stdout, JobStdout)
+
+    def test_prints_from_worker_threads_go_to_the_job(self, tmp_path, monkeypatch):
+        def scan_dir(path):
+            print(f"Error accessing directory {path}")
+            return []
+        monkeypatch.setattr(file_access, "_scan_dir", scan_dir)
+
+        async def run_job(config_path, overrides, event_sink, concurrency_budget, metrics_sink):
+            name = overrides["name"]
+            await asyncio.to_thread(print, f"{name} on a worker thread")
+            store = SqliteStore(str(tmp_path / f"{name}.sqlite"))
+            try:
+                await store._call(lambda conn: print(f"{name} on a store thread"))
+            finally:
+                store.close()
+            async for _ in file_access.image_walk(name, recursive=False, skip_if_caption_exists=False):
+                pass
+
+        manager = JobManager(run_job=run_job)
+        jobs = [manager.start(overrides={"name": name}) for name in ("big", "urgent")]
+        _wait_for(jobs)
+        for job, name in zip(jobs, ("big", "urgent")):
+            assert _log(job) == [f"{name} on a worker thread", f"{name} on a store thread",
+                                 f"Error accessing directory {name}"]
+
+    def test_stop_and_errors(self):
+        async def run_job(config_path, overrides, event_sink, concurrency_budget, metrics_sink):
+            if overrides.get("fail"):
+                raise ValueError("bad config")
+            await asyncio.sleep(30)
+
+        manager = JobManager(run_job=run_job)
+        slow, broken = manager.start(), manager.start(overrides={"fail": True})
+        assert manager.stop(slow.id)
+        _wait_for([slow, broken])
+        assert (slow.status, broken.status, broken.error) == (JOB_CANCELLED, JOB_ERROR, "bad config")
+        assert [e["status"] for e in slow.events.read(0)[0] if e["type"] == STATUS] == ["cancelled", "complete"]
+        assert not manager.stop(slow.id)
+
+    def test_jobs_keep_their_own_hint_caches(self, tmp_path, monkeypatch):
+        # Both jobs read their directory's metadata at the same time, each on its own loop
+        both_reading = threading.Barrier(2, timeout=5)
+        original = registration._read_json
+
+        async def slow(path):
+            await asyncio.to_thread(both_reading.wait)
+            return await original(path)
+        monkeypatch.setattr(registration, "_read_json", slow)
+
+        config = tmp_path / "caption.yaml"
+        config.write_text("model: m\nprompts: [describe]\nhint_sources: [metadata]\n")
+        for name in ("big", "urgent"):
+            (tmp_path / name).mkdir()
+            (tmp_path / name / "metadata.json").write_text(json.dumps({"set": name}))
+            for i in range(3):
+                (tmp_path / name / f"{i}.jpg").write_bytes(b"x" * 100)
+
+        hints = {}
+
+        async def run_job(config_path, overrides, event_sink, concurrency_budget, metrics_sink):
+            conf = await load_config(config_path, overrides)
+            hint_cache = HintCache()
+            jobs = await asyncio.gather(*(prepare_image(ImageJob(str(path)), conf, hint_cache=hint_cache)
+                                          for path in sorted((tmp_path / conf.base_directory).glob("*.jpg"))))
+            hints[conf.base_directory] = [job.prefetched.hints for job in jobs]
+
+        manager = JobManager(run_job=run_job)
+        jobs = [manager.start(str(config), {"base_directory": name}) for name in ("big", "urgent")]
+        _wait_for(jobs)
+        assert [job.status for job in jobs] == [JOB_COMPLETE, JOB_COMPLETE]
+        assert hints == {name: [f"Directory metadata:\n- set: {name}\n"] * 3 for name in ("big", "urgent")}
+
+    def test_finished_jobs_are_pruned(self):
+        async def run_job(*args):
+            pass
+
+        manager = JobManager(run_job=run_job, keep_finished=2)
+        for _ in range(4):
+            _wait_for([manager.start()])
+        manager.start()
+        assert len(manager.list()) == 3
+
+
+class TestJobRoutes:
+    def test_start_status_and_list(self, monkeypatch, tmp_path):
+        async def run_job(config_path, overrides, event_sink, concurrency_budget, metrics_sink):
+            ProgressEvents(event_sink).emit("progress", finished=1)
+
+        monkeypatch.setattr(app, "job_manager", JobManager(run_job=run_job))
+        config = tmp_path / "urgent.yaml"
+        config.write_text("base_directory: x\n")
+        client = app.app.test_client()
+        response = client.post("/api/jobs", json={"config_path": str(config), "config": {"concurrent_batch_size": 2}, "name": "urgent"})
+        job = response.get_json()["job"]
+        _wait_for([app.job_manager.get(job["id"])])
+
+        status = client.get(f"/api/jobs/{job['id']}").get_json()["job"]
+        assert (status["name"], status["status"], status["overrides"]) == ("urgent", JOB_COMPLETE, {"concurrent_batch_size": 2})
+        assert [j["id"] for j in client.get("/api/jobs").get_json()["jobs"]] == [job["id"]]
+        assert '"finished": 1' in client.get(f"/api/jobs/{job['id']}/events").get_data(as_text=True)
+        assert client.post(f"/api/jobs/{job['id']}/stop").status_code == 400
+        assert client.get("/api/jobs/nope").status_code == 404
+        assert client.post("/api/jobs", json={"config_path": str(tmp_path / "missing.yaml")}).status_code == 400
+
+    def test_metrics_of_every_job(self, monkeypatch):
+        async def run_job(config_path, overrides, event_sink, concurrency_budget, metrics_sink):
+            metrics = RunMetrics()
+            for _ in range(overrides["images"]):
+                metrics.image_discovered()
+            metrics_sink(metrics)
+
+        monkeypatch.setattr(app, "job_manager", JobManager(run_job=run_job))
+        jobs = [app.job_manager.start(overrides={"images": images}) for images in (3, 5)]
+        _wait_for(jobs)
+        text = app.app.test_client().get("/api/metrics").get_data(as_text=True)
+        assert "vlm_caption_running 0" in text
+        assert text.count("# TYPE vlm_caption_images_discovered gauge") == 1
+        assert f'vlm_caption_images_discovered{{job="{jobs[0].id}"}} 3' in text
+        assert f'vlm_caption_images_discovered{{job="{jobs[1].id}"}} 5' in text
@@ -0,0 +1,117 @@
+import asyncio
+
+from omegaconf import OmegaConf
+
+from caption_openai import ImageJob, prepare_image
+from scheduling.memory_budget import (MB, ByteBudget, create_memory_budget, encoded_payload_bytes,
+                                      estimate_payload_bytes)
+
+
+async def _settle():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+class TestByteBudget:
+    def test_waits_for_room(self):
+        async def run():
+            budget = ByteBudget(100)
+            await budget.acquire(60)
+            second = asyncio.create_task(budget.acquire(60))
+            await _settle()
+            assert not second.done() and budget.waiting == 1
+            budget.release(60)
+            await second
+            return budget.used
+
+        assert asyncio.run(run()) == 60
+
+    def test_small_requests_pass_a_large_one(self):
+        async def run():
+            budget = ByteBudget(100)
+            await budget.acquire(50)
+            large = asyncio.create_task(budget.acquire(80))
+            await _settle()
+            small = asyncio.create_task(budget.acquire(30))
+            await _settle()
+            assert small.done() and not large.done()
+            budget.release(50)
+            budget.release(30)
+            await large
+            return budget.used
+
+        assert asyncio.run(run()) == 80
+
+    def test_large_request_stops_being_passed(self):
+        async def run():
+            budget = ByteBudget(100, max_passes=1)
+            await budget.acquire(50)
+            large = asyncio.create_task(budget.acquire(80))
+            await _settle()
+            first = asyncio.create_task(budget.acquire(10))
+            second = asyncio.create_task(budget.acquire(30))
+            await _settle()
+            assert first.done() and not second.done()
+            budget.release(50)
+            budget.release(10)
+            await large
+            assert not second.done()
+            budget.release(80)
+            await second
+
+        asyncio.run(run())
+
+    def test_oversized_request_admitted_when_idle(self):
+        async def run():
+            budget = ByteBudget(100)
+            await budget.acquire(500)
+            return budget.used, budget.peak
+
+        assert asyncio.run(run()) == (500, 500)
+
+    def test_resize(self):
+        async def run():
+            budget = ByteBudget(100)
+            held = await budget.acquire(90)
+            waiting = asyncio.create_task(budget.acquire(50))
+            await _settle()
+            held = budget.resize(held, 40)
+            await waiting
+            return held, budget.used
+
+        assert asyncio.run(run()) == (40, 90)
+
+    def test_cancelled_waiter_does_not_hold_budget(self):
+        async def run():
+            budget = ByteBudget(100)
+            await budget.acquire(100)
+            waiting = asyncio.create_task(budget.acquire(10))
+            await _settle()
+            waiting.cancel()
+            await _settle()
+            budget.release(100)
+            return budget.used, budget.waiting
+
+        assert asyncio.run(run()) == (0, 0)
+
+    def test_disabled_by_default(self):
+        assert create_memory_budget(OmegaConf.create({})) is None
+        assert create_memory_budget(OmegaConf.create({"memory_budget_mb": 2})).limit == 2 * MB
+
+
+class TestPrepareImageBudget:
+    def test_holds_encoded_payload(self, tmp_path):
+        image = tmp_path / "img.jpg"
+        image.write_bytes(b"x" * 3000)
+        conf = OmegaConf.create({"model": "m", "prompts": ["describe"]})
+
+        async def run():
+            budget = ByteBudget(10 * MB)
+            job = await prepare_image(ImageJob(str(image)), conf, budget=budget)
+            assert job.error is None
+            assert "memory_wait" in job.timer.stages
+            return job.payload_bytes, budget.used
+
+        held, used = asyncio.run(run())
+        assert held == used == encoded_payload_bytes(4000)
+        assert estimate_payload_bytes(3000) == 3000 + 3 * 4000
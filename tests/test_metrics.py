@@ -0,0 +1,123 @@
+import asyncio
+import json
+import threading
+import time
+
+from omegaconf import OmegaConf
+
+from metrics.timing import ImageTimer, RunMetrics, create_run_metrics, prometheus_text, quantile
+
+
+def _result(path, total=1.0, success=True, cached=False, ttft=0.2):
+    timer = ImageTimer()
+    timer.stages = {"encode": 0.1, "turns": total - 0.2, "save": 0.1}
+    timer.after_turn({}, {"ttft": ttft, "latency": total - 0.2, "prompt_tokens": 10,
+                          "completion_tokens": 20, "tokens_per_s": 25.0})
+    timing = timer.record()
+    timing["total"] = total
+    result = {"image_path": path, "success": success, "cached": cached, "timing": timing,
+              "prompt_token_usage": 10, "completion_token_usage": 20}
+    if not success:
+        result["error"] = "boom"
+    return result
+
+
+class TestImageTimer:
+    def test_stages_accumulate(self):
+        timer = ImageTimer()
+        with timer.stage("cache"):
+            time.sleep(0.01)
+        with timer.stage("cache"):
+            time.sleep(0.01)
+        record = timer.record()
+        assert record["stages"]["cache"] >= 0.02
+        assert record["total"] >= record["stages"]["cache"]
+        assert record["turns"] == []
+
+
+class TestRunMetrics:
+    def test_quantile_nearest_rank(self):
+        values = list(range(1, 101))
+        assert quantile(values, 0.5) == 50
+        assert quantile(values, 0.95) == 95
+        assert quantile(values, 0.99) == 99
+        assert quantile([7], 0.99) == 7
+
+    def test_counts_and_quantiles(self):
+        metrics = RunMetrics()
+        for i in range(1, 11):
+            metrics.observe(_result(f"{i}.jpg", total=float(i)))
+        metrics.observe(_result("cached.jpg", total=0.01, cached=True))
+        metrics.observe(_result("bad.jpg", success=False))
+        assert metrics.outcomes == {"done": 10, "failed": 1, "cached": 1}
+        assert metrics.tokens == {"prompt": 110, "completion": 220}
+        summary = metrics.summary()
+        assert "p50 5.000s  p95 10.000s" in summary
+        assert "encode" in summary
+
+    def test_eta_once_walk_is_complete(self):
+        metrics = RunMetrics()
+        for _ in range(4):
+            metrics.image_discovered()
+        metrics.observe(_result("a.jpg"))
+        assert "ETA" not in metrics.progress_line()
+        metrics.walk_complete()
+        assert "ETA" in metrics.progress_line()
+
+    def test_prometheus_text(self):
+        metrics = RunMetrics()
+        metrics.observe(_result("a.jpg", total=2.0))
+        text = metrics.prometheus_text()
+        assert 'vlm_caption_images_total{outcome="done"} 1' in text
+        assert '# TYPE vlm_caption_stage_seconds summary' in text
+        assert 'vlm_caption_stage_seconds{stage="encode",quantile="0.95"} 0.100000' in text
+        assert 'vlm_caption_image_seconds_count 1' in text
+        assert text.endswith("\n")
+
+    def test_prometheus_text_of_several_runs(self):
+        first, second = RunMetrics(), RunMetrics()
+        first.observe(_result("a.jpg", total=2.0))
+        text = prometheus_text([({"job": "one"}, first), ({"job": 'say "two"'}, second)])
+        assert text.count("# TYPE vlm_caption_images_total counter") == 1
+        assert 'vlm_caption_images_total{job="one",outcome="done"} 1' in text
+        assert 'vlm_caption_images_total{job="say \\"two\\"",outcome="done"} 0' in text
+        assert 'vlm_caption_stage_seconds{job="one",stage="encode",quantile="0.5"} 0.100000' in text
+        assert prometheus_text([]) == ""
+
+    def test_jsonl_records(self, tmp_path):
+        path = tmp_path / "metrics.jsonl"
+        metrics = create_run_metrics(OmegaConf.create({"metrics_file": str(path)}))
+        metrics.observe(_result("a.jpg"))
+        metrics.observe(_result("b.jpg", success=False))
+        metrics.close()
+        records = [json.loads(line) for line in path.read_text().splitlines()]
+        assert [r["image_path"] for r in records] == ["a.jpg", "b.jpg"]
+        assert records[0]["stages"]["encode"] == 0.1
+        assert records[0]["turns"][0]["ttft"] == 0.2
+        assert records[1]["error"] == "boom"
+
+    def test_jsonl_records_are_written_in_batches_off_the_loop(self, tmp_path, monkeypatch):
+        path = tmp_path / "metrics.jsonl"
+        metrics = RunMetrics(jsonl_path=str(path), flush_records=2, flush_interval=60)
+        threads = []
+        original = metrics._write
+
+        def write(records):
+            threads.append(threading.current_thread())
+            original(records)
+        monkeypatch.setattr(metrics, "_write", write)
+
+        async def run():
+            for name in ("a.jpg", "b.jpg", "c.jpg"):
+                metrics.observe(_result(name))
+                await metrics.flush()
+            lines = path.read_text().splitlines()
+            await metrics.flush(force=True)
+            return lines
+
+        try:
+            assert len(asyncio.run(run())) == 2
+            assert len(path.read_text().splitlines()) == 3
+            assert len(threads) == 2 and threading.main_thread() not in threads
+        finally:
+            metrics.close()
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from scheduling.pipeline import Pipeline, Stage
+
+
+async def _items(n, produced=None):
+    for i in range(n):
+        if produced is not None:
+            produced.append(i)
+        yield i
+
+
+class TestPipeline:
+    def test_every_item_passes_every_stage(self):
+        out = []
+
+        async def double(x):
+            await asyncio.sleep(0.001 * (x % 3))
+            return x * 2
+
+        async def collect(x):
+            out.append(x)
+
+        pipeline = Pipeline([Stage("double", double, workers=3), Stage("collect", collect, workers=2)])
+        asyncio.run(pipeline.run(_items(20)))
+        assert sorted(out) == [x * 2 for x in range(20)]
+
+    def test_slow_stage_holds_back_the_source(self):
+        produced = []
+
+        async def run():
+            gate = asyncio.Event()
+
+            async def slow(x):
+                await gate.wait()
+
+            pipeline = Pipeline([Stage("slow", slow, workers=2, queue_size=3)])
+            task = asyncio.create_task(pipeline.run(_items(100, produced)))
+            await asyncio.sleep(0.05)
+            # 2 in the workers, 3 queued and 1 waiting for room
+            held = len(produced)
+            gate.set()
+            await task
+            return held
+
+        assert asyncio.run(run()) == 6
+        assert len(produced) == 100
+
+    def test_bypass_skips_a_stage(self):
+        seen = {"odd": [], "last": []}
+
+        async def odd(x):
+            seen["odd"].append(x)
+            return x
+
+        async def last(x):
+            seen["last"].append(x)
+
+        pipeline = Pipeline([
+            Stage("odd", odd, workers=2, bypass=lambda x: x % 2 == 0),
+            Stage("last", last),
+        ])
+        asyncio.run(pipeline.run(_items(10)))
+        assert sorted(seen["odd"]) == [1, 3, 5, 7, 9]
+        assert sorted(seen["last"]) == list(range(10))
+
+    def test_none_drops_the_item(self):
+        out = []
+
+        async def evens(x):
+            return x if x % 2 == 0 else None
+
+        async def collect(x):
+            out.append(x)
+
+        asyncio.run(Pipeline([Stage("evens", evens), Stage("collect", collect)]).run(_items(6)))
+        assert sorted(out) == [0, 2, 4]
+
+    def test_stage_error_stops_the_pipeline(self):
+        async def boom(x):
+            if x == 3:
+                raise RuntimeError("boom")
+            return x
+
+        async def sink(x):
+            await asyncio.sleep(0.001)
+
+        pipeline = Pipeline([Stage("boom", boom, workers=2), Stage("sink", sink)])
+        with pytest.raises(RuntimeError):
+            asyncio.run(pipeline.run(_items(100)))
+
+    def test_empty_source(self):
+        async def never(x):
+            raise AssertionError("no items")
+
+        asyncio.run(Pipeline([Stage("a", never, workers=4), Stage("b", never, workers=2)]).run(_items(0)))
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+from omegaconf import OmegaConf
+
+from scheduling.prompt_graph import prompt_identity, prompt_nodes, run_prompt_graph, turn_stages
+
+GRAPH = [
+    {"name": "describe", "prompt": "Describe"},
+    {"name": "identify", "prompt": "Identify", "depends_on": "describe"},
+    {"name": "composition", "prompt": "Composition", "depends_on": "describe"},
+    {"name": "summary", "prompt": "Summarize", "depends_on": ["identify", "composition"]},
+]
+
+
+def _texts(messages):
+    out = []
+    for message in messages:
+        content = message["content"]
+        out.append(content if isinstance(content, str) else content[0]["text"])
+    return out
+
+
+class TestPromptNodes:
+    def test_prompts_list_is_a_chain(self):
+        nodes = prompt_nodes(OmegaConf.create({"prompts": ["a", "b", "c"]}))
+        assert [node.prompt for node in nodes] == ["a", "b", "c"]
+        assert nodes[0].depends_on == ()
+        assert nodes[2].depends_on == (nodes[1].name,)
+
+    def test_depends_on_defaults_to_previous_turn(self):
+        conf = OmegaConf.create({"prompt_graph": [{"name": "a", "prompt": "A"}, {"name": "b", "prompt": "B"}]})
+        assert prompt_nodes(conf)[1].depends_on == ("a",)
+
+    def test_unknown_dependency_rejected(self):
+        conf = OmegaConf.create({"prompt_graph": [{"name": "a", "prompt": "A"},
+                                                  {"name": "b", "prompt": "B", "depends_on": "zzz"}]})
+        with pytest.raises(ValueError, match="zzz"):
+            prompt_nodes(conf)
+
+    def test_dead_end_branch_rejected(self):
+        conf = OmegaConf.create({"prompt_graph": [{"name": "a", "prompt": "A"},
+                                                  {"name": "b", "prompt": "B", "depends_on": "a"},
+                                                  {"name": "c", "prompt": "C", "depends_on": "a"}]})
+        with pytest.raises(ValueError, match="'b'"):
+            prompt_nodes(conf)
+
+    def test_identity_unchanged_for_prompts_list(self):
+        assert prompt_identity(OmegaConf.create({"prompts": ["a", "b"]})) == "a\n\nb"
+
+    def test_identity_includes_dependencies(self):
+        chain = OmegaConf.create({"prompt_graph": [dict(g, depends_on=None) for g in GRAPH]})
+        assert prompt_identity(OmegaConf.create({"prompt_graph": GRAPH})) != prompt_identity(chain)
+
+    def test_turn_stages(self):
+        assert turn_stages(prompt_nodes(OmegaConf.create({"prompt_graph": GRAPH}))) == [0, 1, 1, 2]
+        assert turn_stages(prompt_nodes(OmegaConf.create({"prompts": ["a", "b", "c"]}))) == [0, 1, 2]
+
+
+class TestRunPromptGraph:
+    def _run(self, nodes):
+        seen = {}
+        running = []
+        peak = [0]
+
+        async def run_turn(i, messages):
+            seen[nodes[i].name] = _texts(messages)
+            running.append(i)
+            peak[0] = max(peak[0], len(running))
+            await asyncio.sleep(0.01)
+            running.remove(i)
+            return f"answer {nodes[i].name}", 10, 1
+
+        first = [{"type": "text", "text": nodes[0].prompt}, {"type": "image_url", "image_url": {"url": "x"}}]
+        result = asyncio.run(run_prompt_graph(nodes, [{"role": "system", "content": "sys"}], first, run_turn))
+        return result, seen, peak[0]
+
+    def test_branches_run_concurrently_and_merge(self):
+        nodes = prompt_nodes(OmegaConf.create({"prompt_graph": GRAPH}))
+        (messages, prompt_tokens, completion_tokens), seen, peak = self._run(nodes)
+        assert peak == 2
+        assert seen["identify"] == ["sys", "Describe", "answer describe", "Identify"]
+        assert seen["composition"] == ["sys", "Describe", "answer describe", "Composition"]
+        assert seen["summary"] == ["sys", "Describe", "answer describe", "Identify", "answer identify",
+                                   "Composition", "answer composition", "Summarize"]
+        assert _texts(messages)[-1] == "answer summary"
+        assert (prompt_tokens, completion_tokens) == (40, 4)
+
+    def test_chain_matches_sequential_conversation(self):
+        nodes = prompt_nodes(OmegaConf.create({"prompts": ["a", "b", "c"]}))
+        (messages, _, _), seen, peak = self._run(nodes)
+        assert peak == 1
+        assert _texts(messages) == ["sys", "a", "answer turn0", "b", "answer turn1", "c", "answer turn2"]
+
+    def test_failure_cancels_other_turns(self):
+        nodes = prompt_nodes(OmegaConf.create({"prompt_graph": GRAPH}))
+        started = []
+
+        async def run_turn(i, messages):
+            started.append(nodes[i].name)
+            if nodes[i].name == "identify":
+                raise RuntimeError("boom")
+            await asyncio.sleep(0.05)
+            return "ok", 0, 0
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(run_prompt_graph(nodes, [], [{"type": "text", "text": "Describe"}], run_turn))
+        assert "summary" not in started
@@ -0,0 +1,124 @@
+import asyncio
+import time
+
+import openai
+import pytest
+
+from scheduling.rate_limit import (
+    RateLimiter,
+    TokenBucket,
+    estimate_prompt_tokens,
+    retry_after_seconds,
+)
+from scheduling.turns import stream_chat_turn
+
+
+def _status_error(cls, status, headers=None):
+    response = type('Response', (), {'status_code': status, 'headers': headers or {}, 'request': None})()
+    return cls("error", response=response, body=None)
+
+
+class _Event:
+    def __init__(self, content=None, usage=None):
+        self.choices = [type('C', (), {'delta': type('D', (), {'content': content})()})()] if content is not None else []
+        self.usage = usage
+
+
+class _FlakyClient:
+    """Fails the first `failures` calls with `error`, then streams a response."""
+    def __init__(self, error, failures):
+        self.error = error
+        self.failures = failures
+        self.calls = 0
+        self.chat = type('Chat', (), {'completions': type('Comp', (), {'create': self._create})()})()
+
+    async def _create(self, **kwargs):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error
+
+        async def gen():
+            yield _Event("ok")
+            yield _Event(usage=type('U', (), {'prompt_tokens': 50, 'completion_tokens': 10})())
+        return gen()
+
+
+class TestTokenBucket:
+    def test_waits_when_empty(self):
+        async def run():
+            bucket = TokenBucket(600)  # 10 per second
+            await bucket.take(600)
+            start = time.monotonic()
+            await bucket.take(2)
+            return time.monotonic() - start
+        assert 0.15 <= asyncio.run(run()) < 1.0
+
+    def test_adjust_charges_and_refunds(self):
+        async def run():
+            bucket = TokenBucket(60_000)
+            await bucket.take(100)
+            bucket.adjust(-100)
+            return bucket.level
+        assert asyncio.run(run()) == pytest.approx(60_000, rel=1e-3)
+
+    def test_oversized_request_goes_into_debt(self):
+        async def run():
+            bucket = TokenBucket(60)
+            await bucket.take(120)
+            return bucket.level
+        assert asyncio.run(run()) < 0
+
+
+class TestEstimates:
+    def test_estimate_counts_text_and_images(self):
+        messages = [
+            {"role": "system", "content": "x" * 400},
+            {"role": "user", "content": [
+                {"type": "text", "text": "y" * 40},
+                {"type": "image_url", "image_url": {"url": "data:image/jpeg;base64,AAAA"}},
+            ]},
+        ]
+        assert estimate_prompt_tokens(messages, image_tokens=500) == 110 + 500
+
+    def test_retry_after_seconds_and_ms(self):
+        assert retry_after_seconds(_status_error(openai.RateLimitError, 429, {"retry-after": "3"})) == 3.0
+        assert retry_after_seconds(_status_error(openai.RateLimitError, 429, {"retry-after-ms": "250"})) == 0.25
+        assert retry_after_seconds(ValueError("no response")) is None
+
+
+class TestRateLimiterRetries:
+    def test_retries_rate_limit_then_succeeds(self):
+        error = _status_error(openai.RateLimitError, 429, {"retry-after": "0"})
+        client = _FlakyClient(error, failures=2)
+        limiter = RateLimiter(max_retries=3, backoff_base=0.01)
+        text, prompt_tokens, completion_tokens = asyncio.run(stream_chat_turn(client, [], [limiter], model="m"))
+        assert text == "ok"
+        assert client.calls == 3
+        assert limiter.retries == 2
+
+    def test_gives_up_after_max_retries(self):
+        error = _status_error(openai.InternalServerError, 503)
+        client = _FlakyClient(error, failures=10)
+        limiter = RateLimiter(max_retries=2, backoff_base=0.01)
+        with pytest.raises(openai.InternalServerError):
+            asyncio.run(stream_chat_turn(client, [], [limiter], model="m"))
+        assert client.calls == 3
+
+    def test_does_not_retry_request_errors(self):
+        error = _status_error(openai.BadRequestError, 400)
+        client = _FlakyClient(error, failures=1)
+        limiter = RateLimiter(max_retries=5, backoff_base=0.01)
+        with pytest.raises(openai.BadRequestError):
+            asyncio.run(stream_chat_turn(client, [], [limiter], model="m"))
+        assert client.calls == 1
+
+    def test_token_bucket_corrected_with_actual_usage(self):
+        client = _FlakyClient(None, failures=0)
+        limiter = RateLimiter(tokens_per_minute=60_000, image_token_estimate=0)
+        messages = [{"role": "user", "content": "z" * 4000}]  # estimate 1000
+
+        async def run():
+            await stream_chat_turn(client, messages, [limiter], model="m")
+            return limiter.tokens.level
+        # actual usage is 60 tokens, so the 1000 token reservation is mostly refunded
+        assert asyncio.run(run()) == pytest.approx(60_000 - 60, abs=5)
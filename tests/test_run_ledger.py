@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+
+from file_utils.run_ledger import (
+    RunLedger,
+    STATE_DONE,
+    STATE_FAILED,
+    STATE_IN_FLIGHT,
+    STATE_QUEUED,
+)
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+async def _collect(agen):
+    return [item async for item in agen]
+
+
+class TestRunLedger:
+    def test_state_transitions_and_counts(self, tmp_path):
+        async def run():
+            ledger = RunLedger(str(tmp_path / "ledger.sqlite"))
+            try:
+                await ledger.open_job("job")
+                for p in ["a.jpg", "b.jpg", "c.jpg"]:
+                    await ledger.add_queued(p)
+                await ledger.flush_queued()
+                await ledger.mark_in_flight("a.jpg")
+                await ledger.mark_done("a.jpg", 10, 5)
+                await ledger.mark_in_flight("b.jpg")
+                await ledger.mark_failed("b.jpg", "boom")
+                return await ledger.counts(), await ledger.is_done("a.jpg"), await ledger.is_done("b.jpg")
+            finally:
+                ledger.close()
+
+        counts, a_done, b_done = _run(run())
+        assert counts == {STATE_QUEUED: 1, STATE_IN_FLIGHT: 0, STATE_DONE: 1, STATE_FAILED: 1}
+        assert a_done is True
+        assert b_done is False
+
+    def test_crash_requeues_in_flight_and_resumes_without_walk(self, tmp_path):
+        path = str(tmp_path / "ledger.sqlite")
+
+        async def first_run():
+            ledger = RunLedger(path)
+            await ledger.open_job("job")
+            for p in ["a.jpg", "b.jpg", "c.jpg"]:
+                await ledger.add_queued(p)
+            await ledger.mark_walk_complete()
+            await ledger.mark_in_flight("a.jpg")
+            await ledger.mark_done("a.jpg")
+            await ledger.mark_in_flight("b.jpg")
+            # simulated crash: b.jpg is never finished
+            ledger.close()
+
+        async def second_run():
+            ledger = RunLedger(path)
+            try:
+                counts = await ledger.open_job("job")
+                return counts, await ledger.walk_complete(), await _collect(ledger.iter_queued(page_size=1))
+            finally:
+                ledger.close()
+
+        _run(first_run())
+        counts, walk_complete, pending = _run(second_run())
+        assert counts[STATE_IN_FLIGHT] == 0
+        assert counts[STATE_QUEUED] == 2
+        assert walk_complete is True
+        assert pending == ["b.jpg", "c.jpg"]
+
+    def test_failed_not_requeued_when_retry_disabled(self, tmp_path):
+        async def run():
+            ledger = RunLedger(str(tmp_path / "ledger.sqlite"))
+            try:
+                await ledger.open_job("job")
+                await ledger.mark_in_flight("a.jpg")
+                await ledger.mark_failed("a.jpg", "boom")
+                return await ledger.open_job("job", retry_failed=False)
+            finally:
+                ledger.close()
+
+        assert _run(run())[STATE_FAILED] == 1
+
+    def test_different_job_resets_ledger(self, tmp_path):
+        async def run():
+            ledger = RunLedger(str(tmp_path / "ledger.sqlite"))
+            try:
+                await ledger.open_job("job-1")
+                await ledger.mark_in_flight("a.jpg")
+                await ledger.mark_done("a.jpg")
+                return await ledger.open_job("job-2")
+            finally:
+                ledger.close()
+
+        assert sum(_run(run()).values()) == 0
+
+    def test_fully_done_ledger_rewalks_but_keeps_done_rows(self, tmp_path):
+        async def run():
+            ledger = RunLedger(str(tmp_path / "ledger.sqlite"))
+            try:
+                await ledger.open_job("job")
+                await ledger.add_queued("a.jpg")
+                await ledger.mark_walk_complete()
+                await ledger.mark_in_flight("a.jpg")
+                await ledger.mark_done("a.jpg")
+                await ledger.open_job("job")
+                return await ledger.walk_complete(), await ledger.is_done("a.jpg")
+            finally:
+                ledger.close()
+
+        assert _run(run()) == (False, True)
+
+    def test_queued_insert_does_not_override_progress(self, tmp_path):
+        async def run():
+            ledger = RunLedger(str(tmp_path / "ledger.sqlite"))
+            try:
+                await ledger.open_job("job")
+                await ledger.add_queued("a.jpg")
+                await ledger.mark_in_flight("a.jpg")
+                await ledger.mark_done("a.jpg")
+                await ledger.flush_queued()
+                return await ledger.is_done("a.jpg")
+            finally:
+                ledger.close()
+
+        assert _run(run()) is True
+
+    def test_finished_while_still_buffered(self, tmp_path):
+        async def run():
+            ledger = RunLedger(str(tmp_path / "ledger.sqlite"))
+            try:
+                await ledger.open_job("job")
+                for p in ["a.jpg", "b.jpg"]:
+                    await ledger.add_queued(p)
+                # e.g. a cache hit and a failed read, before the buffer is flushed
+                await ledger.mark_done("a.jpg")
+                await ledger.mark_failed("b.jpg", "unreadable")
+                await ledger.flush_queued()
+                return await _collect(ledger.iter_queued()), await ledger.counts()
+            finally:
+                ledger.close()
+
+        queued, counts = _run(run())
+        assert queued == []
+        assert counts == {STATE_QUEUED: 0, STATE_IN_FLIGHT: 0, STATE_DONE: 1, STATE_FAILED: 1}
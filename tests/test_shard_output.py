@@ -0,0 +1,140 @@
+import asyncio
+import json
+import os
+import tarfile
+
+import pytest
+from omegaconf import OmegaConf
+
+from caption_openai import ImageJob, write_image
+from file_utils.file_access import image_walk, save_caption
+from file_utils.shard_output import (OUTPUT_FORMAT_JSONL_SHARDS, OUTPUT_FORMAT_TAR_SHARDS, ShardOutput,
+                                     open_shard_output)
+
+
+def _write_all(shards, paths, model="m", prompt="p"):
+    async def run():
+        await asyncio.gather(*(shards.write(path, f"caption {os.path.basename(path)}", model, prompt) for path in paths))
+    asyncio.run(run())
+
+
+class TestShardOutput:
+    def test_jsonl_shards_roll_over(self, tmp_path):
+        shards = ShardOutput(str(tmp_path), OUTPUT_FORMAT_JSONL_SHARDS, max_records=4)
+        try:
+            _write_all(shards, [f"/images/{i}.jpg" for i in range(10)])
+            # captions written together share one batch
+            assert shards.batches < 10
+        finally:
+            shards.close()
+        names = sorted(n for n in os.listdir(tmp_path) if n.endswith(".jsonl"))
+        assert names == ["captions-000000.jsonl", "captions-000001.jsonl", "captions-000002.jsonl"]
+        lines = [json.loads(line) for name in names for line in (tmp_path / name).read_text(encoding="utf-8").splitlines()]
+        assert len(lines) == 10
+        assert set(lines[0]) == {"image_path", "text", "model", "prompt"}
+
+    def test_tar_shards_are_webdataset_style(self, tmp_path):
+        shards = ShardOutput(str(tmp_path), OUTPUT_FORMAT_TAR_SHARDS)
+        try:
+            _write_all(shards, ["/images/a.jpg", "/images/b.jpg"])
+        finally:
+            shards.close()
+        with tarfile.open(tmp_path / "captions-000000.tar") as tar:
+            names = tar.getnames()
+            assert names == ["000000_0000000.txt", "000000_0000000.json", "000000_0000001.txt", "000000_0000001.json"]
+            metadata = json.loads(tar.extractfile(names[1]).read())
+            caption = tar.extractfile(names[0]).read().decode("utf-8")
+        assert caption == f"caption {os.path.basename(metadata['image_path'])}"
+        assert metadata["model"] == "m"
+
+    def test_index_survives_reopen_and_new_run_starts_new_shard(self, tmp_path):
+        shards = ShardOutput(str(tmp_path))
+        try:
+            _write_all(shards, ["/images/a.jpg"])
+        finally:
+            shards.close()
+        shards = ShardOutput(str(tmp_path))
+        try:
+            found = asyncio.run(shards.contains_many(["/images/a.jpg", "/images/b.jpg"], "m", "p"))
+            assert found == [True, False]
+            assert asyncio.run(shards.contains("/images/a.jpg", "other model", "p")) is False
+            _write_all(shards, ["/images/b.jpg"])
+        finally:
+            shards.close()
+        assert sorted(n for n in os.listdir(tmp_path) if n.endswith(".jsonl")) == ["captions-000000.jsonl", "captions-000001.jsonl"]
+
+    def test_shard_number_taken_by_another_worker_is_skipped(self, tmp_path, monkeypatch):
+        shards = ShardOutput(str(tmp_path))
+        # The other worker created its shard after this one listed the directory
+        (tmp_path / "captions-000000.jsonl").write_text("")
+        monkeypatch.setattr(shards, "_next_number", lambda conn: 0)
+        try:
+            _write_all(shards, ["/images/a.jpg"])
+        finally:
+            shards.close()
+        assert (tmp_path / "captions-000000.jsonl").read_text() == ""
+        assert "a.jpg" in (tmp_path / "captions-000001.jsonl").read_text()
+
+    def test_index_holds_paths_relative_to_base_directory(self, tmp_path):
+        images = tmp_path / "images"
+        shards = ShardOutput(str(tmp_path / "shards"), base_directory=str(images))
+        try:
+            _write_all(shards, [str(images / "sub" / "a.jpg")])
+            rows = shards._call_sync(lambda conn: conn.execute("SELECT image_path FROM entries").fetchall())
+            assert rows == [("sub/a.jpg",)]
+            assert asyncio.run(shards.contains(os.path.join(str(images), "sub", "..", "sub", "a.jpg"), "m", "p"))
+            assert shards._call_sync(lambda conn: conn.execute("PRAGMA journal_mode").fetchone()) == ("delete",)
+        finally:
+            shards.close()
+
+    def test_skip_if_caption_exists(self, tmp_path):
+        images = tmp_path / "images"
+        images.mkdir()
+        for name in ["a.jpg", "b.jpg"]:
+            (images / name).write_bytes(b"x")
+        (tmp_path / "shards").mkdir()
+        shards = ShardOutput(str(tmp_path / "shards"))
+
+        async def run():
+            await save_caption(str(images / "a.jpg"), "a caption", "", output_format=OUTPUT_FORMAT_JSONL_SHARDS,
+                               model="m", concat_prompt="p", shard_output=shards)
+            return [os.path.basename(p) async for p in image_walk(
+                str(images), recursive=True, skip_if_caption_exists=True, output_format=OUTPUT_FORMAT_JSONL_SHARDS,
+                model="m", concat_prompt="p", caption_index=shards)]
+
+        try:
+            assert asyncio.run(run()) == ["b.jpg"]
+        finally:
+            shards.close()
+
+    def test_failed_shard_write_is_a_failed_result(self, tmp_path, monkeypatch):
+        conf = OmegaConf.create({"model": "m", "prompts": ["describe"], "output_format": OUTPUT_FORMAT_JSONL_SHARDS})
+        shards = ShardOutput(str(tmp_path))
+
+        def full_disk(conn, entries):
+            raise OSError("No space left on device")
+        monkeypatch.setattr(shards, "_commit", full_disk)
+        try:
+            job = ImageJob(str(tmp_path / "a.jpg"), model="m", caption_text="a caption")
+            result = asyncio.run(write_image(job, conf, shard_output=shards))
+        finally:
+            shards.close()
+        assert result["success"] is False
+        assert "No space left" in result["error"]
+
+    def test_open_shard_output(self, tmp_path):
+        assert open_shard_output(OmegaConf.create({"output_format": "txt"})) is None
+        conf = OmegaConf.create({"output_format": "tar_shards", "base_directory": str(tmp_path),
+                                 "shard_output": {"max_mb": 1, "prefix": "train"}})
+        shards = open_shard_output(conf)
+        try:
+            assert shards.directory == os.path.join(str(tmp_path), "caption_shards")
+            assert shards.base_directory == str(tmp_path)
+            assert shards.max_bytes == 1024 * 1024
+            assert shards.prefix == "train"
+        finally:
+            shards.close()
+
+    def test_unknown_format(self, tmp_path):
+        with pytest.raises(ValueError):
+            ShardOutput(str(tmp_path), "zip_shards")
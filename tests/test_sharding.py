@@ -0,0 +1,68 @@
+import asyncio
+import os
+
+import pytest
+from omegaconf import OmegaConf
+
+from caption_openai import _walk_images
+from file_utils.run_ledger import ledger_job_key
+from metrics.timing import RunMetrics
+from scheduling.sharding import Shard, create_shard, shard_of
+
+PATHS = [f"dir{i % 7}/img{i}.jpg" for i in range(500)]
+
+
+class TestShardOf:
+    def test_shards_are_disjoint_and_complete(self):
+        for count in (2, 3, 8):
+            shards = [[p for p in PATHS if shard_of(p, count) == index] for index in range(count)]
+            assert sorted(p for shard in shards for p in shard) == sorted(PATHS)
+            assert all(shard for shard in shards)
+
+    def test_separators_do_not_matter(self):
+        assert all(shard_of(p, 5) == shard_of(p.replace("/", "\\"), 5) for p in PATHS)
+
+    def test_stable_across_runs(self):
+        # Unlike hash(), the shard does not depend on the process or Python version
+        assert [shard_of(p, 4) for p in ["a/b.jpg", "cat.png", "x/y/z.webp"]] == [0, 2, 3]
+
+
+class TestShard:
+    def test_selects_by_relative_path(self, tmp_path):
+        base_a, base_b = str(tmp_path / "mount_a"), str(tmp_path / "mount_b")
+        a, b = Shard(1, 3, base_a), Shard(1, 3, base_b)
+        assert [a.selects(os.path.join(base_a, p)) for p in PATHS] == [b.selects(os.path.join(base_b, p)) for p in PATHS]
+        assert a.seen == len(PATHS) and 0 < a.selected < len(PATHS)
+
+    def test_config(self):
+        assert create_shard(OmegaConf.create({"base_directory": "x"})) is None
+        shard = create_shard(OmegaConf.create({"base_directory": "x", "shard_index": 2, "shard_count": 4}))
+        assert (shard.index, shard.count, shard.label) == (2, 4, "shard 2/4")
+        with pytest.raises(ValueError, match="shard_index"):
+            create_shard(OmegaConf.create({"base_directory": "x", "shard_index": 4, "shard_count": 4}))
+
+    def test_ledger_key_includes_shard(self):
+        conf = OmegaConf.create({"base_directory": "x", "model": "m"})
+        sharded = OmegaConf.create({"base_directory": "x", "model": "m", "shard_index": 0, "shard_count": 2})
+        other = OmegaConf.create({"base_directory": "x", "model": "m", "shard_index": 1, "shard_count": 2})
+        keys = {ledger_job_key(c, "p") for c in (conf, sharded, other)}
+        assert len(keys) == 3
+        assert ledger_job_key(OmegaConf.create({"base_directory": "x", "model": "m", "shard_count": 1}), "p") == \
+            ledger_job_key(conf, "p")
+
+
+class TestShardedWalk:
+    def test_workers_cover_the_tree(self, tmp_path):
+        for i in range(40):
+            (tmp_path / f"img{i}.jpg").write_bytes(b"x")
+
+        async def walk(index):
+            conf = OmegaConf.create({"base_directory": str(tmp_path), "recursive": False, "prompts": ["p"]})
+            shard = Shard(index, 3, str(tmp_path))
+            paths = [p async for p in _walk_images(conf, None, None, None, RunMetrics(), shard=shard)]
+            return paths, shard
+
+        results = [asyncio.run(walk(index)) for index in range(3)]
+        walked = [path for paths, _ in results for path in paths]
+        assert len(walked) == len(set(walked)) == 40
+        assert all(shard.seen == 40 and shard.selected == len(paths) for paths, shard in results)
@@ -0,0 +1,121 @@
+import asyncio
+import os
+
+from omegaconf import OmegaConf
+
+from file_utils.file_access import IMAGE_EXTENSIONS, _scan_dir, image_walk
+from file_utils.walk_snapshot import WalkSnapshot, open_walk_snapshot
+
+
+def _tree(root):
+    for rel in ["a.jpg", "a.txt", "d1/b.png", "d1/d2/c.jpg", "d3/e.webp"]:
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x")
+    # Listings taken right after a change are not trusted, so make the tree look settled
+    for directory in [root, root / "d1", root / "d1" / "d2", root / "d3"]:
+        _age(directory)
+
+
+def _age(directory, seconds=60):
+    mtime = os.stat(directory).st_mtime_ns - seconds * 1_000_000_000
+    os.utime(directory, ns=(mtime, mtime))
+
+
+def _walk(root, snapshot):
+    async def run():
+        return sorted([os.path.relpath(p, root).replace(os.sep, "/") async for p in image_walk(
+            str(root), recursive=True, skip_if_caption_exists=False, walk_snapshot=snapshot)])
+    return asyncio.run(run())
+
+
+class _CountingScan:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, path):
+        self.calls.append(path)
+        return _scan_dir(path)
+
+
+class TestWalkSnapshot:
+    def test_unchanged_directory_served_from_snapshot(self, tmp_path):
+        _tree(tmp_path)
+        snapshot = WalkSnapshot(str(tmp_path / "snap.sqlite"))
+        try:
+            scan = _CountingScan()
+            first = snapshot.listing(str(tmp_path / "d1"), scan)
+            second = snapshot.listing(str(tmp_path / "d1"), scan)
+            assert len(scan.calls) == 1
+            assert sorted(first) == sorted(second)
+            assert (snapshot.hits, snapshot.misses) == (1, 1)
+        finally:
+            snapshot.close()
+
+    def test_changed_directory_is_listed_again(self, tmp_path):
+        _tree(tmp_path)
+        snapshot = WalkSnapshot(str(tmp_path / "snap.sqlite"))
+        try:
+            scan = _CountingScan()
+            directory = tmp_path / "d1"
+            snapshot.listing(str(directory), scan)
+            (directory / "new.jpg").write_bytes(b"x")
+            os.utime(directory, ns=(0, os.stat(directory).st_mtime_ns + 1_000_000_000))
+            entries = snapshot.listing(str(directory), scan)
+            assert len(scan.calls) == 2
+            assert str(directory / "new.jpg") in [path for path, _, _ in entries]
+        finally:
+            snapshot.close()
+
+    def test_listing_in_the_same_tick_is_listed_again(self, tmp_path):
+        directory = tmp_path / "fresh"
+        directory.mkdir()
+        (directory / "a.jpg").write_bytes(b"x")
+        snapshot = WalkSnapshot(str(tmp_path / "snap.sqlite"))
+        try:
+            scan = _CountingScan()
+            snapshot.listing(str(directory), scan)
+            # A file added within the same coarse timestamp tick leaves the mtime as it was
+            mtime = os.stat(directory).st_mtime_ns
+            (directory / "b.jpg").write_bytes(b"x")
+            os.utime(directory, ns=(mtime, mtime))
+            entries = snapshot.listing(str(directory), scan)
+            assert len(scan.calls) == 2
+            assert str(directory / "b.jpg") in [path for path, _, _ in entries]
+        finally:
+            snapshot.close()
+
+    def test_walk_with_snapshot_finds_same_images(self, tmp_path):
+        images = tmp_path / "images"
+        images.mkdir()
+        _tree(images)
+        expected = ["a.jpg", "d1/b.png", "d1/d2/c.jpg", "d3/e.webp"]
+        path = str(tmp_path / "snap.sqlite")
+
+        snapshot = WalkSnapshot(path)
+        assert _walk(images, snapshot) == expected
+        assert snapshot.hits == 0
+        snapshot.close()
+
+        snapshot = WalkSnapshot(path)
+        assert _walk(images, snapshot) == expected
+        assert (snapshot.hits, snapshot.misses) == (4, 0)
+        snapshot.close()
+
+    def test_count_images(self, tmp_path):
+        images = tmp_path / "images"
+        images.mkdir()
+        _tree(images)
+        snapshot = WalkSnapshot(str(tmp_path / "snap.sqlite"))
+        try:
+            assert asyncio.run(snapshot.count_images(str(images), True, IMAGE_EXTENSIONS)) is None
+            _walk(images, snapshot)
+            assert asyncio.run(snapshot.count_images(str(images), True, IMAGE_EXTENSIONS)) == 4
+            assert asyncio.run(snapshot.count_images(str(images), False, IMAGE_EXTENSIONS)) == 1
+            # a.jpg already has a.txt
+            assert asyncio.run(snapshot.count_images(str(images), True, IMAGE_EXTENSIONS, uncaptioned_txt=True)) == 3
+        finally:
+            snapshot.close()
+
+    def test_disabled_by_default(self):
+        assert open_walk_snapshot(OmegaConf.create({})) is None
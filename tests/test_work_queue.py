@@ -0,0 +1,239 @@
+import asyncio
+import os
+import time
+
+import pytest
+from omegaconf import OmegaConf
+
+from caption_openai import _claim_images
+from file_utils.work_queue import STATE_DONE, STATE_FAILED, STATE_LEASED, STATE_QUEUED, WorkQueue, open_work_queue
+from metrics.timing import RunMetrics
+
+
+def _queues(tmp_path, count=2, **kwargs):
+    path = str(tmp_path / "queue.sqlite")
+    return [WorkQueue(path, str(tmp_path), worker=f"w{i}", **kwargs) for i in range(count)]
+
+
+def _images(tmp_path, count):
+    return [str(tmp_path / f"img{i}.jpg") for i in range(count)]
+
+
+def _close(queues):
+    for queue in queues:
+        queue.close()
+
+
+class TestWorkQueue:
+    def test_claims_are_disjoint(self, tmp_path):
+        a, b = _queues(tmp_path)
+
+        async def run():
+            await a.open_job("job")
+            await a.add(_images(tmp_path, 10))
+            return await a.claim(4), await b.claim(4), await b.claim(4)
+
+        try:
+            first, second, third = asyncio.run(run())
+        finally:
+            _close((a, b))
+        assert len(first) == len(second) == 4 and len(third) == 2
+        assert sorted(first + second + third) == sorted(_images(tmp_path, 10))
+
+    def test_expired_lease_is_reclaimed(self, tmp_path):
+        a, b = _queues(tmp_path, lease_seconds=0.05)
+
+        async def run():
+            await a.add(_images(tmp_path, 2))
+            claimed = await a.claim(2)
+            assert await b.claim(2) == []
+            await asyncio.sleep(0.1)
+            return claimed, await b.claim(2)
+
+        try:
+            claimed, reclaimed = asyncio.run(run())
+        finally:
+            _close((a, b))
+        assert sorted(claimed) == sorted(reclaimed)
+
+    def test_heartbeat_keeps_leases(self, tmp_path):
+        a, b = _queues(tmp_path, lease_seconds=0.2)
+
+        async def run():
+            await a.add(_images(tmp_path, 1))
+            await a.claim()
+            for _ in range(3):
+                await asyncio.sleep(0.1)
+                await a.heartbeat()
+            return await b.claim()
+
+        try:
+            assert asyncio.run(run()) == []
+        finally:
+            _close((a, b))
+
+    def test_done_is_never_handed_out_again(self, tmp_path):
+        a, b = _queues(tmp_path, lease_seconds=0.05)
+
+        async def run():
+            await a.add(_images(tmp_path, 3))
+            claimed = await a.claim(3)
+            await asyncio.gather(*(a.complete(path) for path in claimed))
+            await asyncio.sleep(0.1)
+            await a.add(_images(tmp_path, 3))
+            return await b.claim(3), await a.counts(), a.completed
+
+        try:
+            reclaimed, counts, completed = asyncio.run(run())
+        finally:
+            _close((a, b))
+        assert reclaimed == [] and counts[STATE_DONE] == completed == 3
+
+    def test_failures_are_retried_then_failed(self, tmp_path):
+        a, b = _queues(tmp_path, max_attempts=2)
+
+        async def run():
+            image = _images(tmp_path, 1)[0]
+            await a.add([image])
+            await a.claim()
+            first = await a.fail(image, "timeout")
+            assert await b.claim() == [image]
+            return first, await b.fail(image, "timeout again"), await b.remaining()
+
+        try:
+            assert asyncio.run(run()) == (STATE_QUEUED, STATE_FAILED, 0)
+        finally:
+            _close((a, b))
+
+    def test_late_completion_after_lease_expired_is_reported(self, tmp_path):
+        a, b = _queues(tmp_path, lease_seconds=0.05)
+
+        async def run():
+            done, failed = _images(tmp_path, 2)
+            await a.add([done, failed])
+            await a.claim(2)
+            await asyncio.sleep(0.1)
+            assert sorted(await b.claim(2)) == sorted([done, failed])
+            # a finishes after its leases ran out and b took the images over
+            late = await a.complete(done), await a.fail(failed, "timeout"), a.completed
+            return late, await b.complete(done), await b.counts()
+
+        try:
+            late, completed, counts = asyncio.run(run())
+        finally:
+            _close((a, b))
+        assert late == (False, STATE_LEASED, 0)
+        assert completed and counts[STATE_DONE] == 1 and counts[STATE_LEASED] == 1
+
+    def test_release_returns_unfinished_images(self, tmp_path):
+        a, b = _queues(tmp_path)
+
+        async def run():
+            await a.add(_images(tmp_path, 4))
+            await a.claim(4)
+            return await a.release(), await b.claim(4)
+
+        try:
+            released, claimed = asyncio.run(run())
+        finally:
+            _close((a, b))
+        assert released == 4 and len(claimed) == 4
+
+    def test_walk_lease(self, tmp_path):
+        a, b = _queues(tmp_path, lease_seconds=0.05)
+
+        async def run():
+            assert await a.claim_walk() and not await b.claim_walk()
+            await asyncio.sleep(0.1)
+            assert await b.claim_walk()
+            await a.finish_walk()
+            assert not await a.walk_complete()
+            await b.finish_walk()
+            return await a.walk_complete(), await a.claim_walk()
+
+        try:
+            assert asyncio.run(run()) == (True, False)
+        finally:
+            _close((a, b))
+
+    def test_finished_job_walks_again(self, tmp_path):
+        (a,) = _queues(tmp_path, count=1)
+
+        async def run():
+            await a.open_job("job")
+            await a.claim_walk()
+            await a.add(_images(tmp_path, 1))
+            await a.finish_walk()
+            await a.complete((await a.claim())[0])
+            await a.open_job("job")
+            return await a.walk_complete()
+
+        try:
+            assert asyncio.run(run()) is False
+        finally:
+            a.close()
+
+    def test_other_job_rejected(self, tmp_path):
+        a, b = _queues(tmp_path)
+
+        async def run():
+            await a.open_job("job")
+            await b.open_job("another job")
+
+        try:
+            with pytest.raises(ValueError, match="another model"):
+                asyncio.run(run())
+        finally:
+            _close((a, b))
+
+    def test_paths_are_relative_to_each_mount(self, tmp_path):
+        path = str(tmp_path / "queue.sqlite")
+        a = WorkQueue(path, str(tmp_path / "mount_a"), worker="a")
+        b = WorkQueue(path, str(tmp_path / "mount_b"), worker="b")
+
+        async def run():
+            await a.add([os.path.join(str(tmp_path / "mount_a"), "sub", "cat.png")])
+            return await b.claim()
+
+        try:
+            assert asyncio.run(run()) == [os.path.join(str(tmp_path / "mount_b"), "sub", "cat.png")]
+        finally:
+            _close((a, b))
+
+    def test_disabled_by_default(self):
+        assert open_work_queue(OmegaConf.create({"base_directory": "x"})) is None
+
+
+class TestClaimImages:
+    def test_workers_share_the_tree(self, tmp_path):
+        images = tmp_path / "images"
+        images.mkdir()
+        for i in range(30):
+            (images / f"img{i}.jpg").write_bytes(b"x")
+        conf = OmegaConf.create({"base_directory": str(images), "recursive": False, "prompts": ["p"],
+                                 "work_queue": {"claim_size": 4, "poll_seconds": 0.01}})
+        queues = [WorkQueue(str(tmp_path / "queue.sqlite"), str(images), worker=f"w{i}") for i in range(3)]
+
+        async def worker(queue, delay):
+            captioned = []
+            async for image_path in _claim_images(conf, queue, None, None, RunMetrics()):
+                await asyncio.sleep(delay)
+                captioned.append(image_path)
+                await queue.complete(image_path)
+            return captioned
+
+        async def run():
+            await queues[0].open_job("job")
+            return await asyncio.gather(*(worker(queue, delay) for queue, delay in zip(queues, (0, 0.005, 0.02))))
+
+        started = time.monotonic()
+        try:
+            results = asyncio.run(run())
+            counts = asyncio.run(queues[0].counts())
+        finally:
+            _close(queues)
+        captioned = [path for result in results for path in result]
+        assert len(captioned) == len(set(captioned)) == 30
+        assert len(results[0]) > len(results[2])
+        assert counts[STATE_DONE] == 30
+        assert time.monotonic() - started < 10